@@ -1,19 +1,33 @@
-from os.path import isfile, abspath
-from sys import argv
-from typing import Iterator, List, Optional, Tuple
+import json
+from array import array
+from itertools import chain
+from linecache import getline
+from os.path import isfile, abspath, splitext
+from sys import argv, byteorder
+from typing import Callable, Dict, Iterable, Iterator, List, NoReturn, Optional, TextIO, Tuple, Union
 
+from built_in.built_in import host_function
 from compiler.lib import CompileError
 
-label: dict[str, int] = {}
 # register to binary
 rtob = {"A": "000", "C": "001", "D": "010", "L": "011", "M": "100", "P": "101", "T": "110", "V": "111"}
 btor = {"000": "A", "001": "C", "010": "D", "011": "L", "100": "M", "101": "P", "110": "T", "111": "V"}
 # C-code to binary
 ctob = {"nv": "000", ">": "001", "==": "010", ">=": "011", "<": "100", "!=": "101", "<=": "110", "aw": "111"}
 btoc = {"000": "nv", "001": "> ", "010": "==", "011": ">=", "100": "< ", "101": "!=", "110": "<=", "111": "aw"}
+# memory-mapped console (see emulator.Console): the last page below 2^31, above the interpreter frames
+# (interpreter.FRAME_BASE = 1 << 20) and the heap (built_in.built_in.HEAP_BASE = 1 << 24 up to HEAP_END = 1 << 30)
+CONSOLE_BASE = 2147479552
+CONSOLE_CHAR = 0  # write a character / read the next input character, -1 at the end
+CONSOLE_INT = 1  # write a decimal number / read the next integer of the input
+CONSOLE_FLUSH = 2  # write anything to flush the output
 # operator to binary
 otob = {"add": "000", "sub": "001", "mul": "010", "div": "011", "rmv": "100", "lmv": "101", "and": "110", "or_": "111"}
 btoo = {"000": "add", "001": "sub", "010": "mul", "011": "div", "100": "rmv", "101": "lmv", "110": "and", "111": "or_"}
+# the same as integers, for assembler2
+rtoi = {k: int(v, 2) for k, v in rtob.items()}
+ctoi = {k: int(v, 2) for k, v in ctob.items()}
+otoi = {k: int(v, 2) for k, v in otob.items()}
 
 
 def asmtovm(asm: str, file: str) -> List[str]:
@@ -60,357 +74,653 @@ def asmtovm(asm: str, file: str) -> List[str]:
                 # sett
                 code.append(f"sett {str(int(getvalue(a, 3), 2))}")
                 assert "0000000000" == getvalue(a, 10)
+            elif code_type == "111":
+                # trap
+                code.append(f"trap {int(getvalue(a, 12), 2)}")
+                assert "0" == next(a)
             else:
                 error(f"error: unknown code type '{code_type}'", file, -1)
     except StopIteration:
         return code
 
 
-def split_newlines(source: List[str]) -> List[str]:
-    result: List[str] = []
-    for line in source:
-        result.extend(line.split("\n"))
-    return result
+# one instruction: its words, and the line of the .vm source it comes from
+Words = Tuple[str, ...]
+Instruction = Tuple[Words, int]
+
+
+def parse(source: Iterable[str]) -> Iterator[Instruction]:
+    """Split each line of `source` into its words once, skipping blank lines."""
+    for line, i in enumerate(source):
+        words = tuple(i.split())
+        if words:
+            yield words, line
+
+
+def unparse(source: Iterable[Instruction]) -> Iterator[str]:
+    for words, _ in source:
+        yield " ".join(words)
+
+
+def dump(source: Iterable[Instruction], out: TextIO) -> Iterator[Instruction]:
+    """Pass `source` through, writing every instruction to `out` on the way (for -o0 and -o1)."""
+    for i in source:
+        out.write(" ".join(i[0]) + "\n")
+        yield i
+
+
+# the expansions of the stages, split once here; `{n}` stands for the n-th argument of expand
+Template = List[Tuple[Words, bool]]
+
+
+def template(text: str) -> Template:
+    return [(tuple(i.split()), "{" in i) for i in text.split("\n")]
+
+
+def expand(expansion: Template, line: int, *args: object) -> Iterator[Instruction]:
+    for words, fields in expansion:
+        yield (tuple(i.format(*args) for i in words) if fields else words), line
 
 
-def error(text: str, file: str, line: int) -> None:
+def error(text: str, file: str, line: int) -> NoReturn:
     raise CompileError(text, file, (line, 0), "assembler")
 
 
-def my_bin(n: int, l: Optional[int] = None) -> str:
-    neg = n < 0
-    n = abs(n)
-    result = ""
-    while n > 1:
-        result = str(n % 2) + result
-        n = n // 2
-    if n == 1:
-        result = "1" + result
-    if l is None:
-        result = "0" + result
-    else:
-        if len(result) < l:
-            result = "0" * (l - len(result)) + result
-        elif len(result) != l:
-            raise ValueError("l is too small")
-    if neg:
-        result = "".join("1" if i == "0" else "0" for i in result)
-        result = bin(int(result, 2) + 1)[2:]
-    return result
-
-
-def assembler2(source: List[str], file: str) -> str:
-    code = ""
-    code_len = 0
-    for line, i in enumerate(source):
-        i = i.strip()
-        if i.startswith("inpv"):
-            i = i.split()
-            if len(i) == 2:
-                if -2048 <= int(i[1]) < 2047:
-                    code += f"000{my_bin(int(i[1]), 12)}0"
-                    code_len += 2
-                else:
-                    n = abs(int(i[1])).bit_length() + 1
-                    n += 12 - (n % 12)
-                    binary = my_bin(int(i[1]), n)
-                    code += f"000{binary[:12]}"
-                    code_len += 2
-                    for j in range(1, len(binary) // 12):
-                        code += f"1101{binary[j*12:j*12+12]}"
-                        code_len += 2
-                    code += "0"
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("copy"):
-            i = i.split()
-            if len(i) == 3 and i[1][0] == "$" and i[2][0] == "$":
-                code += f"001{rtob[i[1][1]]}{rtob[i[2][1]]}" + "0" * 7
-                code_len += 2
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("jump"):
-            i = i.split()
-            if len(i) == 3 and i[1][0] == "$" and i[2][0] == "$":
-                code += f"010{rtob[i[1][1]]}{rtob[i[2][1]]}" + "0" * 7
-                code_len += 2
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("comp"):
-            i = i.split()
-            if len(i) == 4 and i[1][0] == "$" and i[3][0] == "$":
-                if i[2] in ("nv", ">", "==", ">=", "<", "!=", "<=", "aw"):
-                    code += f"011{rtob[i[1][1]]}{ctob[i[2]]}{rtob[i[3][1]]}0000"
-                    code_len += 2
-                else:
-                    error("Unknown C-code", file, line)
-            else:
-                error("Unknown format", file, line)
-        elif i[:3] in ("add", "sub", "mul", "div", "rmv", "lmv", "and", "or_"):
-            i = i.split()
-            if len(i) == 4 and i[0][3] == "r" and i[1][0] == "$" and i[2][0] == "$" and i[3][0] == "$":
-                code += f"100{otob[i[0][:3]]}{rtob[i[1][1]]}{rtob[i[2][1]]}{rtob[i[3][1]]}0"
-                code_len += 2
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("sett"):
-            i = i.split()
+def value_words(value: int) -> List[int]:
+    """The inpv word, followed by exte words for values outside -2048..2047, that load `value` into $V."""
+    if -2048 <= value <= 2047:
+        return [(value & 0xFFF) << 1]
+    n = abs(value).bit_length() + 1
+    n += 12 - (n % 12)
+    value &= (1 << n) - 1
+    count = n // 12
+    words: List[int] = []
+    for k in range(count):
+        chunk = value >> (n - 12 * (k + 1)) & 0xFFF
+        words.append((0 if k == 0 else 5) << 13 | chunk << 1 | (k < count - 1))
+    return words
+
+
+def words_to_bytes(words: "array[int]") -> bytes:
+    """The .asm image of `words`, each one stored big-endian."""
+    if byteorder == "little":
+        words.byteswap()
+    return words.tobytes()
+
+
+def registers(words: Words, *fields: int) -> bool:
+    """Whether the words at `fields` are all registers."""
+    return all(len(words[i]) == 2 and words[i][0] == "$" and words[i][1] in rtoi for i in fields)
+
+
+def encode_copy(words: Words, line: int, file: str) -> int:
+    if len(words) == 3 and registers(words, 1, 2):
+        return 1 << 13 | rtoi[words[1][1]] << 10 | rtoi[words[2][1]] << 7
+    error("Unknown format", file, line)
+
+
+def encode_jump(words: Words, line: int, file: str) -> int:
+    if len(words) == 3 and registers(words, 1, 2):
+        return 2 << 13 | rtoi[words[1][1]] << 10 | rtoi[words[2][1]] << 7
+    error("Unknown format", file, line)
+
+
+def encode_comp(words: Words, line: int, file: str) -> int:
+    if len(words) == 4 and registers(words, 1, 3):
+        if words[2] in ctoi:
+            return 3 << 13 | rtoi[words[1][1]] << 10 | ctoi[words[2]] << 7 | rtoi[words[3][1]] << 4
+        error("Unknown C-code", file, line)
+    error("Unknown format", file, line)
+
+
+def encode_operator(words: Words, line: int, file: str) -> int:
+    if len(words) == 4 and registers(words, 1, 2, 3):
+        return 4 << 13 | otoi[words[0][:3]] << 10 | rtoi[words[1][1]] << 7 | rtoi[words[2][1]] << 4 | rtoi[words[3][1]] << 1
+    error("Unknown format", file, line)
+
+
+def encode_sett(words: Words, line: int, file: str) -> int:
+    if len(words) == 2:
+        if 0 <= int(words[1]) <= 7:
+            return 6 << 13 | int(words[1]) << 10
+        error("$T can only be switched in the range of 0~7", file, line)
+    error("Unknown format", file, line)
+
+
+def encode_trap(words: Words, line: int, file: str) -> int:
+    if len(words) == 2:
+        if 0 <= int(words[1]) < 4096:
+            return 7 << 13 | int(words[1]) << 1
+        error("trap number must be in the range of 0~4095", file, line)
+    error("Unknown format", file, line)
+
+
+# o1 instructions taking one word (inpv, //setl and //getl are handled by assembler2 itself)
+encoders: Dict[str, Callable[[Words, int, str], int]] = {
+    "copy": encode_copy,
+    "jump": encode_jump,
+    "comp": encode_comp,
+    "sett": encode_sett,
+    "trap": encode_trap,
+}
+encoders.update((f"{k}r", encode_operator) for k in otoi)
+
+
+def assembler2(source: Iterable[Instruction], file: str, symbols: Optional[Dict[str, int]] = None) -> bytes:
+    """
+    Encode o1 code into the .asm image.
+    The first pass encodes every instruction into 16-bit words, recording where labels are and leaving one
+    placeholder per //getl. Then the size of every //getl is relaxed (see relax) and each placeholder is
+    replaced with the words loading that address.
+    If `symbols` is given, every label defined by //setl is also recorded in it with its address.
+    """
+    words = array("H")
+    # label -> index in words
+    table: Dict[str, int] = {}
+    # (index of the placeholder in words, label, line)
+    fixups: List[Tuple[int, str, int]] = []
+    for i, line in source:
+        encode = encoders.get(i[0])
+        if encode is not None:
+            words.append(encode(i, line, file))
+        elif i[0] == "inpv":
             if len(i) == 2:
-                if 0 <= int(i[1]) <= 7:
-                    code += f"110{my_bin(int(i[1]), 3)}0000000000"
-                    code_len += 2
-                else:
-                    error("$T can only be switched in the range of 0~7", file, line)
+                words.extend(value_words(int(i[1])))
             else:
                 error("Unknown format", file, line)
-        elif i.startswith("//setl"):
-            i = i.split()
+        elif i[0] == "//setl":
             if len(i) == 2:
-                label[i[1]] = code_len
+                table[i[1]] = len(words)
             else:
                 error("Unknown format", file, line)
-        elif i.startswith("//getl"):
-            i = i.split()
+        elif i[0] == "//getl":
             if len(i) == 2:
-                code += f"/{i[1]}/"
-                code_len += 2
+                fixups.append((len(words), i[1], line))
+                words.append(0)
             else:
                 error("Unknown format", file, line)
         else:
             error("Unknown command", file, line)
-    while "/" in code:
-        t = code.split("/", maxsplit=2)
-        i = label[t[1]]
-        r = ""
-        if -2048 <= i < 2047:
-            r += f"000{my_bin(i, 12)}0"
+    for index, name, line in fixups:
+        if name not in table:
+            error(f"Unknown label '{name}'", file, line)
+    addresses = relax(table, fixups)
+    if symbols is not None:
+        symbols.update(addresses)
+    if not fixups:
+        return words_to_bytes(words)
+    result = array("H")
+    last = 0
+    for index, name, line in fixups:
+        result.extend(words[last:index])
+        result.extend(value_words(addresses[name]))
+        last = index + 1
+    result.extend(words[last:])
+    return words_to_bytes(result)
+
+
+def relax(table: Dict[str, int], fixups: List[Tuple[int, str, int]]) -> Dict[str, int]:
+    """
+    The address of every label in `table` (label -> index among the words with one placeholder per fixup).
+    Every //getl starts as the one inpv word it takes for an address up to 2047 and only ever grows,
+    as its label moves past what the current number of exte words can hold, until no size changes.
+    This settles on the smallest sizes, and the addresses they give are exactly where the labels end up.
+    """
+    positions = sorted(table.items(), key=lambda i: i[1])
+    sizes = [1] * len(fixups)
+    while True:
+        addresses: Dict[str, int] = {}
+        extra = 0
+        k = 0
+        for name, index in positions:
+            while k < len(fixups) and fixups[k][0] < index:
+                extra += sizes[k] - 1
+                k += 1
+            addresses[name] = 2 * (index + extra)
+        changed = False
+        for k, (index, name, line) in enumerate(fixups):
+            size = len(value_words(addresses[name]))
+            if size > sizes[k]:
+                sizes[k] = size
+                changed = True
+        if not changed:
+            return addresses
+
+
+def expand_setv(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 3 and words[1][0] == "$":
+        return expand(o1_setv, line, words[2], words[1][1])
+    error("Unknown format", file, line)
+
+
+def expand_load(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 3 and words[1][0] == "@" and words[2][0] == "$":
+        return expand(o1_load, line, words[1][1], words[2][1])
+    error("Unknown format", file, line)
+
+
+def expand_stor(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 3 and words[1][0] == "@" and words[2][0] == "$":
+        return expand(o1_stor, line, words[1][1], words[2][1])
+    error("Unknown format", file, line)
+
+
+def expand_operator(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 4 and words[1][0] == "$" and words[3][0] == "$":
+        return expand(o1_operator, line, words[2], words[0][:3], words[1][1], words[3][1])
+    error("Unknown format", file, line)
+
+
+def expand_setl(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 2:
+        return iter([(("//setl", words[1]), line)])
+    error("Unknown format", file, line)
+
+
+def expand_getl(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 3 and words[1][0] == "$":
+        return expand(o1_getl, line, words[2], words[1][1])
+    error("Unknown format", file, line)
+
+
+o1_setv = template("inpv {0}\ncopy $V ${1}")
+o1_load = template("copy ${0} $A\ncopy $M ${1}")
+o1_stor = template("copy ${0} $A\ncopy ${1} $M")
+o1_operator = template("inpv {0}\n{1}r ${2} $V ${3}")
+o1_getl = template("//getl {0}\ncopy $V ${1}")
+# o0 instructions assembler1 expands, the others are already o1
+expanders1: Dict[str, Callable[[Words, int, str], Iterator[Instruction]]] = {
+    "setv": expand_setv,
+    "load": expand_load,
+    "stor": expand_stor,
+    "setl": expand_setl,
+    "getl": expand_getl,
+}
+expanders1.update((f"{k}v", expand_operator) for k in otoi)
+
+
+def assembler1(source: Iterable[Instruction], file: str) -> Iterator[Instruction]:
+    for i, line in source:
+        expander = expanders1.get(i[0])
+        if expander is None:
+            yield i, line
         else:
-            n = abs(i).bit_length() + 1
-            n += 12 - (n % 12)
-            binary = my_bin(i, n)
-            r += f"000{binary[:12]}"
-            for j in range(1, len(binary) // 12):
-                r += f"1101{binary[j*12:j*12+12]}"
-            r += "0"
-        code = t[0] + r + t[2]
-    return code
-
-
-def assembler1(source: List[str], file: str) -> List[str]:
-    code: List[str] = []
-    for line, i in enumerate(source):
-        i = i.strip()
-        if i.startswith("setv"):
-            i = i.split()
-            if len(i) == 3 and i[1][0] == "$":
-                code.append(f"inpv {i[2]}\ncopy $V ${i[1][1]}")
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("load"):
-            i = i.split()
-            if len(i) == 3 and i[1][0] == "@" and i[2][0] == "$":
-                code.append(f"copy ${i[1][1]} $A\ncopy $M ${i[2][1]}")
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("stor"):
-            i = i.split()
-            if len(i) == 3 and i[1][0] == "@" and i[2][0] == "$":
-                code.append(f"copy ${i[1][1]} $A\ncopy ${i[2][1]} $M")
-            else:
-                error("Unknown format", file, line)
-        elif i[:3] in ("add", "sub", "mul", "div", "rmv", "lmv", "and", "or") and i[3] == "v":
-            i = i.split()
-            if len(i) == 4 and i[1][0] == "$" and i[3][0] == "$":
-                code.append(f"inpv {i[2]}\n{i[0][:3]}r ${i[1][1]} $V ${i[3][1]}")
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("setl"):
-            i = i.split()
-            if len(i) == 2:
-                code.append(f"//setl {i[1]}")
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("getl"):
-            i = i.split()
-            if len(i) == 3 and i[1][0] == "$":
-                code.append(f"//getl {i[2]}\ncopy $V ${i[1][1]}")
-            else:
-                error("Unknown format", file, line)
+            yield from expander(i, line, file)
+
+
+# $A and $V are only ever read by the instruction right after the one setting them (see vmcode),
+# so the rules below treat them as dead between instructions
+def self_copy(window: List[Words]) -> Optional[List[Words]]:
+    # copy $x $x
+    a = window[0]
+    if len(a) == 3 and a[0] == "copy" and a[1] == a[2]:
+        return []
+    return None
+
+
+def zero_offset(window: List[Words]) -> Optional[List[Words]]:
+    # addv $x 0 $y -> copy $x $y, without loading 0 into $V
+    a = window[0]
+    if len(a) == 4 and a[0] in ("addv", "subv") and a[2] == "0":
+        return [] if a[1] == a[3] else [("copy", a[1], a[3])]
+    return None
+
+
+def cancel_offset(window: List[Words]) -> Optional[List[Words]]:
+    # addv $x k $x, subv $x k $x: a push right before a pop
+    a, b = window
+    if len(a) == 4 and len(b) == 4 and {a[0], b[0]} == {"addv", "subv"} and a[1] == a[3] == b[1] == b[3] and a[2] == b[2]:
+        return []
+    return None
+
+
+def sett_twice(window: List[Words]) -> Optional[List[Words]]:
+    # sett a, sett b -> sett b
+    a, b = window
+    if a[0] == b[0] == "sett":
+        return [b]
+    return None
+
+
+def reload(window: List[Words]) -> Optional[List[Words]]:
+    # stor @x $y, load @x $z -> stor @x $y, copy $y $z
+    a, b = window
+    if len(a) == 3 and len(b) == 3 and a[0] == "stor" and b[0] == "load" and a[1] == b[1]:
+        if all(i[1] not in "AM" for i in (a[1], a[2], b[2])):
+            return [a] + ([] if a[2] == b[2] else [("copy", a[2], b[2])])
+    return None
+
+
+def store_back(window: List[Words]) -> Optional[List[Words]]:
+    # load @x $y, stor @x $y -> load @x $y
+    a, b = window
+    if len(a) == 3 and len(b) == 3 and a[0] == "load" and b[0] == "stor" and a[1:] == b[1:]:
+        # not load @x $x, which moves the address
+        if a[1][1] not in "AM" and a[2][1] not in "AM" and a[1][1] != a[2][1]:
+            return [a]
+    return None
+
+
+# (name, window size, rewrite): rewrite gets the words of the instructions in a window and returns their replacement,
+# or None to leave them alone. A replacement must be cheaper than the window, so that the pass ends.
+PeepholeRule = Tuple[str, int, Callable[[List[Words]], Optional[List[Words]]]]
+peephole_rules: List[PeepholeRule] = [
+    ("self copy", 1, self_copy),
+    ("zero offset", 1, zero_offset),
+    ("cancel offset", 2, cancel_offset),
+    ("sett twice", 2, sett_twice),
+    ("reload", 2, reload),
+    ("store back", 2, store_back),
+]
+
+
+def peephole(
+    source: Iterable[Instruction], rules: Optional[List[PeepholeRule]] = None, counts: Optional[Dict[str, int]] = None
+) -> Iterator[Instruction]:
+    """
+    Rewrite o0 code with `rules` (peephole_rules by default), counting in `counts` how often each rule fired.
+    Every instruction is appended to the output and the rules are tried on the windows ending there;
+    a replacement goes back through the rules, so rewrites cascade. No window spans a label,
+    since setl matches no rule, so everything up to a label is final and is passed on right away.
+    """
+    rules = peephole_rules if rules is None else rules
+    counts = {} if counts is None else counts
+    code: List[Instruction] = []
+    for i in source:
+        pending = [i]
+        while pending:
+            code.append(pending.pop())
+            for name, size, rewrite in rules:
+                if len(code) >= size:
+                    result = rewrite([j[0] for j in code[-size:]])
+                    if result is not None:
+                        line = code[-size][1]
+                        del code[-size:]
+                        pending.extend((j, line) for j in reversed(result))
+                        counts[name] = counts.get(name, 0) + 1
+                        break
+        if code and code[-1][0][0] == "setl":
+            yield from code
+            code.clear()
+    yield from code
+
+
+def expand_label(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 2:
+        return iter([(("setl", words[1]), line)])
+    error("Unknown format", file, line)
+
+
+def expand_push(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) in (2, 3) and words[1] == "@V":
+        # the expansion overwrites $V with its values, so the address goes through $D
+        return chain(iter([(("copy", "$V", "$D"), line)]), expand_push(("push", "@D") + words[2:], line, file))
+    if len(words) == 2:
+        if words[1][0] == "@":
+            return expand(o0_push_at, line, words[1][1])
+        elif words[1][0] == "$":
+            return expand(o0_push_register, line, words[1][1])
         else:
-            code.append(i)
-    return split_newlines(code)
+            return expand(o0_push_value, line, words[1])
+    elif len(words) == 3:
+        if words[1][0] == "@":
+            return expand(o0_push_at_offset, line, words[1][1], words[2])
+        elif words[1][0] == "$":
+            return expand(o0_push_register_offset, line, words[1][1], words[2])
+    error("Unknown format", file, line)
 
 
-def assembler0(source: List[str], file: str) -> List[str]:
-    code: List[str] = []
-    for line, i in enumerate(source):
-        i = i.strip()
-        if i.startswith("//") or i.startswith("debug") or i == "\n" or i == "":
+def expand_pop(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) in (2, 3) and words[1] == "@V":
+        # the expansion overwrites $V with its values, so the address goes through $D
+        return chain(iter([(("copy", "$V", "$D"), line)]), expand_pop(("pop", "@D") + words[2:], line, file))
+    if len(words) == 2:
+        if words[1][0] == "@":
+            return expand(o0_pop_at, line, words[1][1])
+        elif words[1][0] == "$":
+            return expand(o0_pop_register, line, words[1][1])
+    elif len(words) == 3:
+        if words[1][0] == "@":
+            return expand(o0_pop_at_offset, line, words[1][1], words[2])
+    error("Unknown format", file, line)
+
+
+def expand_goto(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 3:
+        if words[2] in o0_goto:
+            return expand(o0_goto[words[2]], line, words[1])
+        error("flag must be 'true', 'false' or 'all'", file, line)
+    error("Unknown format", file, line)
+
+
+def expand_call(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 3:
+        return chain(
+            expand(o0_call, line, words[2], line),
+            chain.from_iterable(expand(o0_call_argument, line, j) for j in range(int(words[2]))),
+            expand(o0_call_jump, line, words[1], words[2], line),
+        )
+    error("Unknown format", file, line)
+
+
+def expand_halt(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    if len(words) == 1:
+        return expand(o0_halt, line, line)
+    error("Unknown format", file, line)
+
+
+def expand_return(words: Words, line: int, file: str) -> Iterator[Instruction]:
+    return expand(o0_return, line)
+
+
+o0_push_at = template("load @{0} $D\nstor @P $D\naddv $P 1 $P")
+o0_push_register = template("stor @P ${0}\naddv $P 1 $P")
+o0_push_value = template("inpv {0}\nstor @P $V\naddv $P 1 $P")
+o0_push_at_offset = template("sett 7\naddv ${0} {1} $T\nload @T $D\nsett 0\nstor @P $D\naddv $P 1 $P")
+o0_push_register_offset = template("addv ${0} {1} $D\nstor @P $D\naddv $P 1 $P")
+o0_pop_at = template("subv $P 1 $P\nload @P $C\nstor @{0} $C")
+o0_pop_register = template("subv $P 1 $P\nload @P ${0}")
+o0_pop_at_offset = template("subv $P 1 $P\nload @P $C\nsett 7\naddv ${0} {1} $T\nstor @T $C\nsett 0")
+o0_goto = {
+    "true": template("getl $T {0}\nsubv $P 1 $P\nload @P $D\ncopy $D $C\njump $T $C"),
+    "false": template("getl $T {0}\nsubv $P 1 $P\nload @P $D\ncopy $D $C\ninpv 0\ncomp $C == $V\njump $T $C"),
+    "all": template("getl $T {0}\nsetv $C 1\njump $T $C"),
+}
+# call: the frame header (return address, $P once the arguments are popped, caller $L) goes on top of the stack,
+# followed by a copy of the arguments, which $L then points at; $C holds where the arguments start
+o0_call = template(
+    "subv $P {0} $C\ngetl $D call_{1}\nstor @P $D\naddv $P 1 $P\nstor @P $C\naddv $P 1 $P\nstor @P $L\naddv $P 1 $P"
+)
+o0_call_argument = template("addv $C {0} $D\nload @D $D\nstor @P $D\naddv $P 1 $P")
+o0_call_jump = template("subv $P {1} $L\ngetl $D {0}\ninpv 1\njump $D $V\nsetl call_{2}")
+# the first instruction of a subroutine makes room for its locals
+o0_frame = template("addv $L {0} $P")
+o0_halt = template("setv $C 1\ngetl $A halt_{0}\nsetl halt_{0}\njump $A $C")
+# return: the header below $L gives the return address in $C, then $P and $L of the caller, onto which the result is pushed
+o0_return = template(
+    "subv $P 1 $P\nload @P $D\nsett 7\nsubv $L 3 $T\nload @T $C\naddv $T 1 $T\nload @T $P\naddv $T 1 $T\n"
+    "load @T $L\nsett 0\nstor @P $D\naddv $P 1 $P\ninpv 1\njump $C $V"
+)
+# .vm instructions assembler0 expands, the others are already o0
+expanders0: Dict[str, Callable[[Words, int, str], Iterator[Instruction]]] = {
+    "label": expand_label,
+    "push": expand_push,
+    "pop": expand_pop,
+    "goto": expand_goto,
+    "call": expand_call,
+    "halt": expand_halt,
+    "return": expand_return,
+}
+
+
+def assembler0(source: Iterable[Instruction], file: str) -> Iterator[Instruction]:
+    # a subroutine (label with a '.') is held back until its end, when the size of its frame is known
+    subroutine: Optional[Tuple[str, int]] = None
+    size = 0
+    code: List[Instruction] = []
+    for i, line in source:
+        if i[0].startswith(("//", "debug")):
             continue
-        elif i.startswith("label"):
-            code.append(f"setl {i.split()[1]}")
-        elif i.startswith("push"):
-            i = i.split()
-            if len(i) == 2:
-                if i[1][0] == "@":
-                    code.append(f"load @{i[1][1]} $D\nstor @P $D\naddv $P 1 $P")
-                elif i[1][0] == "$":
-                    code.append(f"stor @P ${i[1][1]}\naddv $P 1 $P")
-                else:
-                    code.append(f"inpv {i[1]}\nstor @P $V\naddv $P 1 $P")
-            elif len(i) == 3:
-                if i[1][0] == "@":
-                    code.append(f"sett 7\naddv ${i[1][1]} {i[2]} $T\nload @T $D\nsett 0\nstor @P $D\naddv $P 1 $P")
-                elif i[1][0] == "$":
-                    code.append(f"addv ${i[1][1]} {i[2]} $D\nstor @P $D\naddv $P 1 $P")
-                else:
-                    error("Unknown format", file, line)
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("pop"):
-            i = i.split()
-            if len(i) == 2:
-                if i[1][0] == "@":
-                    code.append(f"subv $P 1 $P\nload @P $D\nstor @{i[1][1]} $D")
-                elif i[1][0] == "$":
-                    code.append(f"subv $P 1 $P\nload @P $D\ncopy ${i[1][1]} $D")
-                else:
-                    error("Unknown format", file, line)
-            elif len(i) == 3:
-                if i[1][0] == "@":
-                    code.append(f"subv $P 1 $P\nload @P $D\nsett 7\naddv ${i[1][1]} {i[2]} $T\nstor @T $D\nsett 0")
-                else:
-                    error("Unknown format", file, line)
-        elif i.startswith("goto"):
-            i = i.split()
-            if len(i) == 3:
-                if i[2] == "true":
-                    code.append(f"getl $T {i[1]}\nsubv $P 1 $P\nload @P $D\ncopy $C $D\njump $T $C")
-                elif i[2] == "false":
-                    code.append(f"getl $T {i[1]}\nsubv $P 1 $P\nload @P $D\ncopy $C $D\ninpv 0\ncomp $C == $V\njump $T $C")
-                elif i[2] == "all":
-                    code.append(f"getl $T {i[1]}\nsetv $C 1\njump $T $C")
-                else:
-                    error("flag must be 'true', 'false' or 'all'", file, line)
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("call"):
-            i = i.split()
-            if len(i) == 3:
-                code.append(f"copy $P $T\nsubv $T {i[2]} $T\ngetl $D {i[1]}\nstor @P $D\naddv $P 1 $P\nsubv $L 4 $D\nload @D $D")
-                code.append("stor @P $D\naddv $P 1 $P\nsubv $P 2 $D\nstor @P $D\naddv $P 1 $P\nstor @P $L\naddv $P 1 $P\nsett 1")
-                code.append("copy $P $T\nsett 0")
-                for j in range(int(i[2])):
-                    code.append(f"addv $T {j} $D\nload @D $D\nstor @P $D\naddv $P 1 $P")
-                code.append(f"sett 1\ncopy $T $L\nsett 0\ngetl $D {i[1]}\ninpv 1\njump $D $V")
-            else:
-                error("Unknown format", file, line)
-        elif i.startswith("return"):
-            code.append("subv $P 1 $P")
-            code.append("load @P $D")
-            code.append("copy $T $D")
-            code.append("subv $L 3 $L")
-            code.append("load @L $D")
-            code.append("addv $L 1 $L")
-            code.append("load @L $P")
-            code.append("addv $L 1 $L")
-            code.append("load @L $L")
-            code.append("inpv 1")
-            code.append("jump $D $V")
-            code.append("stor @P $T")
-            code.append("addv $P 1 $P")
+        if i[0] == "label" and len(i) == 2 and "." in i[1]:
+            yield from frame(subroutine, size, code)
+            subroutine, size, code = (i[1], line), 0, []
+            continue
+        if i[0] in ("push", "pop") and len(i) == 3 and i[1] in ("@L", "$L"):
+            size = max(size, int(i[2]) + 1)
+        expander = expanders0.get(i[0])
+        expanded = iter([(i, line)]) if expander is None else expander(i, line, file)
+        if subroutine is None:
+            yield from expanded
         else:
-            code.append(i)
-    return split_newlines(code)
+            code.extend(expanded)
+    yield from frame(subroutine, size, code)
 
 
-def preprocess(source: List[str]) -> List[str]:
-    code: List[str] = []
-    for i in source:
-        i = i.strip()
-        if i.startswith("call built_in."):
-            if i == "call built_in.neg 1":  # -
-                code.append("pop $D\ninpv 0\nsubr $V $D $D\npush $D")
-            elif i == "call built_in.invert 1":  # !
-                code.append("pop $D\ninpv 0\ncomp $V == $D\npush $C")
-            elif i == "call built_in.add 2":  # +
-                code.append("pop $D\npop $T\naddr $D $T $D\npush $D")
-            elif i == "call built_in.sub 2":  # -
-                code.append("pop $D\npop $T\nsubr $D $T $D\npush $D")
-            elif i == "call built_in.mul 2":  # *
-                code.append("pop $D\npop $T\nmulr $D $T $D\npush $D")
-            elif i == "call built_in.div 2":  # /
-                code.append("pop $D\npop $T\ndivr $D $T $D\npush $D")
-            elif i == "call built_in.or 2":  # |
-                code.append("pop $D\npop $T\nor_r $D $T $D\npush $D")
-            elif i == "call built_in.and 2":  # &
-                code.append("pop $D\npop $T\nandr $D $T $D\npush $D")
-            elif i == "call built_in.lm 2":  # <<
-                code.append("pop $D\npop $T\nlmvr $D $T $D\npush $D")
-            elif i == "call built_in.rm 2":  # >>
-                code.append("pop $D\npop $T\nrmvr $D $T $D\npush $D")
-            elif i == "call built_in.eq 2":  # ==
-                code.append("pop $D\npop $T\ncomp $D == $T\npush $C")
-            elif i == "call built_in.neq 2":  # !=
-                code.append("pop $D\npop $T\ncomp $D != $T\npush $C")
-            elif i == "call built_in.geq 2":  # >=
-                code.append("pop $D\npop $T\ncomp $D >= $T\npush $C")
-            elif i == "call built_in.leq 2":  # <=
-                code.append("pop $D\npop $T\ncomp $D <= $T\npush $C")
-            elif i == "call built_in.gt 2":  # >
-                code.append("pop $D\npop $T\ncomp $D > $T\npush $C")
-            elif i == "call built_in.lt 2":  # <
-                code.append("pop $D\npop $T\ncomp $D < $T\npush $C")
-            elif i == "call built_in.bool 1":  # bool
-                code.append("pop $D\ninpv 0\ncomp $D == $V\ncomp $C == $V\npush $C")
+def frame(subroutine: Optional[Tuple[str, int]], size: int, code: List[Instruction]) -> Iterator[Instruction]:
+    """The code of a subroutine, starting with its label and the room for `size` arguments and locals."""
+    if subroutine is not None:
+        yield ("setl", subroutine[0]), subroutine[1]
+        yield from expand(o0_frame, subroutine[1], size)
+    yield from code
+
+
+def expand_host(words: Words, line: int) -> Optional[Iterator[Instruction]]:
+    """The expansion of `call <name> <argc>` if preprocess handles that call."""
+    host = host_function.get(words[1])
+    if host is not None and words[2] == str(host[1]):
+        return iter([(("trap", str(host[0])), line)])
+    if (words[1], words[2]) in inline_calls:
+        return expand(inline_calls[words[1], words[2]], line)
+    if words[1].startswith("built_in."):
+        return iter(())
+    return None
+
+
+# `call <name> <argc>` that preprocess replaces with the operation itself
+inline_calls = {
+    ("built_in.neg", "1"): template("pop $D\ninpv 0\nsubr $V $D $D\npush $D"),  # -
+    ("built_in.invert", "1"): template("pop $D\ninpv 0\ncomp $V == $D\npush $C"),  # !
+    ("built_in.add", "2"): template("pop $T\npop $D\naddr $D $T $D\npush $D"),  # +
+    ("built_in.sub", "2"): template("pop $T\npop $D\nsubr $D $T $D\npush $D"),  # -
+    ("built_in.mul", "2"): template("pop $T\npop $D\nmulr $D $T $D\npush $D"),  # *
+    ("built_in.div", "2"): template("pop $T\npop $D\ndivr $D $T $D\npush $D"),  # /
+    # %: a - a / b * b, leaving $T to hold a
+    ("built_in.mod", "2"): template("pop $D\nsubv $P 1 $P\nload @P $T\ndivr $T $D $C\nmulr $C $D $C\nsubr $T $C $D\npush $D"),
+    ("built_in.or", "2"): template("pop $T\npop $D\nor_r $D $T $D\npush $D"),  # |
+    ("built_in.and", "2"): template("pop $T\npop $D\nandr $D $T $D\npush $D"),  # &
+    ("built_in.lm", "2"): template("pop $T\npop $D\nlmvr $D $T $D\npush $D"),  # <<
+    ("built_in.rm", "2"): template("pop $T\npop $D\nrmvr $D $T $D\npush $D"),  # >>
+    ("built_in.eq", "2"): template("pop $T\npop $D\ncomp $D == $T\npush $C"),  # ==
+    ("built_in.neq", "2"): template("pop $T\npop $D\ncomp $D != $T\npush $C"),  # !=
+    ("built_in.geq", "2"): template("pop $T\npop $D\ncomp $D >= $T\npush $C"),  # >=
+    ("built_in.leq", "2"): template("pop $T\npop $D\ncomp $D <= $T\npush $C"),  # <=
+    ("built_in.gt", "2"): template("pop $T\npop $D\ncomp $D > $T\npush $C"),  # >
+    ("built_in.lt", "2"): template("pop $T\npop $D\ncomp $D < $T\npush $C"),  # <
+    ("built_in.bool", "1"): template("pop $D\ninpv 0\ncomp $D == $V\ncomp $C == $V\npush $C"),  # bool
+    # print(x): the number and a newline to the console, returns 0
+    ("print", "1"): template(
+        f"pop $D\nsetv $A {CONSOLE_BASE + CONSOLE_INT}\ncopy $D $M\nsetv $D 10\nsetv $A {CONSOLE_BASE + CONSOLE_CHAR}\ncopy $D $M\npush 0"
+    ),
+    # input(pass): the next integer from the console
+    ("input", "0"): template(f"setv $A {CONSOLE_BASE + CONSOLE_INT}\ncopy $M $D\npush $D"),
+}
+
+
+def preprocess(source: Iterable[Instruction]) -> Iterator[Instruction]:
+    for i, line in source:
+        expansion = expand_host(i, line) if i[0] == "call" and len(i) == 3 else None
+        if expansion is None:
+            yield i, line
         else:
-            code.append(i)
-    return split_newlines(code)
+            yield from expansion
 
 
-def main(path: str, flags: List[bool]) -> None:
-    code: List[str] = []
+class Assembler:
+    """
+    One assembly of a .vm program into its .asm image, with no file I/O.
+
+    The stages (preprocess, assembler0, [peephole,] assembler1, assembler2) are generators passing instructions
+    (see parse) to each other, so each line is split once and no stage keeps a whole program: only the image
+    and the labels are held until the end. Each Assembler keeps its own symbol table, so any number of them
+    can run in one process at once. The line of a CompileError is the line of the .vm source it comes from.
+    """
+
+    def __init__(self, file: str = "<vm>", level: int = 0) -> None:
+        self.file = file
+        # 1 runs peephole between assembler0 and assembler1
+        self.level = level
+        # instructions removed by peephole, and how often each rule fired
+        self.removed = 0
+        self.rules: Dict[str, int] = {}
+        self.symbols: Dict[str, int] = {}
+        self.image = b""
+
+    def assemble(self, source: Union[str, Iterable[str]], o0: Optional[TextIO] = None, o1: Optional[TextIO] = None) -> bytes:
+        """
+        Assemble the .vm code in `source`, a string or its lines, returning the .asm image.
+        The o0 and o1 code is written to `o0` and `o1` as it goes by, if they are given.
+        """
+        code = assembler0(preprocess(parse(source.splitlines() if isinstance(source, str) else source)), self.file)
+        if self.level >= 1:
+            self.removed, self.rules = 0, {}
+            code = self.tally(peephole(self.tally(code, 1), counts=self.rules), -1)
+        if o0 is not None:
+            code = dump(code, o0)
+        code = assembler1(code, self.file)
+        if o1 is not None:
+            code = dump(code, o1)
+        self.symbols = {}
+        self.image = assembler2(code, self.file, self.symbols)
+        return self.image
+
+    def tally(self, source: Iterable[Instruction], step: int) -> Iterator[Instruction]:
+        for i in source:
+            self.removed += step
+            yield i
+
+    def o2(self) -> List[str]:
+        """The image decoded back into instructions."""
+        return asmtovm("".join(f"{i:08b}" for i in self.image), self.file)
+
+
+def assemble(source: Union[str, Iterable[str]], file: str = "<vm>", level: int = 0) -> bytes:
+    """Shorthand for Assembler(file, level).assemble(source)."""
+    return Assembler(file, level).assemble(source)
+
+
+def main(path: str, flags: List[bool], level: int = 0) -> None:
     if isfile(path):
         path = abspath(path)
     else:
         print(f"path error: {path}")
         return
-    with open(path, "r", encoding="utf-8") as f:
-        code = f.readlines()
     file_name = ".".join(path.split(".")[:-1])
-    code = preprocess(code)
-    try:
-        code = assembler0(code, path)
-    except CompileError as e:
-        print("in assembler0:")
-        print(e.show(code[e.line])[0])
-        return
-    if flags[0]:
-        with open(file_name + "_o0.vm", "w", encoding="utf-8") as f:
-            f.write("\n".join(code))
-    try:
-        code = assembler1(code, abspath(file_name + "_o0.vm"))
-    except CompileError as e:
-        print("in assembler1:")
-        print(e.show(code[e.line])[0])
-        return
-    if flags[1]:
-        with open(file_name + "_o1.vm", "w", encoding="utf-8") as f:
-            f.write("\n".join(code))
+    assembler = Assembler(path, level)
+    o0 = open(file_name + "_o0.vm", "w", encoding="utf-8") if flags[0] else None
+    o1 = open(file_name + "_o1.vm", "w", encoding="utf-8") if flags[1] else None
     try:
-        asm = assembler2(code, abspath(file_name + "_o1.vm"))
+        with open(path, "r", encoding="utf-8") as f:
+            assembler.assemble(f, o0, o1)
     except CompileError as e:
-        print("in assembler2:")
-        print(e.show(code[e.line])[0])
+        print(e.show(getline(path, e.line + 1))[0])
         return
+    finally:
+        for i in (o0, o1):
+            if i is not None:
+                i.close()
+    if level >= 1:
+        rules = ", ".join(f"{k} {v}" for k, v in assembler.rules.items())
+        print(f"peephole removed {assembler.removed} instructions ({rules or 'no rule fired'})")
     if flags[2]:
         with open(file_name + "_o2.vm", "w", encoding="utf-8") as f:
-            f.write("\n".join(asmtovm(asm, file_name + ".asm")))
+            f.write("\n".join(assembler.o2()))
     with open(file_name + ".asm", "wb") as f:
-        f.write(bytes(int(asm[i : i + 8], 2) for i in range(0, len(asm), 8)))
+        f.write(assembler.image)
+    with open(file_name + ".sym", "w", encoding="utf-8") as f:
+        json.dump(assembler.symbols, f, indent=0)
 
 
-def parser_args(args: List[str]) -> Tuple[str, List[bool]]:
+def parser_args(args: List[str]) -> Tuple[str, List[bool], int]:
     path = ""
     if len(args) >= 1:
         for i in args:
@@ -424,12 +734,13 @@ def parser_args(args: List[str]) -> Tuple[str, List[bool]]:
         flags[1] = True
     if "-o2" in args:
         flags[2] = True
-    return path, flags
+    level = 1 if "-O1" in args else 0
+    return path, flags, level
 
 
 if __name__ == "__main__":
     if len(argv) <= 1:
-        path, flags = parser_args(input("path and flags (only one path):").split())
+        path, flags, level = parser_args(input("path and flags (only one path):").split())
     else:
-        path, flags = parser_args(argv[1:])
-    main(path, flags)
+        path, flags, level = parser_args(argv[1:])
+    main(path, flags, level)
@@ -0,0 +1,158 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from os.path import abspath, isfile
+from sys import argv
+from typing import Dict, List, Optional, Union
+
+import assembler
+import emulator
+
+# filled in each worker process by load_programs, so every image is decoded once per worker
+programs: Dict[str, emulator.Program] = {}
+binaries: Dict[str, bytes] = {}
+
+Result = Dict[str, Union[str, int, bool, List[int], Dict[str, int], None]]
+
+
+class Args:
+    def __init__(
+        self,
+        paths: Optional[List[str]] = None,
+        images: Optional[List[str]] = None,
+        core: str = "block",
+        max_steps: int = 1000000,
+        workers: Optional[int] = None,
+        report: str = "",
+    ) -> None:
+        self.paths = paths if paths is not None else []
+        self.images = images if images is not None else []
+        self.core = core
+        self.max_steps = max_steps
+        self.workers = workers
+        self.report = report
+
+
+def parser_args(args: List[str]) -> Args:
+    result = Args()
+    options = iter(args)
+    for i in options:
+        if i == "--core":
+            result.core = next(options, "")
+        elif i == "--max-steps":
+            result.max_steps = int(next(options, "0"))
+        elif i == "--workers":
+            result.workers = int(next(options, "0"))
+        elif i == "--image":
+            result.images.append(abspath(next(options, "")))
+        elif i == "--report":
+            result.report = abspath(next(options, ""))
+        elif isfile(i) and (i.endswith(".asm") or i.endswith(".vm")):
+            result.paths.append(abspath(i))
+        else:
+            raise Exception(f"Unknown argument '{i}'")
+    if not result.paths:
+        raise Exception("Need to pass in at least one .asm or .vm file")
+    if result.images and len(result.paths) != 1:
+        raise Exception("--image can only be used with a single program")
+    if result.core not in emulator.cores:
+        raise Exception(f"Unknown core '{result.core}', expected one of: {', '.join(emulator.cores)}")
+    return result
+
+
+def assemble(path: str) -> bytes:
+    """The image of a .asm file, or of a .vm file assembled in memory (a CompileError fails only this program)."""
+    if path.endswith(".vm"):
+        with open(path, "r", encoding="utf-8") as f:
+            return assembler.Assembler(path).assemble(f)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def load_programs(data: Dict[str, bytes]) -> None:
+    """Worker initializer: keep the raw images, decoding each one on first use."""
+    binaries.update(data)
+
+
+def load_image(vm: emulator.VM, path: str) -> None:
+    """Set up the initial state from a snapshot (see VM.snapshot) or a JSON object of address: value."""
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            for address, value in json.load(f).items():
+                vm.memory[int(address)] = value
+    else:
+        vm.restore(path)
+
+
+def run_one(path: str, image: str, core: str, max_steps: int) -> Result:
+    """Run one program in a worker and return its final state, with what it wrote to the console."""
+    result: Result = {"program": path, "image": image or None}
+    try:
+        program = programs.get(path)
+        if program is None:
+            program = programs[path] = emulator.Program(binaries[path])
+        vm = emulator.VM()
+        if image:
+            load_image(vm, image)
+        # the console reads no input and its output goes into the result
+        output = StringIO()
+        vm.memory.map(assembler.CONSOLE_BASE, emulator.Console(output, StringIO()))
+        state = emulator.Machine(program, core, vm).run(max_steps)
+        result["reason"] = state.reason
+        result["steps"] = state.steps
+        result["pointer"] = state.pointer
+        result["registers"] = state.registers
+        result["rT"] = state.rT
+        result["memory"] = {str(address): value for address, value in vm.memory.items()}
+        result["output"] = output.getvalue()
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def run_batch(args: Args) -> List[Result]:
+    """Assemble every distinct program once, then run all of them (or one program over every image) in a process pool."""
+    data: Dict[str, bytes] = {}
+    errors: Dict[str, str] = {}
+    for path in args.paths:
+        if path not in data and path not in errors:
+            try:
+                data[path] = assemble(path)
+            except Exception as e:
+                errors[path] = f"{type(e).__name__}: {e}"
+    if args.images:
+        tasks = [(args.paths[0], image) for image in args.images]
+    else:
+        tasks = [(path, "") for path in args.paths]
+    with ProcessPoolExecutor(args.workers, initializer=load_programs, initargs=(data,)) as pool:
+        futures = [None if path in errors else pool.submit(run_one, path, image, args.core, args.max_steps) for path, image in tasks]
+        return [
+            {"program": path, "image": image or None, "error": errors[path]} if future is None else future.result()
+            for (path, image), future in zip(tasks, futures)
+        ]
+
+
+def report(results: List[Result]) -> str:
+    lines = []
+    for result in results:
+        name = str(result["image"] or result["program"])
+        if "error" in result:
+            lines.append(f"{name}: {result['error']}")
+        else:
+            lines.append(f"{name}: {result['reason']} after {result['steps']} steps, registers {result['registers']}")
+    failed = sum("error" in i for i in results)
+    unfinished = sum(i.get("reason") == "steps" for i in results)
+    lines.append(f"{len(results)} runs, {failed} failed, {unfinished} out of steps")
+    return "\n".join(lines)
+
+
+def main(args: Args) -> None:
+    results = run_batch(args)
+    print(report(results))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main(parser_args(argv[1:]))
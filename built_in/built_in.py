@@ -1,5 +1,5 @@
-from typing import Literal, Tuple
-from compiler.lib import type_void, type_str, type_class
+from typing import Any, Callable, Literal, Tuple
+from compiler.lib import type_void, type_str, type_class, type_int
 from compiler.AST import Identifier, Type
 
 built_in_function: dict[str, Tuple[Type, Literal["class", "constructor", "function", "method"]]] = {
@@ -9,8 +9,177 @@ built_in_function: dict[str, Tuple[Type, Literal["class", "constructor", "functi
     "input": (type_str, "function"),
     "str.format": (type_str, "method"),
     "arr.new": (Type(Identifier("arr")), "constructor"),
+    "arr.copy": (type_void, "function"),
+    "arr.fill": (type_void, "function"),
 }
 
+# subroutines run by the host instead of as NewJack code: name -> (trap number, argument count, implementation)
+# `call <name> n` becomes the `trap <number>` instruction, which pops the arguments from the VM stack,
+# calls implementation(vm, *args) and pushes the result, see emulator.VM.trap
+host_function: dict[str, Tuple[int, int, Callable[..., int]]] = {}
+# the same by trap number: number -> (argument count, implementation)
+host_trap: dict[int, Tuple[int, Callable[..., int]]] = {}
+
+
+def host(name: str, number: int, argc: int) -> Callable[[Callable[..., int]], Callable[..., int]]:
+    """Declare `name` as a host function with trap `number`, implemented by the decorated function."""
+
+    def decorator(function: Callable[..., int]) -> Callable[..., int]:
+        if number in host_trap:
+            raise Exception(f"Host function number {number} is already used")
+        host_function[name] = (number, argc, function)
+        host_trap[number] = (argc, function)
+        built_in_function.setdefault(name, (type_int, "function"))
+        return function
+
+    return decorator
+
+
+@host("math.mod", 0, 2)
+def math_mod(vm: Any, a: int, b: int) -> int:
+    # the same as a % b, see emulator.modulo
+    return a % b if b != 0 else a
+
+
+@host("math.gcd", 1, 2)
+def math_gcd(vm: Any, a: int, b: int) -> int:
+    while b != 0:
+        a, b = b, math_mod(vm, a, b)
+    return a
+
+
+@host("math.pow", 2, 2)
+def math_pow(vm: Any, a: int, b: int) -> int:
+    # the product wraps around like mulr, so only the low 32 bits matter
+    return pow(a, b, 4294967296) if b >= 0 else 1
+
+
+# The heap used by built_in.alloc and system.alloc, kept entirely in VM memory so it survives snapshots:
+# HEAP_BASE holds the top of the heap (0 before the first allocation), HEAP_BASE + 1 + c the free list of class c
+# and HEAP_LIMIT the top at which alloc runs the next collection (0 for HEAP_GC_SPACE above the start).
+# A block of class c has room for 2 ** c words and is preceded by a header word, c while in use and ~c once freed.
+# A free block keeps the next block of its list in its first word.
+HEAP_BASE = 1 << 24
+HEAP_END = 1 << 30
+HEAP_CLASSES = 31
+HEAP_LIMIT = HEAP_BASE + HEAP_CLASSES + 1
+HEAP_HEADER = HEAP_CLASSES + 2
+# words the heap may grow by between two collections
+HEAP_GC_SPACE = 1 << 18
+
+
+@host("built_in.alloc", 3, 1)
+def alloc(vm: Any, size: int) -> int:
+    """A block of at least `size` zeroed words, or -1 if there is no room left."""
+    if size < 0:
+        return -1
+    memory = vm.memory
+    c = max(size - 1, 0).bit_length()
+    address = memory.read(HEAP_BASE + 1 + c)
+    if address != 0:
+        memory.write(HEAP_BASE + 1 + c, memory.read(address))
+        memory.fill(address, 0, max(size, 1))
+    else:
+        address = (memory.read(HEAP_BASE) or HEAP_BASE + HEAP_HEADER) + 1
+        if address + (1 << c) > (memory.read(HEAP_LIMIT) or HEAP_BASE + HEAP_HEADER + HEAP_GC_SPACE) and vm.collect:
+            collect(vm)
+            # room for this block too, so that the retry does not collect again
+            memory.write(HEAP_LIMIT, address + (1 << c) + HEAP_GC_SPACE)
+            return alloc(vm, size)
+        if address + (1 << c) > HEAP_END:
+            return -1
+        memory.write(HEAP_BASE, address + (1 << c))
+    memory.write(address - 1, c)
+    return address
+
+
+@host("built_in.free", 4, 1)
+def free(vm: Any, address: int) -> int:
+    """Put a block from alloc back on the free list of its class."""
+    memory = vm.memory
+    if not HEAP_BASE + HEAP_HEADER < address < memory.read(HEAP_BASE):
+        raise Exception(f"Invalid free of address {address}")
+    c = memory.read(address - 1)
+    if c < 0:
+        raise Exception(f"Double free of address {address}")
+    if c >= HEAP_CLASSES:
+        raise Exception(f"Invalid free of address {address}")
+    memory.write(address - 1, ~c)
+    memory.write(address, memory.read(HEAP_BASE + 1 + c))
+    memory.write(HEAP_BASE + 1 + c, address)
+    return 0
+
+
+@host("system.gc", 9, 0)
+def collect(vm: Any) -> int:
+    """
+    Mark-sweep collection of the heap, returning the number of blocks freed.
+
+    Frames and operand stacks hold untyped words, so the collector is conservative: every word
+    equal to the address of a block in use counts as a reference to it. The roots are the registers,
+    rT, all memory outside the heap, and the words given by the functions in vm.roots
+    (the interpreter keeps its operand stack there). Nothing is collected while vm.collect is false.
+    """
+    if not vm.collect:
+        return 0
+    memory = vm.memory
+    top = memory.read(HEAP_BASE)
+    blocks: dict[int, int] = {}
+    address = HEAP_BASE + HEAP_HEADER + 1
+    while address < top:
+        c = memory.read(address - 1)
+        if c >= 0:
+            blocks[address] = c
+        address += (1 << (c if c >= 0 else ~c)) + 1
+    words = list(vm.registers) + list(vm.rT)
+    words.extend(v for a, v in memory.items() if not HEAP_BASE <= a < top)
+    for root in vm.roots:
+        words.extend(root())
+    marked: set[int] = set()
+    work = [i for i in words if i in blocks]
+    while work:
+        address = work.pop()
+        if address not in marked:
+            marked.add(address)
+            work.extend(i for i in memory.load(address, 1 << blocks[address]) if i in blocks and i not in marked)
+    for address in blocks:
+        if address not in marked:
+            free(vm, address)
+    return len(blocks) - len(marked)
+
+
+host("system.alloc", 5, 1)(alloc)
+host("system.free", 6, 1)(free)
+
+
+@host("arr.copy", 7, 3)
+def copy(vm: Any, target: int, source: int, count: int) -> int:
+    """arr.copy(target, source, count): like memmove, in one step whatever the count."""
+    vm.memory.copy(target, source, count)
+    return 0
+
+
+@host("arr.fill", 8, 3)
+def fill(vm: Any, target: int, value: int, count: int) -> int:
+    """arr.fill(target, value, count): like memset, but with a word value."""
+    vm.memory.fill(target, value, count)
+    return 0
+
+
+@host("system.spawn", 10, 2)
+def spawn(vm: Any, entry: int, argument: int) -> int:
+    """Start a green thread at code address `entry` (see emulator.Scheduler), returning its number or -1."""
+    if vm.scheduler is None:
+        raise Exception("system.spawn needs a scheduler")
+    return vm.scheduler.spawn(entry, argument)
+
+
+@host("system.yield", 11, 0)
+def yield_(vm: Any) -> int:
+    """Let the next green thread run, nothing without a scheduler."""
+    vm.yielding = vm.scheduler is not None
+    return 0
+
 built_in_class = ("list", "str", "int", "float", "bool", "char", "arr")
 
 built_in_njcode = {
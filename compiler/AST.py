@@ -120,7 +120,7 @@ class Char:
 class Op:
     def __init__(
         self,
-        content: Literal["+", "-", "*", "/", "|", "&", "<<", ">>", "==", "!=", ">=", "<=", ">", "<"],
+        content: Literal["+", "-", "*", "/", "%", "|", "&", "<<", ">>", "==", "!=", ">=", "<=", ">", "<"],
         location: Tuple[int, int] = (-1, -1),
     ) -> None:
         self.location = location
@@ -1,9 +1,10 @@
 from traceback import format_stack
-from typing import Literal, List, Tuple, Union
+from typing import Literal, List, Optional, Tuple, Union
 
 from compiler.AST import *
+from compiler.escape import EscapeAnalysis
 from compiler.lib import CompileError, CompileErrorGroup, Info, type_int, type_void, format_traceback, none
-from built_in.built_in import built_in_function, built_in_class
+from built_in.built_in import built_in_function, built_in_class, host_function
 
 
 class Compiler:
@@ -25,8 +26,12 @@ class Compiler:
             "local": 0,
             "loop": 0,
             "if": 0,
+            "new": 0,
         }
         self.now_subroutine: Subroutine = Subroutine(none, "method", Type(none), [], [])
+        # subroutine -> {local: class} built in the stack frame (see EscapeAnalysis)
+        self.frame: dict[str, dict[str, str]] = {}
+        self.now_frame: dict[str, str] = {}
         self.loop: List[int] = []
         self.loop_n: List[int] = []
         self.debug_flag = debug_flag
@@ -69,6 +74,9 @@ class Compiler:
         else:
             self.code.extend(code)
 
+    def analyze(self, class_list: List[Class]) -> None:
+        self.frame = EscapeAnalysis(class_list).frame
+
     def showCompilerInfo(self) -> None:
         for k, v in self.__dict__.items():
             if k == "errout" or k == "code" or k == "err_list":
@@ -131,12 +139,31 @@ class Compiler:
             self.argument[str(subroutine.name)]["self"] = (Type(self.now_class.name), 0)
             self.count["argument"] += 1
         if subroutine.kind == "constructor":
+            # self is 0 unless the caller already reserved room for the object in its frame
+            n = self.count["new"]
+            self.count["new"] += 1
+            code.append("push @L 0")
+            code.append(f"goto new_{n} true")
             code.append(f"push {len(self.attribute[str(self.now_class.name)])}")
             code.append(f"call built_in.alloc 1")
             code.append("pop @L 0")
+            code.append(f"label new_{n}")
         self.declare(subroutine.argument_list)
-        for i in subroutine.statement_list:
-            code.extend(self.compileStatement(i))
+        name = code[0].split()[1]
+        self.now_frame = self.frame.get(name, {})
+        if name in host_function and subroutine.kind == "function":
+            # run by the host, the body is only kept for reference (see host_function)
+            for i in range(len(subroutine.argument_list)):
+                code.append(f"push @L {i}")
+            code.append(f"call {name} {len(subroutine.argument_list)}")
+            code.append("return")
+        else:
+            for i in subroutine.statement_list:
+                code.extend(self.compileStatement(i))
+            if not subroutine.statement_list or not isinstance(subroutine.statement_list[-1], Return_S):
+                # falling off the end returns 0 instead of running into the next subroutine
+                code.append("push 0")
+                code.append("return")
         del self.argument[str(subroutine.name)]
         del self.local[str(subroutine.name)]
         self.loop_n.pop()
@@ -168,7 +195,14 @@ class Compiler:
         if len(var.var_list) < len(var.expression_list):
             self.error("'value' redundant 'variable'", var.location)
         for i, j in zip(var.var_list, var.expression_list):
-            code.extend(self.compileExpression(j))
+            if i.kind == "local" and str(i.name) in self.now_frame:
+                # the object never escapes, so it lives in hidden locals right before the variable
+                storage = self.count["argument"] + self.count["local"]
+                size = len(self.attribute[self.now_frame[str(i.name)]])
+                self.count["local"] += size
+                code.extend(self.compileCall(j.content[0].content, storage))  # type: ignore
+            else:
+                code.extend(self.compileExpression(j))
             if i.kind == "global":
                 code.append("inpv 0")
                 code.append(f"pop @V {self.global_[str(i.name)][1]}")
@@ -333,7 +367,13 @@ class Compiler:
         elif isinstance(term.content, Call):
             code.extend(self.compileCall(term.content))
         elif isinstance(term.content, Variable):
-            code.extend(self.GetVarInfo(term.content).code)
+            var_info = self.GetVarInfo(term.content)
+            if var_info.kind == "function":
+                # a function used as a value is its code address, as system.spawn takes it
+                code.append(f"getl $D {var_info.name}")
+                code.append("push $D")
+            else:
+                code.extend(var_info.code)
         elif isinstance(term.content, Expression):
             code.extend(self.compileExpression(term.content))
         elif isinstance(term.content, Term):
@@ -366,6 +406,8 @@ class Compiler:
             return ["call built_in.mul 2"]
         elif op == "/":
             return ["call built_in.div 2"]
+        elif op == "%":
+            return ["call built_in.mod 2"]
         elif op == "|":
             return ["call built_in.or 2"]
         elif op == "&":
@@ -390,7 +432,7 @@ class Compiler:
             self.error(f"unknown op {op}", op.location)
             return []
 
-    def compileCall(self, call: Call) -> List[str]:
+    def compileCall(self, call: Call, storage: Optional[int] = None) -> List[str]:
         code: List[str] = []
         var_info = self.GetVarInfo(call.var)
         if var_info.name == "arr.new":
@@ -400,6 +442,12 @@ class Compiler:
         else:
             if var_info.kind == "method":
                 code.append("\n".join(var_info.code))
+            elif var_info.kind == "constructor" and storage is not None:
+                size = len(self.attribute[var_info.name.rsplit(".", 1)[0]])
+                for k in range(size):
+                    code.append("push 0")
+                    code.append(f"pop @L {storage + k}")
+                code.append(f"push $L {storage}")
             elif var_info.kind == "constructor":
                 code.append("push 0")
             elif var_info.kind != "function":
@@ -436,6 +484,9 @@ class Compiler:
                 t = f"V {self.global_[str(var.var)][1]}"
             elif str(var.var) in self.subroutine:
                 var_info.type = Type(Identifier(self.subroutine[str(var.var)][1]))
+                if var.attr is None and self.subroutine[str(var.var)][1] != "class":
+                    # a built-in function called by its bare name, like print
+                    var_info.type, var_info.kind = self.subroutine[str(var.var)]
             else:
                 self.error(f"variable {var} not found", var.location)
         else:
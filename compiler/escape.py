@@ -0,0 +1,219 @@
+"""
+Escape analysis for the NewJack compiler.
+
+Finds locals declared as `var T x = T.new(...)` whose object never leaves the subroutine,
+so the compiler can build them in the caller's stack frame instead of calling built_in.alloc.
+An object escapes when it is returned, stored (in a variable, attribute or array), used in an
+operation, or passed to a parameter that escapes. Parameter summaries are solved to a fixed point
+over every class, so calls between user subroutines (including recursion) are followed.
+"""
+
+from typing import Dict, List, Optional, Set
+
+from compiler.AST import *
+
+
+def bare_name(expression: Expression) -> Optional[str]:
+    """The variable name if the expression is just a variable (or self), otherwise None."""
+    if len(expression.content) != 1 or not isinstance(expression.content[0], Term):
+        return None
+    term = expression.content[0]
+    while term.neg is None and isinstance(term.content, (Term, Expression)):
+        if isinstance(term.content, Term):
+            term = term.content
+        elif len(term.content.content) == 1 and isinstance(term.content.content[0], Term):
+            term = term.content.content[0]
+        else:
+            return None
+    if term.neg is not None:
+        return None
+    if isinstance(term.content, str) and term.content == "self":
+        return "self"
+    if isinstance(term.content, Variable) and term.content.attr is None and term.content.index is None:
+        if isinstance(term.content.var, Identifier):
+            return str(term.content.var)
+    return None
+
+
+class Scope:
+    """Names seen while scanning one subroutine."""
+
+    def __init__(self, subroutine: Subroutine, class_name: str) -> None:
+        self.subroutine = subroutine
+        self.class_name = class_name
+        self.params: List[str] = []
+        self.types: Dict[str, str] = {}
+        if subroutine.kind != "function":
+            self.params.append("self")
+            self.types["self"] = class_name
+        for i in subroutine.argument_list:
+            self.params.append(str(i.name))
+            self.types[str(i.name)] = str(i.type.outside)
+        self.declared: Dict[str, int] = {}
+        self.candidates: Dict[str, str] = {}
+        self.escaped: Set[str] = set()
+
+
+class EscapeAnalysis:
+    def __init__(self, class_list: List[Class]) -> None:
+        self.classes: Set[str] = {str(c.name) for c in class_list}
+        self.subroutines: Dict[str, Subroutine] = {}
+        self.owner: Dict[str, str] = {}
+        for c in class_list:
+            for s in c.subroutine_list:
+                name = str(s.name)
+                if not name.startswith(str(c.name) + "."):
+                    name = f"{c.name}.{name}"
+                self.subroutines[name] = s
+                self.owner[name] = str(c.name)
+        # escapes[name][k] is True when parameter k (self first) can outlive the call
+        self.escapes: Dict[str, List[bool]] = {}
+        for name, s in self.subroutines.items():
+            self.escapes[name] = [False] * (len(s.argument_list) + (s.kind != "function"))
+        # frame[name] holds the locals of that subroutine to build in its stack frame
+        self.frame: Dict[str, Dict[str, str]] = {}
+        changed = True
+        while changed:
+            changed = False
+            for name in self.subroutines:
+                scope = self.scan(name)
+                summary = [i in scope.escaped for i in scope.params]
+                if summary != self.escapes[name]:
+                    self.escapes[name] = summary
+                    changed = True
+        for name in self.subroutines:
+            scope = self.scan(name)
+            self.frame[name] = {
+                k: v
+                for k, v in scope.candidates.items()
+                if k not in scope.escaped and scope.declared[k] == 1 and not self.escapes[f"{v}.new"][0]
+            }
+
+    def scan(self, name: str) -> Scope:
+        scope = Scope(self.subroutines[name], self.owner[name])
+        for i in scope.subroutine.statement_list:
+            self.statement(i, scope)
+        return scope
+
+    def statement(self, statement: Statement, scope: Scope) -> None:
+        if isinstance(statement, Var_S):
+            for i in statement.var_list:
+                if i.kind == "local":
+                    scope.declared[str(i.name)] = scope.declared.get(str(i.name), 0) + 1
+                    scope.types[str(i.name)] = str(i.type.outside)
+            for i, j in zip(statement.var_list, statement.expression_list):
+                call = self.construction(j, str(i.type.outside))
+                if i.kind == "local" and call is not None:
+                    scope.candidates[str(i.name)] = str(i.type.outside)
+                    self.call(call, scope)
+                else:
+                    self.value(j, scope)
+        elif isinstance(statement, Do_S):
+            self.call(statement.call, scope)
+        elif isinstance(statement, Let_S):
+            if statement.var.attr is None and statement.var.index is None and isinstance(statement.var.var, Identifier):
+                # reassigning a name: whatever it held before is no longer tracked
+                scope.escaped.add(str(statement.var.var))
+            else:
+                self.variable(statement.var, scope)
+            self.value(statement.expression, scope)
+        elif isinstance(statement, Return_S):
+            if statement.expression is not None:
+                if scope.subroutine.kind == "constructor" and bare_name(statement.expression) == "self":
+                    return
+                self.value(statement.expression, scope)
+        elif isinstance(statement, If_S):
+            self.value(statement.if_conditional, scope)
+            for i in statement.elif_conditional_list:
+                self.value(i, scope)
+            for s in statement.if_statement_list + statement.else_statement_list:
+                self.statement(s, scope)
+            for l in statement.elif_statement_list:
+                for s in l:
+                    self.statement(s, scope)
+        elif isinstance(statement, While_S):
+            self.value(statement.conditional, scope)
+            for s in statement.statement_list + statement.else_statement_list:
+                self.statement(s, scope)
+        elif isinstance(statement, For_S):
+            for i in statement.for_range:
+                self.value(i, scope)
+            for s in statement.statement_list + statement.else_statement_list:
+                self.statement(s, scope)
+
+    def construction(self, expression: Expression, type_: str) -> Optional[Call]:
+        """The call if the expression is exactly `type_.new(...)` for a user-defined constructor."""
+        if len(expression.content) != 1 or not isinstance(expression.content[0], Term):
+            return None
+        term = expression.content[0]
+        call = term.content
+        if term.neg is not None or not isinstance(call, Call) or not isinstance(call.var.var, Identifier):
+            return None
+        if str(call.var.var) != type_ or str(call.var.attr) != "new":
+            return None
+        s = self.subroutines.get(f"{type_}.new")
+        if s is None or s.kind != "constructor":
+            return None
+        return call
+
+    def value(self, expression: Expression, scope: Scope) -> None:
+        """Scan an expression whose result goes somewhere untracked, so every bare name in it escapes."""
+        for i in expression.content:
+            if isinstance(i, Term):
+                self.term(i, scope)
+
+    def term(self, term: Term, scope: Scope) -> None:
+        content = term.content
+        if isinstance(content, Variable):
+            if content.attr is None and content.index is None and isinstance(content.var, Identifier):
+                scope.escaped.add(str(content.var))
+            else:
+                self.variable(content, scope)
+        elif isinstance(content, Call):
+            self.call(content, scope)
+        elif isinstance(content, Expression):
+            self.value(content, scope)
+        elif isinstance(content, Term):
+            self.term(content, scope)
+        elif isinstance(content, str) and content == "self":
+            scope.escaped.add("self")
+
+    def variable(self, var: Variable, scope: Scope) -> None:
+        """Reading an attribute or element only dereferences the base, it does not leak it."""
+        while isinstance(var, Variable):
+            if var.index is not None:
+                self.value(var.index, scope)
+            var = var.var  # type: ignore
+
+    def call(self, call: Call, scope: Scope) -> None:
+        target = call.var
+        callee: Optional[str] = None
+        receiver: Optional[str] = None
+        method = False
+        if target.attr is not None and isinstance(target.var, Identifier):
+            base = str(target.var)
+            if base in scope.types or base == "self":
+                callee = f"{scope.types.get(base, scope.class_name)}.{target.attr}"
+                receiver = base
+                method = True
+            elif base in self.classes:
+                callee = f"{base}.{target.attr}"
+        elif target.attr is not None:
+            self.variable(target.var, scope)  # type: ignore
+        summary = self.escapes.get(callee) if callee is not None else None
+        if summary is not None and method and self.subroutines[callee].kind != "method":  # type: ignore
+            summary = None
+        if summary is not None and not method and self.subroutines[callee].kind == "method":  # type: ignore
+            summary = None
+        offset = 0
+        if summary is not None and self.subroutines[callee].kind != "function":  # type: ignore
+            offset = 1
+        if receiver is not None and (summary is None or summary[0]):
+            scope.escaped.add(receiver)
+        for k, i in enumerate(call.expression_list):
+            name = bare_name(i)
+            if name is not None and summary is not None and k + offset < len(summary):
+                if summary[k + offset]:
+                    scope.escaped.add(name)
+            else:
+                self.value(i, scope)
@@ -113,7 +113,7 @@ def lexer(source: List[str], file: str) -> List[Token]:
             elif char == "`":
                 state = "comment"
             elif char == "-":
-                if p in ("[", "(", "=", ",", "!", "+", "-", "*", "/", "|", "&", "==", "!=", ">=", "<=", ">", "<", "<<", ">>"):
+                if p in ("[", "(", "=", ",", "!", "+", "-", "*", "/", "%", "|", "&", "==", "!=", ">=", "<=", ">", "<", "<<", ">>"):
                     state = "neg"
                     content = char
                     location = (i, j + 1)
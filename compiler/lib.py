@@ -32,7 +32,7 @@ __all__ = [
 
 
 TokenType = Literal["string", "integer", "symbol", "keyword", "float", "char", "identifier", "file_name"]
-Symbol = set("{}[]():;,.!+-*/|&>=<") | {"==", "!=", ">=", "<=", "<<", ">>"}
+Symbol = set("{}[]():;,.!+-*/%|&>=<") | {"==", "!=", ">=", "<=", "<<", ">>"}
 Number = set("0123456789")
 atoz = set("abcdefghijklmnopqrstuvwxyz")
 AtoZ = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
@@ -73,6 +73,7 @@ Precedence = {
     "~": 6,
     "*": 5,
     "/": 5,
+    "%": 5,
     "+": 4,
     "-": 4,
     "<<": 3,
@@ -250,7 +251,7 @@ def format_traceback(e: BaseException) -> str:
     return "Traceback (most recent call last):\n" + "".join(format_list(extract_tb(e.__traceback__)))
 
 
-Operator = Tokens("symbol", ("+", "-", "*", "/", "==", "!=", ">=", "<=", ">", "<", "|", "&"))
+Operator = Tokens("symbol", ("+", "-", "*", "/", "%", "==", "!=", ">=", "<=", ">", "<", "|", "&"))
 built_in_type = Tokens("keyword", ("int", "bool", "char", "str", "list", "float", "void", "arr"))
 type_class = Type(Identifier("class"))
 type_subroutine = {
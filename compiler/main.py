@@ -61,6 +61,7 @@ def compile_all_file(
                 errout.append("-" * s[1])
         failed = True
     else:
+        compiler.analyze(class_list)
         for c in class_list:
             try:
                 # Add the AST to the compiler for further processing.
@@ -189,7 +190,7 @@ def main(file: str | None = None) -> Tuple[List[str], str, bool]:
         else:
             print("compile end")
 
-        code = ["call system.init 0", "pop $T", f"call {arg.enter} 0", "pop $T"] + code
+        code = ["call system.init 0", "pop $T", f"call {arg.enter} 0", "pop $T", "halt"] + code
 
         # output the compiled file
         if arg.outpath == "":
@@ -1,18 +1,238 @@
-from sys import argv
-from typing import Dict, List
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+import sys
+from sys import argv, byteorder, maxsize
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, TextIO, Tuple, Union
 from os.path import isfile, abspath
+from time import monotonic
 
 import assembler
+from built_in.built_in import host_trap
+
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+ZERO_PAGE = array("i", bytes(PAGE_SIZE * 4))
+# magic, version, byte order of the pages (0 little, 1 big), PAGE_BITS, pointer, temp_bits, temp_value, registers, rT, page count
+SNAPSHOT_HEADER = struct.Struct("<4sHBBiIq8i8iI")
+SNAPSHOT_MAGIC = b"NJVM"
+SNAPSHOT_VERSION = 1
+# $L and $P of a new VM: the stack of the main program grows upwards from here, above the globals
+STACK_BASE = 1 << 20
+
+
+class Console:
+    """
+    Memory-mapped console, occupying the page at assembler.CONSOLE_BASE (see PagedMemory.map).
+
+    Ports, as offsets from CONSOLE_BASE:
+    - CONSOLE_CHAR: writing prints the character with that code, reading gives the next input character (-1 at the end)
+    - CONSOLE_INT: writing prints the value in decimal, reading parses the next integer of the input (0 at the end)
+    - CONSOLE_FLUSH: writing flushes the output
+    Output is collected on the host and written in bulk once `limit` characters are pending,
+    before input is read, on CONSOLE_FLUSH and when the run ends. Input is read a line at a time.
+    """
+
+    def __init__(self, output: Optional[TextIO] = None, input: Optional[TextIO] = None, limit: int = 4096) -> None:
+        self.output = output if output is not None else sys.stdout
+        self.input = input if input is not None else sys.stdin
+        self.limit = limit
+        self.buffer: List[str] = []
+        self.pending = 0
+        self.line = ""
+        self.index = 0
+
+    def __bool__(self) -> bool:
+        # compiled cores look pages up with `pages.get(n) or ...`
+        return True
+
+    def __getitem__(self, offset: int) -> int:
+        if offset == assembler.CONSOLE_CHAR:
+            return self.read_char()
+        elif offset == assembler.CONSOLE_INT:
+            return self.read_int()
+        return 0
+
+    def __setitem__(self, offset: int, value: int) -> None:
+        if offset == assembler.CONSOLE_CHAR:
+            self.write(chr(value) if 0 <= value < 0x110000 else "\ufffd")
+        elif offset == assembler.CONSOLE_INT:
+            self.write(str(value))
+        elif offset == assembler.CONSOLE_FLUSH:
+            self.flush()
+
+    def write(self, text: str) -> None:
+        self.buffer.append(text)
+        self.pending += len(text)
+        if self.pending >= self.limit:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.output.write("".join(self.buffer))
+            self.buffer.clear()
+            self.pending = 0
+        self.output.flush()
+
+    def peek(self) -> str:
+        """The next input character without consuming it, "" at the end of the input."""
+        if self.index >= len(self.line):
+            self.flush()
+            self.line = self.input.readline()
+            self.index = 0
+        return self.line[self.index : self.index + 1]
+
+    def read_char(self) -> int:
+        char = self.peek()
+        if char == "":
+            return -1
+        self.index += 1
+        return ord(char)
+
+    def read_int(self) -> int:
+        while self.peek().isspace():
+            self.index += 1
+        digits = ""
+        if self.peek() in ("-", "+"):
+            digits = self.peek()
+            self.index += 1
+        while self.peek().isdigit():
+            digits += self.peek()
+            self.index += 1
+        return (int(digits) + 2147483648 & 4294967295) - 2147483648 if digits.strip("+-") else 0
+
+
+# A page is an array('i'), a memoryview cast to 'i' over a mapped snapshot (see VM.restore), or a device such as Console.
+Page = Union["array[int]", memoryview, Console]
+
+
+class PagedMemory:
+    """
+    Word-addressed VM memory.
+
+    Addresses are 32-bit register values, so a program touches both the stack near 0 and the heap
+    near 2^31 (see built_in/system.nj). The address space is split into pages of PAGE_SIZE words,
+    each an array('i') allocated on first write and found through the page table `pages`
+    (page number -> page). Reading an untouched page gives 0 without allocating it.
+    """
+
+    def __init__(self) -> None:
+        self.pages: Dict[int, Page] = {}
+        # pages handled by a device instead of plain words, see map
+        self.devices: Dict[int, Console] = {}
+        # the snapshot that restored pages are views into, kept open as long as they are in use
+        self.mapping: Optional[mmap.mmap] = None
+
+    def map(self, address: int, device: Console) -> None:
+        """Let `device` handle the page containing `address`: reads and writes there go to device[offset]."""
+        self.devices[address >> PAGE_BITS] = device
+        self.pages[address >> PAGE_BITS] = device
+
+    def flush(self) -> None:
+        """Flush the output buffered by the devices."""
+        for device in self.devices.values():
+            device.flush()
+
+    def page(self, number: int) -> Page:
+        """Return page `number`, allocating it if needed."""
+        page = self.pages.get(number)
+        if page is None:
+            page = self.pages[number] = array("i", bytes(PAGE_SIZE * 4))
+        return page
+
+    def read(self, address: int) -> int:
+        return (self.pages.get(address >> PAGE_BITS) or ZERO_PAGE)[address & PAGE_MASK]
+
+    def write(self, address: int, value: int) -> None:
+        self.page(address >> PAGE_BITS)[address & PAGE_MASK] = value
+
+    __getitem__ = read
+    __setitem__ = write
+
+    def load(self, address: int, count: int) -> "array[int]":
+        """The `count` words from `address` on, copied a page slice at a time."""
+        result = array("i")
+        while count > 0:
+            number, offset = address >> PAGE_BITS, address & PAGE_MASK
+            n = min(count, PAGE_SIZE - offset)
+            page = self.pages.get(number) or ZERO_PAGE
+            if number in self.devices:
+                result.extend(page[offset + i] for i in range(n))
+            else:
+                result.frombytes(page[offset : offset + n].tobytes())  # type: ignore
+            address += n
+            count -= n
+        return result
+
+    def store(self, address: int, words: "array[int]") -> None:
+        """Write `words` from `address` on, a page slice at a time."""
+        k = 0
+        while k < len(words):
+            number, offset = address >> PAGE_BITS, address & PAGE_MASK
+            n = min(len(words) - k, PAGE_SIZE - offset)
+            page = self.page(number)
+            if number in self.devices:
+                for i in range(n):
+                    page[offset + i] = words[k + i]
+            else:
+                page[offset : offset + n] = words[k : k + n]  # type: ignore
+            address += n
+            k += n
+
+    def copy(self, target: int, source: int, count: int) -> None:
+        """Copy `count` words from `source` to `target`, the ranges may overlap."""
+        if count > 0:
+            self.store(target, self.load(source, count))
+
+    def fill(self, target: int, value: int, count: int) -> None:
+        """Set the `count` words from `target` on to `value`."""
+        if count > 0:
+            self.store(target, array("i", [value]) * count)
+
+    def items(self) -> List[Tuple[int, int]]:
+        """All non-zero words as (address, value), in address order."""
+        result: List[Tuple[int, int]] = []
+        for number in sorted(self.pages):
+            if number in self.devices:
+                continue
+            base = number << PAGE_BITS
+            result.extend((base + i, v) for i, v in enumerate(self.pages[number]) if v != 0)
+        return result
+
+    def __repr__(self) -> str:
+        return str(dict(self.items()))
+
+
+def snapshot_table_offset() -> int:
+    """File offset of the page table in a snapshot."""
+    return (SNAPSHOT_HEADER.size + 7) // 8 * 8
+
+
+def snapshot_page_offset(count: int) -> int:
+    """File offset of the first page in a snapshot with `count` pages."""
+    end = snapshot_table_offset() + 8 * count
+    return (end + PAGE_SIZE * 4 - 1) // (PAGE_SIZE * 4) * (PAGE_SIZE * 4)
 
 
 class VM:
-    def __init__(self, size: int) -> None:
-        self.size = size
-        self.memory: Dict[int, int] = {}
+    def __init__(self) -> None:
+        self.memory = PagedMemory()
         self.registers = [0] * 8
+        self.registers[3] = self.registers[5] = STACK_BASE
         self.pointer = 0
         self.rT = [0] * 8
-        self.temp_value = ""
+        self.temp_value = 0
+        self.temp_bits = 0
+        # extra roots for the heap collector besides registers and memory (see system.gc in built_in/built_in.py)
+        self.roots: List[Callable[[], Iterable[int]]] = []
+        self.collect = True
+        # green threads, see Scheduler; system.yield sets `yielding` to end the running time slice
+        self.scheduler: Optional["Scheduler"] = None
+        self.yielding = False
 
     def setr(self, key: int, value: int) -> None:
         while value >= 2147483648:
@@ -20,7 +240,7 @@ class VM:
         while value < -2147483648:
             value += 4294967296
         if key == 4:
-            self.memory[self.registers[0]] = value
+            self.memory.write(self.registers[0], value)
         elif key == 6:
             self.rT[self.registers[6]] = value
         elif 0 <= key < 8:
@@ -30,9 +250,7 @@ class VM:
 
     def getr(self, key: int) -> int:
         if key == 4:
-            if key not in self.memory:
-                self.memory[key] = 0
-            return self.memory[key]
+            return self.memory.read(self.registers[0])
         elif key == 6:
             return self.rT[self.registers[6]]
         elif 0 <= key < 8:
@@ -40,12 +258,12 @@ class VM:
         else:
             raise Exception("Invalid register")
 
-    def inpv(self, value: str, extended: bool = False) -> None:
+    def inpv(self, value: int, extended: bool = False) -> None:
         if extended:
             self.temp_value = value
+            self.temp_bits = 12
         else:
-            self.setr(7, int(value, 2))
-        # print(value, int(value, 2), extended)
+            self.setr(7, sign_extend(value, 12))
 
     def copy(self, r0: int, r1: int) -> None:
         self.setr(r1, self.getr(r0))
@@ -98,13 +316,11 @@ class VM:
         else:
             raise Exception(f"Invalid operation code: {ocode}")
 
-    def exte(self, value: str, extended: bool) -> None:
-        value = self.temp_value + value
-        if extended:
-            self.temp_value = value
-        else:
-            self.setr(7, int(value, 2))
-        # print(value, int(value, 2), extended)
+    def exte(self, value: int, extended: bool) -> None:
+        self.temp_value = (self.temp_value << 12) | value
+        self.temp_bits += 12
+        if not extended:
+            self.setr(7, sign_extend(self.temp_value, self.temp_bits))
 
     def sett(self, value: int) -> None:
         if 0 <= value < 8:
@@ -112,75 +328,1017 @@ class VM:
         else:
             raise Exception("Invalid register code")
 
+    def trap(self, number: int, top: int) -> int:
+        """
+        Run host function `number` (see host_function in built_in/built_in.py) over the arguments
+        below the stack top `top`, leaving its result in their place. Returns the new stack top.
+        """
+        if number not in host_trap:
+            raise Exception(f"Unknown host function {number}")
+        argc, function = host_trap[number]
+        top -= argc
+        value = function(self, *[self.memory.read(i) for i in range(top, top + argc)])
+        self.memory.write(top, (value + 2147483648 & 4294967295) - 2147483648)
+        return top + 1
+
+    def snapshot(self, path: str) -> None:
+        """
+        Save the registers, $T sub-registers, pointer and memory to `path`.
+
+        Layout: SNAPSHOT_HEADER, then the page numbers as int64 (starting at an 8-byte boundary),
+        then the pages themselves as raw 'i' words, each page aligned to its own size,
+        so restore can map the file and use the pages in place.
+        """
+        numbers = sorted(i for i in self.memory.pages if i not in self.memory.devices)
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_VERSION,
+            0 if byteorder == "little" else 1,
+            PAGE_BITS,
+            self.pointer,
+            self.temp_bits,
+            self.temp_value,
+            *self.registers,
+            *self.rT,
+            len(numbers),
+        )
+        table = snapshot_table_offset()
+        start = snapshot_page_offset(len(numbers))
+        with open(path, "wb") as f:
+            f.write(header)
+            f.write(bytes(table - len(header)))
+            f.write(struct.pack(f"<{len(numbers)}q", *numbers))
+            f.write(bytes(start - table - 8 * len(numbers)))
+            for number in numbers:
+                f.write(self.memory.pages[number].tobytes())  # type: ignore
+
+    def restore(self, path: str) -> None:
+        """
+        Load a file written by snapshot into this VM.
+
+        The file is mapped copy-on-write and its pages are used in place, so nothing is parsed
+        or copied up front and writes never reach the file. The register lists and the page table
+        are updated in place, so cores already built on this VM keep working.
+        """
+        with open(path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        header = SNAPSHOT_HEADER.unpack_from(mapping)
+        magic, version, order, page_bits, pointer, temp_bits, temp_value = header[:7]
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or page_bits != PAGE_BITS:
+            raise Exception(f"Invalid snapshot: {path}")
+        count = header[-1]
+        numbers = struct.unpack_from(f"<{count}q", mapping, snapshot_table_offset())
+        start = snapshot_page_offset(count)
+        view = memoryview(mapping)
+        pages: Dict[int, Page] = {}
+        for i, number in enumerate(numbers):
+            data = view[start + i * PAGE_SIZE * 4 : start + (i + 1) * PAGE_SIZE * 4]
+            if order == (0 if byteorder == "little" else 1):
+                pages[number] = data.cast("i")
+            else:
+                page = array("i", data)
+                page.byteswap()
+                pages[number] = page
+        self.pointer, self.temp_bits, self.temp_value = pointer, temp_bits, temp_value
+        self.registers[:] = header[7:15]
+        self.rT[:] = header[15:23]
+        self.memory.pages.clear()
+        self.memory.pages.update(pages)
+        self.memory.pages.update(self.memory.devices)
+        self.memory.mapping = mapping
+
 
 class Args:
-    def __init__(self, path: str = "") -> None:
+    def __init__(self, path: str = "", core: str = "legacy", trace: str = "off", trace_size: int = 64, profile: bool = False, snapshot: str = "", restore: str = "", quantum: int = 0) -> None:
         self.path = path
+        self.core = core
+        self.trace = trace
+        self.trace_size = trace_size
+        self.profile = profile
+        self.snapshot = snapshot
+        self.restore = restore
+        # run under a Scheduler with this time slice, 0 for a plain run
+        self.quantum = quantum
 
 
 def parser_args(args: List[str]) -> Args:
-    path = ""
-    for i in args:
-        if path == "" and isfile(i) and (i.endswith(".asm") or i.endswith(".vm")):
-            path = abspath(i)
-    if path == "":
+    result = Args()
+    options = iter(args)
+    for i in options:
+        if i == "--core":
+            result.core = next(options, "")
+        elif i == "--trace":
+            result.trace = next(options, "")
+        elif i == "--trace-size":
+            result.trace_size = int(next(options, "0"))
+        elif i == "--profile":
+            result.profile = True
+        elif i == "--snapshot":
+            result.snapshot = abspath(next(options, ""))
+        elif i == "--restore":
+            result.restore = abspath(next(options, ""))
+        elif i == "--quantum":
+            result.quantum = int(next(options, "0"))
+        elif result.path == "" and isfile(i) and (i.endswith(".asm") or i.endswith(".vm")):
+            result.path = abspath(i)
+    if result.path == "":
         raise Exception("Need to pass in an .asm file")
-    return Args(path)
+    if result.core not in cores:
+        raise Exception(f"Unknown core '{result.core}', expected one of: {', '.join(cores)}")
+    if result.trace not in Trace.modes:
+        raise Exception(f"Unknown trace mode '{result.trace}', expected one of: {', '.join(Trace.modes)}")
+    if result.quantum and (result.trace != "off" or result.profile):
+        raise Exception("--quantum cannot be used with --trace or --profile")
+    return result
+
+
+def sign_extend(value: int, bits: int) -> int:
+    """Read `value` as a two's complement number of width `bits`, as written by assembler.value_words."""
+    if value >> (bits - 1) & 1:
+        return value - (1 << bits)
+    return value
+
+
+class Program:
+    """
+    An .asm image decoded once at load time.
+
+    Every field of every instruction is stored in its own array, indexed by `pointer >> 1`,
+    so the run loop only does integer indexing instead of rebuilding bit strings each step.
+    Field names follow the bit layout documented in ./vmcode.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        if len(data) % 2 != 0:
+            raise Exception("Invalid image: every instruction must be 2 bytes")
+        words = array("H", data)
+        if byteorder == "little":
+            words.byteswap()
+        self.size = len(data)
+        self.words = words
+        self.opcode = array("B", [w >> 13 for w in words])  # bits 0~2
+        self.r0 = array("B", [w >> 10 & 7 for w in words])  # bits 3~5
+        self.r1 = array("B", [w >> 7 & 7 for w in words])  # bits 6~8
+        self.r2 = array("B", [w >> 4 & 7 for w in words])  # bits 9~11
+        self.r3 = array("B", [w >> 1 & 7 for w in words])  # bits 12~14
+        self.value = array("H", [w >> 1 & 0xFFF for w in words])  # bits 3~14
+        self.extend = array("B", [w & 1 for w in words])  # bit 15
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+
+class Halt(Exception):
+    """Raised by a taken jump to its own address, the idle loop that ends a program."""
+
+    def __init__(self, pointer: int) -> None:
+        super().__init__(f"halt at {pointer}")
+        self.pointer = pointer
+
+
+class Yield(Exception):
+    """Raised after a trap that asked the scheduler for a switch (system.yield), with the pointer to resume at."""
+
+    def __init__(self, pointer: int) -> None:
+        super().__init__(f"yield at {pointer}")
+        self.pointer = pointer
+
+
+class Trace:
+    """
+    Step trace of one run, chosen once before the run starts.
+
+    off:  nothing is recorded, the cores run their untraced loops
+    ring: the last `size` steps are kept and printed by dump()
+    full: every step is printed as it executes
+    A step is one instruction, or one whole block for BlockCore, recorded after it executed.
+    """
+
+    modes = ("off", "ring", "full")
+
+    def __init__(self, mode: str = "ring", size: int = 64) -> None:
+        self.mode = mode
+        self.records: Deque[Tuple[int, int, int, Tuple[int, ...], Tuple[int, ...]]] = deque(maxlen=size)
+
+    def record(self, step: int, pointer: int, word: int, vm: VM) -> None:
+        record = (step, pointer, word, tuple(vm.registers), tuple(vm.rT))
+        if self.mode == "full":
+            print(self.format(record))
+        else:
+            self.records.append(record)
+
+    @staticmethod
+    def format(record: Tuple[int, int, int, Tuple[int, ...], Tuple[int, ...]]) -> str:
+        step, pointer, word, registers, rT = record
+        return f"{step:>9} {pointer:>7}  {assembler.asmtovm(f'{word:016b}', '')[0]:<20} {list(registers)} {list(rT)}"
+
+    def dump(self) -> None:
+        for record in self.records:
+            print(self.format(record))
+
+
+class Profile:
+    """
+    Executed-instruction counts of a run, kept per address and rolled up per opcode and per subroutine.
+
+    `counts` has one counter per instruction of `program`. Subroutines are the labels of the symbol
+    table written by assembler.main (<name>.sym) whose name contains a '.', like list.append;
+    every address is charged to the closest subroutine label at or before it.
+    """
+
+    def __init__(self, program: Program) -> None:
+        self.program = program
+        self.counts = array("Q", bytes(8 * len(program)))
+
+    def total(self) -> int:
+        return sum(self.counts)
+
+    def by_address(self) -> Dict[int, int]:
+        return {k << 1: n for k, n in enumerate(self.counts) if n != 0}
+
+    def by_opcode(self) -> Dict[str, int]:
+        result: Dict[str, int] = {}
+        for k, n in enumerate(self.counts):
+            if n != 0:
+                name = opcode_name(self.program.words[k])
+                result[name] = result.get(name, 0) + n
+        return dict(sorted(result.items(), key=lambda i: -i[1]))
+
+    def by_label(self, symbols: Dict[str, int]) -> Dict[str, int]:
+        labels = sorted((address, name) for name, address in symbols.items() if "." in name)
+        starts = [address for address, _ in labels]
+        result: Dict[str, int] = {}
+        for k, n in enumerate(self.counts):
+            if n != 0:
+                i = bisect_right(starts, k << 1) - 1
+                name = labels[i][1] if i >= 0 else "<entry>"
+                result[name] = result.get(name, 0) + n
+        return dict(sorted(result.items(), key=lambda i: -i[1]))
+
+    def report(self, symbols: Dict[str, int], top: int = 20) -> str:
+        total = self.total() or 1
+        lines = [f"{self.total()} instructions executed", "", "subroutine:"]
+        lines.extend(f"    {n:>12} {n / total:>7.2%}  {name}" for name, n in list(self.by_label(symbols).items())[:top])
+        lines.append("opcode:")
+        lines.extend(f"    {n:>12} {n / total:>7.2%}  {name}" for name, n in self.by_opcode().items())
+        lines.append("address:")
+        hottest = sorted(self.by_address().items(), key=lambda i: -i[1])[:top]
+        lines.extend(f"    {n:>12} {n / total:>7.2%}  {address}" for address, n in hottest)
+        return "\n".join(lines)
+
+    def to_json(self, symbols: Dict[str, int]) -> Dict[str, object]:
+        return {
+            "total": self.total(),
+            "subroutine": self.by_label(symbols),
+            "opcode": self.by_opcode(),
+            "address": self.by_address(),
+        }
+
+
+def opcode_name(word: int) -> str:
+    """Mnemonic of an instruction word, with the operation spelled out for [operation]r."""
+    if word >> 13 == 4:
+        return assembler.btoo[f"{word >> 10 & 7:03b}"] + "r"
+    return ("inpv", "copy", "jump", "comp", "", "exte", "sett", "trap")[word >> 13]
+
+
+def wrap(expression: str) -> str:
+    """Python source that wraps `expression` into a signed 32-bit value, like VM.setr."""
+    return f"(({expression}) + 2147483648 & 4294967295) - 2147483648"
+
+
+def register_source(key: int, local: bool = False) -> str:
+    """
+    Python source naming the raw slot of register `key` in a compiled handler.
+    With `local`, registers are the locals r0~r7 instead of items of the list `r`.
+    """
+    return f"r{key}" if local else f"r[{key}]"
 
 
-def get_command(data: bytes, pointer: int) -> str:
-    return bin(data[pointer])[2:].zfill(8) + bin(data[pointer + 1])[2:].zfill(8)
+def read_source(key: int, local: bool = False) -> str:
+    """Python source that reads register `key`, going through memory for $M and the sub-registers for $T."""
+    if key == 4:
+        address = register_source(0, local)
+        return f"(pages.get({address} >> {PAGE_BITS}) or ZERO_PAGE)[{address} & {PAGE_MASK}]"
+    elif key == 6:
+        return f"rT[{register_source(6, local)}]"
+    return register_source(key, local)
+
+
+def write_source(key: int, value: str, local: bool = False) -> str:
+    """Python source that writes `value` to register `key`, see read_source."""
+    if key == 4:
+        address = register_source(0, local)
+        return f"(pages.get({address} >> {PAGE_BITS}) or page({address} >> {PAGE_BITS}))[{address} & {PAGE_MASK}] = {value}"
+    elif key == 6:
+        return f"rT[{register_source(6, local)}] = {value}"
+    return f"{register_source(key, local)} = {value}"
+
+
+def divide(a: int, b: int) -> int:
+    try:
+        return a // b
+    except ZeroDivisionError as e:
+        print(e, e.__traceback__)
+        return 0
+
+
+def modulo(a: int, b: int) -> int:
+    """The remainder matching divide: a - divide(a, b) * b, so it takes the sign of b and a % 0 is a."""
+    return a % b if b != 0 else a
+
+
+comp_source = {1: ">", 2: "==", 3: ">=", 4: "<", 5: "!=", 6: "<="}
+operation_source = {0: "+", 1: "-", 2: "*", 4: ">>", 5: "<<", 6: "&", 7: "|"}
+
+
+def instruction_source(word: int, local: bool = False) -> List[str]:
+    """
+    Translate one non-jump instruction into Python statements.
+
+    The statements run against the names `r` (registers, or the locals r0~r7 with `local`),
+    `rT`, `pages`/`page` (see PagedMemory) and `ext` (the [value, bits] state of an inpv/exte chain), see DispatchCore.
+    """
+    op, r0, r1, r2, r3 = word >> 13, word >> 10 & 7, word >> 7 & 7, word >> 4 & 7, word >> 1 & 7
+    value, extended = word >> 1 & 0xFFF, word & 1
+    if op == 0:
+        if extended:
+            return [f"ext[0] = {value}", "ext[1] = 12"]
+        return [write_source(7, str(sign_extend(value, 12)), local)]
+    elif op == 1:
+        return [write_source(r1, read_source(r0, local), local)]
+    elif op == 3:
+        if r1 == 0:
+            return [write_source(1, "0", local)]
+        elif r1 == 7:
+            return [write_source(1, "1", local)]
+        return [write_source(1, f"1 if {read_source(r0, local)} {comp_source[r1]} {read_source(r2, local)} else 0", local)]
+    elif op == 4:
+        if r0 == 3:
+            result = wrap(f"divide({read_source(r1, local)}, {read_source(r2, local)})")
+        else:
+            result = wrap(f"{read_source(r1, local)} {operation_source[r0]} {read_source(r2, local)}")
+        return [write_source(r3, result, local)]
+    elif op == 5:
+        code = [f"ext[0] = ext[0] << 12 | {value}", "ext[1] += 12"]
+        if not extended:
+            code.append(write_source(7, wrap("sign_extend(ext[0], ext[1])"), local))
+        return code
+    elif op == 6:
+        return [f"{register_source(6, local)} = {r0}"]
+    elif op == 7:
+        return [f"{register_source(5, local)} = trap({value}, {register_source(5, local)})"]
+    raise Exception(f"Invalid command {word:016b}")
+
+
+def jump_source(word: int, next_pointer: str, local: bool = False) -> str:
+    """Python expression giving the pointer after a jump instruction."""
+    return f"{read_source(word >> 10 & 7, local)} if {read_source(word >> 7 & 7, local)} != 0 else {next_pointer}"
+
+
+def written_registers(word: int) -> List[int]:
+    """The register slots an instruction writes, leaving out $M and $T whose writes go to memory and rT."""
+    op = word >> 13
+    if op in (0, 5):
+        return [7]
+    elif op == 1 and (word >> 7 & 7) not in (4, 6):
+        return [word >> 7 & 7]
+    elif op == 3:
+        return [1]
+    elif op == 4 and (word >> 1 & 7) not in (4, 6):
+        return [word >> 1 & 7]
+    elif op == 6:
+        return [6]
+    elif op == 7:
+        return [5]
+    return []
+
+
+def pattern(
+    op: int, r0: Optional[int] = None, r1: Optional[int] = None, r2: Optional[int] = None, r3: Optional[int] = None,
+    value: Optional[int] = None, extended: Optional[int] = None,
+) -> Tuple[int, int]:
+    """
+    A (mask, bits) pair matching the instruction words with opcode `op` and the given fields, see ./vmcode.
+    Fields left as None match anything.
+    """
+    mask, bits = 0xE000, op << 13
+    for field, shift in ((r0, 10), (r1, 7), (r2, 4), (r3, 1)):
+        if field is not None:
+            mask, bits = mask | 7 << shift, bits | field << shift
+    if value is not None:
+        mask, bits = mask | 0xFFF << 1, bits | (value & 0xFFF) << 1
+    if extended is not None:
+        mask, bits = mask | 1, bits | extended
+    return mask, bits
+
+
+# Fixed instruction sequences emitted by assembler0/assembler1 that DispatchCore runs as one handler.
+# Longer idioms come first, so push and pop win over the load/stor pairs inside them.
+superinstructions: List[Tuple[str, Tuple[Tuple[int, int], ...]]] = [
+    # push $x: stor @P $x, addv $P 1 $P
+    ("push", (pattern(1, 5, 0), pattern(1, None, 4), pattern(0, value=1, extended=0), pattern(4, 0, 5, 7, 5))),
+    # pop $x: subv $P 1 $P, load @P $x
+    ("pop", (pattern(0, value=1, extended=0), pattern(4, 1, 5, 7, 5), pattern(1, 5, 0), pattern(1, 4))),
+    # load @x $y
+    ("load", (pattern(1, None, 0), pattern(1, 4))),
+    # stor @x $y
+    ("stor", (pattern(1, None, 0), pattern(1, None, 4))),
+    # setv $x k
+    ("setv", (pattern(0, extended=0), pattern(1, 7))),
+    # addv, subv, ... $x k $y
+    ("opv", (pattern(0, extended=0), pattern(4, r2=7))),
+]
+
+
+def handler_namespace(vm: VM, ext: List[int]) -> Dict[str, object]:
+    """The global names that code from instruction_source and jump_source runs against."""
+    return {
+        "r": vm.registers,
+        "rT": vm.rT,
+        "pages": vm.memory.pages,
+        "page": vm.memory.page,
+        "ZERO_PAGE": ZERO_PAGE,
+        "ext": ext,
+        "divide": divide,
+        "sign_extend": sign_extend,
+        "Halt": Halt,
+        "Yield": Yield,
+        "trap": vm.trap,
+        "vm": vm,
+    }
+
+
+class DispatchCore:
+    """
+    Execution core that dispatches through a table of precompiled handlers.
+
+    Every distinct instruction word gets one handler, generated and compiled once, with its
+    opcode, sub-op and registers baked in. A handler takes the pointer and returns the next one,
+    so the run loop is a single indexed call per instruction.
+    With `fuse`, every address that starts one of the `superinstructions` also gets a handler running
+    the whole idiom at once. The other addresses keep their single handlers, so a jump into the middle
+    of an idiom just runs the rest of it one instruction at a time.
+    It shares the register file and memory of `vm`, so it can be compared against the legacy loop in main.
+    """
+
+    def __init__(self, vm: VM, program: Program, fuse: bool = True) -> None:
+        self.vm = vm
+        self.program = program
+        self.ext = [vm.temp_value, vm.temp_bits]
+        namespace = handler_namespace(vm, self.ext)
+        source: List[str] = []
+        for word in sorted(set(program.words)):
+            source.append(f"def h{word}(pc):")
+            if word >> 13 == 2:
+                source.append(f"    target = {jump_source(word, 'pc + 2')}")
+                source.append("    if target == pc:")
+                source.append("        raise Halt(pc)")
+                source.append("    return target")
+            else:
+                source.extend("    " + i for i in instruction_source(word))
+                if word >> 13 == 7:
+                    source.append("    if vm.yielding:")
+                    source.append("        raise Yield(pc + 2)")
+                source.append("    return pc + 2")
+        exec(compile("\n".join(source), "<dispatch>", "exec"), namespace)
+        self.handlers: List[Callable[[int], int]] = [namespace[f"h{word}"] for word in program.words]  # type: ignore
+        # handlers used by the untraced loop, with `lengths` instructions each
+        self.fused = list(self.handlers)
+        self.lengths = array("B", [1] * len(program))
+        self.idioms: Dict[str, int] = {}
+        self.longest = 1
+        if fuse:
+            self.fuse(namespace)
+        self.halted = False
+
+    def fuse(self, namespace: Dict[str, object]) -> None:
+        """Find the superinstructions in the program and compile one local-register handler for each distinct one."""
+        words = self.program.words
+        found: Dict[Tuple[int, ...], List[int]] = {}
+        k = 0
+        while k < len(words):
+            for name, idiom in superinstructions:
+                if k + len(idiom) <= len(words) and all(words[k + i] & mask == bits for i, (mask, bits) in enumerate(idiom)):
+                    found.setdefault(tuple(words[k : k + len(idiom)]), []).append(k)
+                    self.idioms[name] = self.idioms.get(name, 0) + 1
+                    k += len(idiom)
+                    break
+            else:
+                k += 1
+        source: List[str] = []
+        for n, sequence in enumerate(found):
+            written = sorted({i for word in sequence for i in written_registers(word)})
+            source.append(f"def f{n}(pc):")
+            source.append("    r0, r1, r2, r3, r4, r5, r6, r7 = r")
+            source.extend("    " + line for word in sequence for line in instruction_source(word, True))
+            source.extend(f"    r[{i}] = r{i}" for i in written)
+            source.append(f"    return pc + {2 * len(sequence)}")
+        exec(compile("\n".join(source), "<superinstructions>", "exec"), namespace)
+        for n, (sequence, starts) in enumerate(found.items()):
+            for k in starts:
+                self.fused[k] = namespace[f"f{n}"]  # type: ignore
+                self.lengths[k] = len(sequence)
+            self.longest = max(self.longest, len(sequence))
+
+    def run(self, trace: Optional[Trace] = None, profile: Optional[Profile] = None, max_steps: Optional[int] = None) -> int:
+        """
+        Run until the program halts or `max_steps` instructions have been executed,
+        returning the number of executed instructions. `halted` tells which one happened.
+        """
+        handlers = self.handlers
+        words = self.program.words
+        size = self.program.size
+        limit = maxsize if max_steps is None else max_steps
+        pc = self.vm.pointer
+        steps = 0
+        self.halted = False
+        try:
+            if trace is None and profile is None:
+                fused, lengths = self.fused, self.lengths
+                # stop fusing while the next idiom could overshoot the budget
+                bound = limit - self.longest + 1
+                while 0 <= pc < size and steps < bound:
+                    k = pc >> 1
+                    pc = fused[k](pc)
+                    steps += lengths[k]
+                while 0 <= pc < size and steps < limit:
+                    pc = handlers[pc >> 1](pc)
+                    steps += 1
+            elif trace is None and profile is not None:
+                counts = profile.counts
+                while 0 <= pc < size and steps < limit:
+                    counts[pc >> 1] += 1
+                    pc = handlers[pc >> 1](pc)
+                    steps += 1
+            else:
+                while 0 <= pc < size and steps < limit:
+                    last = pc
+                    if profile is not None:
+                        profile.counts[pc >> 1] += 1
+                    pc = handlers[pc >> 1](pc)
+                    steps += 1
+                    if trace is not None:
+                        trace.record(steps, last, words[last >> 1], self.vm)
+        except Halt as e:
+            pc = e.pointer
+            steps += 1
+            self.halted = True
+            if trace is not None:
+                trace.record(steps, pc, words[pc >> 1], self.vm)
+        except Yield as e:
+            pc = e.pointer
+            steps += 1
+            if trace is not None:
+                trace.record(steps, pc - 2, words[(pc - 2) >> 1], self.vm)
+        finally:
+            self.vm.pointer = pc
+            self.vm.temp_value, self.vm.temp_bits = self.ext
+        self.halted = self.halted or not 0 <= pc < size
+        return steps
+
+
+class BlockCore:
+    """
+    Execution core that compiles basic blocks into Python functions.
+
+    A block is the straight-line run from an entry pointer up to and including the next jump or trap
+    (or the end of the image), so a trap can end the time slice of a green thread (see Scheduler). The first time the pointer lands on an entry, its block is generated
+    as Python source, compiled and cached by entry pointer, so a push, pop or call expansion costs
+    one Python call instead of one dispatch per machine instruction.
+    Inside a block the registers live in locals, and complete inpv/exte chains are folded into one constant.
+    Jumping into the middle of a block simply compiles another block starting there.
+    """
+
+    def __init__(self, vm: VM, program: Program) -> None:
+        self.vm = vm
+        self.program = program
+        self.ext = [vm.temp_value, vm.temp_bits]
+        self.namespace = handler_namespace(vm, self.ext)
+        self.blocks: Dict[int, Tuple[Callable[[], int], int]] = {}
+        self.halted = False
+
+    def chain(self, pointer: int) -> Tuple[int, int, int]:
+        """
+        Fold the inpv/exte chain starting at `pointer`.
+        Returns the address after the chain with its accumulated value and bit width, or (-1, 0, 0) if it is cut off.
+        """
+        words = self.program.words
+        value, bits = 0, 0
+        while pointer < self.program.size:
+            word = words[pointer >> 1]
+            if (word >> 13) != (0 if bits == 0 else 5):
+                break
+            value, bits = value << 12 | (word >> 1 & 0xFFF), bits + 12
+            pointer += 2
+            if not word & 1:
+                return pointer, value, bits
+        return -1, 0, 0
+
+    def compile(self, entry: int, limit: Optional[int] = None) -> Tuple[Callable[[], int], int]:
+        """
+        Compile and cache the block starting at `entry`.
+        With `limit`, the block is cut after that many instructions and not cached, so a step budget can end inside it.
+        """
+        words = self.program.words
+        size = self.program.size
+        end_pointer = size if limit is None else min(size, entry + 2 * limit)
+        code: List[str] = []
+        written: set[int] = set()
+        pointer = entry
+        next_pointer = ""
+        trapped = False
+        while pointer < end_pointer and next_pointer == "" and not trapped:
+            word = words[pointer >> 1]
+            op = word >> 13
+            if op == 0 and word & 1:
+                end, value, bits = self.chain(pointer)
+                if end != -1 and end <= end_pointer:
+                    code.append(f"r7 = {(sign_extend(value, bits) + 2147483648 & 4294967295) - 2147483648}")
+                    code.append(f"ext[0] = {value}")
+                    code.append(f"ext[1] = {bits}")
+                    written.add(7)
+                    pointer = end
+                    continue
+            pointer += 2
+            if op == 2:
+                next_pointer = jump_source(word, str(pointer), True)
+                continue
+            if op == 7:
+                # the host function sees vm.registers (system.gc roots on them), so store the locals first
+                code.extend(f"r[{i}] = r{i}" for i in sorted(written))
+            code.extend(instruction_source(word, True))
+            written.update(written_registers(word))
+            trapped = op == 7
+        source = ["def block():", "    r0, r1, r2, r3, r4, r5, r6, r7 = r"]
+        source.extend("    " + i for i in code)
+        source.append(f"    pc = {next_pointer or pointer}")
+        source.extend(f"    r[{i}] = r{i}" for i in sorted(written))
+        if next_pointer:
+            source.append(f"    if pc == {pointer - 2}:")
+            source.append(f"        raise Halt(pc)")
+        if trapped:
+            source.append("    if vm.yielding:")
+            source.append("        raise Yield(pc)")
+        source.append("    return pc")
+        exec(compile("\n".join(source), f"<block {entry}>", "exec"), self.namespace)
+        block = (self.namespace.pop("block"), (pointer - entry) >> 1)
+        if limit is None:
+            self.blocks[entry] = block  # type: ignore
+        return block  # type: ignore
+
+    def run(self, trace: Optional[Trace] = None, profile: Optional[Profile] = None, max_steps: Optional[int] = None) -> int:
+        """
+        Run until the program halts or `max_steps` instructions have been executed,
+        returning the number of executed instructions. `halted` tells which one happened.
+        With `profile`, only block entries are counted while running and spread over the block's instructions at the end.
+        """
+        blocks = self.blocks
+        words = self.program.words
+        size = self.program.size
+        limit = maxsize if max_steps is None else max_steps
+        pc = self.vm.pointer
+        steps = 0
+        hits: Dict[Tuple[int, int], int] = {}
+        self.halted = False
+        try:
+            if trace is None and profile is None:
+                while 0 <= pc < size and steps < limit:
+                    block = blocks.get(pc)
+                    if block is None:
+                        block = self.compile(pc)
+                    if steps + block[1] > limit:
+                        block = self.compile(pc, limit - steps)
+                    steps += block[1]
+                    pc = block[0]()
+            else:
+                while 0 <= pc < size and steps < limit:
+                    last = pc
+                    block = blocks.get(pc)
+                    if block is None:
+                        block = self.compile(pc)
+                    if steps + block[1] > limit:
+                        block = self.compile(pc, limit - steps)
+                    hits[pc, block[1]] = hits.get((pc, block[1]), 0) + 1
+                    steps += block[1]
+                    pc = block[0]()
+                    if trace is not None:
+                        trace.record(steps, last, words[last >> 1], self.vm)
+        except Halt as e:
+            pc = e.pointer
+            self.halted = True
+        except Yield as e:
+            pc = e.pointer
+        finally:
+            self.vm.pointer = pc
+            self.vm.temp_value, self.vm.temp_bits = self.ext
+            if profile is not None:
+                for (entry, length), n in hits.items():
+                    for k in range(entry >> 1, (entry >> 1) + length):
+                        profile.counts[k] += n
+        self.halted = self.halted or not 0 <= pc < size
+        return steps
+
+
+class LegacyCore:
+    """Reference core that decodes nothing ahead and executes every instruction through the VM methods."""
+
+    def __init__(self, vm: VM, program: Program) -> None:
+        self.vm = vm
+        self.program = program
+        self.halted = False
+
+    def run(self, trace: Optional[Trace] = None, profile: Optional[Profile] = None, max_steps: Optional[int] = None) -> int:
+        """
+        Run until the program halts or `max_steps` instructions have been executed,
+        returning the number of executed instructions. `halted` tells which one happened.
+        """
+        vm = self.vm
+        program = self.program
+        opcode, r0, r1, r2, r3 = program.opcode, program.r0, program.r1, program.r2, program.r3
+        value, extend = program.value, program.extend
+        limit = maxsize if max_steps is None else max_steps
+        steps = 0
+        self.halted = False
+        while 0 <= vm.pointer < program.size and steps < limit:
+            k = vm.pointer >> 1
+            op = opcode[k]
+            vm.pointer += 2
+            if op == 0:
+                vm.inpv(value[k], extend[k] == 1)
+            elif op == 1:
+                vm.copy(r0[k], r1[k])
+            elif op == 2:
+                vm.jump(r0[k], r1[k])
+            elif op == 3:
+                vm.comp(r0[k], r1[k], r2[k])
+            elif op == 4:
+                vm.operation(r0[k], r1[k], r2[k], r3[k])
+            elif op == 5:
+                vm.exte(value[k], extend[k] == 1)
+            elif op == 6:
+                vm.sett(r0[k])
+            else:
+                vm.registers[5] = vm.trap(value[k], vm.registers[5])
+            steps += 1
+            if profile is not None:
+                profile.counts[k] += 1
+            if trace is not None:
+                trace.record(steps, k << 1, program.words[k], vm)
+            if vm.pointer == k << 1:
+                # a taken jump to itself
+                self.halted = True
+                break
+            if op == 7 and vm.yielding:
+                break
+        self.halted = self.halted or not 0 <= vm.pointer < program.size
+        return steps
+
+
+cores: Dict[str, Callable[[VM, Program], Union[LegacyCore, DispatchCore, BlockCore]]] = {
+    "legacy": LegacyCore,
+    "dispatch": DispatchCore,
+    "block": BlockCore,
+}
+
+
+class Result:
+    """
+    What a Machine.run call ended with.
+
+    `reason` is one of Machine.reasons: "halt" (a jump to itself), "exit" (the pointer left the image),
+    "steps" (max_steps ran out) or "deadline". `steps` counts this call only, `total` everything since load.
+    """
+
+    def __init__(
+        self, reason: str, steps: int, total: int, pointer: int, registers: List[int], rT: List[int], memory: Dict[int, int]
+    ) -> None:
+        self.reason = reason
+        self.steps = steps
+        self.total = total
+        self.pointer = pointer
+        self.registers = registers
+        self.rT = rT
+        self.memory = memory
+
+    @property
+    def finished(self) -> bool:
+        return self.reason in ("halt", "exit")
+
+    def __repr__(self) -> str:
+        return f"Result({self.reason!r}, steps={self.steps}, pointer={self.pointer}, registers={self.registers})"
+
+
+class Machine:
+    """
+    The emulator as a library: load an image, then run it with a step budget and/or a deadline.
+
+    A run that stops on its budget can be continued by calling run again; once the program has
+    finished, run returns right away with the same reason and no new steps.
+    """
+
+    reasons = ("halt", "exit", "steps", "deadline")
+    # steps executed between two deadline checks
+    slice = 10000
+
+    def __init__(self, program: Program, core: str = "block", vm: Optional[VM] = None) -> None:
+        if core not in cores:
+            raise Exception(f"Unknown core '{core}', expected one of: {', '.join(cores)}")
+        self.program = program
+        self.vm = vm if vm is not None else VM()
+        self.core = cores[core](self.vm, program)
+        self.total = 0
+        self.reason = ""
+
+    @classmethod
+    def load(cls, data: bytes, core: str = "block", vm: Optional[VM] = None) -> "Machine":
+        """Build a machine from the bytes of an .asm file."""
+        return cls(Program(data), core, vm)
+
+    def run(self, max_steps: Optional[int] = None, deadline: Optional[float] = None, memory: Iterable[int] = ()) -> Result:
+        """
+        Run until the program finishes, `max_steps` more instructions have been executed,
+        or time.monotonic() passes `deadline`. The addresses in `memory` are copied into the result.
+        """
+        steps = 0
+        if self.reason not in ("halt", "exit"):
+            while True:
+                budget = maxsize if max_steps is None else max_steps - steps
+                if deadline is not None:
+                    if monotonic() >= deadline:
+                        self.reason = "deadline"
+                        break
+                    budget = min(budget, self.slice)
+                steps += self.core.run(max_steps=budget)
+                if self.core.halted:
+                    self.reason = "halt" if 0 <= self.vm.pointer < self.program.size else "exit"
+                    break
+                if max_steps is not None and steps >= max_steps:
+                    self.reason = "steps"
+                    break
+        self.total += steps
+        vm = self.vm
+        vm.memory.flush()
+        return Result(
+            self.reason, steps, self.total, vm.pointer, list(vm.registers), list(vm.rT), {i: vm.memory[i] for i in memory}
+        )
+
+
+class Task:
+    """One green thread of a Scheduler, with the registers, rT bank and pointer saved while it is not running."""
+
+    def __init__(self, number: int, pointer: int, stack: int = -1) -> None:
+        self.number = number
+        self.pointer = pointer
+        self.registers = [0] * 8
+        self.rT = [0] * 8
+        self.temp_value = 0
+        self.temp_bits = 0
+        # index of its stack region, -1 for the task the program started in
+        self.stack = stack
+        self.steps = 0
+
+    def __repr__(self) -> str:
+        return f"Task({self.number}, pointer={self.pointer})"
+
+
+class Scheduler:
+    """
+    Cooperative green threads on one VM, sharing its memory and heap.
+
+    The program starts as task 0. system.spawn(entry, argument) adds a task starting at the code address
+    `entry`, with $L and $P on a stack region of its own holding `argument` in @L 0, above a call frame
+    returning to the end of the image. Tasks run round-robin: each one until it calls system.yield or has run
+    `quantum` instructions, and a task is done once it halts, returns from its entry or its pointer leaves the image.
+    The registers of the waiting tasks are roots for the heap collector, their stacks are in plain memory anyway.
+    """
+
+    # stack regions of spawned tasks, between the interpreter frames (1 << 20) and the heap (1 << 24)
+    base = 1 << 22
+    end = 1 << 24
+
+    def __init__(self, program: Program, core: str = "block", vm: Optional[VM] = None, quantum: int = 1000, stack_size: int = 1 << 14) -> None:
+        if core not in cores:
+            raise Exception(f"Unknown core '{core}', expected one of: {', '.join(cores)}")
+        if quantum <= 0:
+            raise Exception("The quantum must be positive")
+        self.program = program
+        self.vm = vm if vm is not None else VM()
+        self.core = cores[core](self.vm, program)
+        self.quantum = quantum
+        self.stack_size = stack_size
+        self.free = list(range((self.end - self.base) // stack_size - 1, -1, -1))
+        main = Task(0, self.vm.pointer)
+        self.save(main)
+        self.tasks: Deque[Task] = deque([main])
+        self.done: List[Task] = []
+        self.count = 1
+        self.vm.scheduler = self
+        self.vm.roots.append(self.roots)
+
+    def spawn(self, entry: int, argument: int) -> int:
+        """Add a task (see the class docstring), returning its number or -1 if every stack region is in use."""
+        if not self.free:
+            return -1
+        task = Task(self.count, entry, self.free.pop())
+        self.count += 1
+        stack = self.base + task.stack * self.stack_size
+        # the return address, $P and $L of a call frame below @L 0, like `call` leaves them:
+        # a `return` from the entry jumps to the end of the image, which ends the task
+        self.vm.memory.write(stack, self.program.size)
+        self.vm.memory.write(stack + 1, stack)
+        self.vm.memory.write(stack + 2, stack)
+        self.vm.memory.write(stack + 3, argument)
+        task.registers[3] = stack + 3
+        task.registers[5] = stack + 4
+        self.tasks.append(task)
+        return task.number
+
+    def roots(self) -> Iterable[int]:
+        for task in self.tasks:
+            yield from task.registers
+            yield from task.rT
+
+    def load(self, task: Task) -> None:
+        # in place, the cores keep references to these lists
+        self.vm.registers[:] = task.registers
+        self.vm.rT[:] = task.rT
+        self.vm.pointer = task.pointer
+        self.vm.temp_value, self.vm.temp_bits = task.temp_value, task.temp_bits
+        if not isinstance(self.core, LegacyCore):
+            self.core.ext[:] = [task.temp_value, task.temp_bits]
+
+    def save(self, task: Task) -> None:
+        task.registers[:] = self.vm.registers
+        task.rT[:] = self.vm.rT
+        task.pointer = self.vm.pointer
+        task.temp_value, task.temp_bits = self.vm.temp_value, self.vm.temp_bits
+
+    def run(self, max_steps: Optional[int] = None) -> int:
+        """Run the tasks until all of them are done or `max_steps` instructions have been executed, returning the steps run."""
+        steps = 0
+        while self.tasks and (max_steps is None or steps < max_steps):
+            task = self.tasks[0]
+            self.load(task)
+            budget = self.quantum if max_steps is None else min(self.quantum, max_steps - steps)
+            n = self.core.run(max_steps=budget)
+            steps += n
+            task.steps += n
+            self.save(task)
+            self.vm.yielding = False
+            self.tasks.popleft()
+            if self.core.halted:
+                self.done.append(task)
+                if task.stack != -1:
+                    self.free.append(task.stack)
+            else:
+                self.tasks.append(task)
+        self.vm.memory.flush()
+        return steps
+
+
+def write_profile(profile: Profile, path: str) -> None:
+    """Print the profile report and save it as <name>.profile.json, using the symbol table <name>.sym if there is one."""
+    file_name = ".".join(path.split(".")[:-1])
+    symbols: Dict[str, int] = {}
+    if isfile(file_name + ".sym"):
+        with open(file_name + ".sym", "r", encoding="utf-8") as f:
+            symbols = json.load(f)
+    print(profile.report(symbols))
+    with open(file_name + ".profile.json", "w", encoding="utf-8") as f:
+        json.dump(profile.to_json(symbols), f, indent=4)
 
 
 def main(args: Args) -> None:
-    s: dict[int, str] = {}  ##
-    i = 1  ##
     if args.path.endswith(".vm"):
         assembler.main(args.path, [False, False, False])
         args.path = args.path.split(".")[-2] + ".asm"
     with open(args.path, "rb") as f:
-        data = f.read()
-    vm = VM(4294967296)
-    while vm.pointer < len(data):
-        c = get_command(data, vm.pointer)
-        if c[:3] == "000":
-            vm.inpv(c[3:15], True if c[15] == "1" else False)
-            vm.pointer += 2
-        elif c[:3] == "001":
-            vm.copy(int(c[3:6], 2), int(c[6:9], 2))
-            vm.pointer += 2
-        elif c[:3] == "010":
-            vm.jump(int(c[3:6], 2), int(c[6:9], 2))
-            vm.pointer += 2
-        elif c[:3] == "011":
-            vm.comp(int(c[3:6], 2), int(c[6:9], 2), int(c[9:12], 2))
-            vm.pointer += 2
-        elif c[:3] == "100":
-            vm.operation(int(c[3:6], 2), int(c[6:9], 2), int(c[9:12], 2), int(c[12:15], 2))
-            vm.pointer += 2
-        elif c[:3] == "101":
-            vm.exte(c[3:15], True if c[15] == "1" else False)
-            i -= 1  ##
-            vm.pointer += 2
-        elif c[:3] == "110":
-            vm.sett(int(c[3:6], 2))
-            vm.pointer += 2
+        program = Program(f.read())
+    vm = VM()
+    vm.memory.map(assembler.CONSOLE_BASE, Console())
+    if args.restore:
+        vm.restore(args.restore)
+    trace = None if args.trace == "off" else Trace(args.trace, args.trace_size)
+    profile = Profile(program) if args.profile else None
+    try:
+        if args.quantum:
+            steps = Scheduler(program, args.core, vm, args.quantum).run()
         else:
-            print(vm.registers)
-            print(vm.rT)
-            raise Exception(f"Invalid command {c} in {args.path} {vm.pointer}")
-        if vm.pointer in s:  ##
-            break  ##
-        s[vm.pointer] = c  ##
-        print(i, vm.pointer, c, vm.registers, vm.memory)  ##
-        i += 1  ##
+            steps = cores[args.core](vm, program).run(trace, profile)
+    finally:
+        vm.memory.flush()
+        if trace is not None:
+            trace.dump()
+        if profile is not None:
+            write_profile(profile, args.path)
+    if args.snapshot:
+        vm.snapshot(args.snapshot)
     print(vm.memory)
-    # print(len(s))  ##
-    # for j, i in enumerate(s):  ##
-    # print(j + 1, i, s[i])  ##
     print(vm.registers)
     print(vm.rT)
     print(vm.pointer)
+    print(f"{steps} steps")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,512 @@
+from operator import add, and_, eq, ge, gt, le, lshift, lt, mul, ne, or_, rshift, sub
+from os.path import abspath, isfile
+from sys import argv, maxsize
+from typing import Callable, Dict, List, Optional, Tuple
+
+from assembler import CONSOLE_BASE, CONSOLE_CHAR, CONSOLE_INT, error, rtob
+from built_in.built_in import HEAP_BASE, host_function
+from compiler.lib import CompileError
+from emulator import VM, Console, divide, modulo
+
+# frames are laid out upwards from FRAME_BASE, built_in.alloc works on the heap at HEAP_BASE (see built_in/built_in.py)
+FRAME_BASE = 1 << 20
+
+register = {name: int(bits, 2) for name, bits in rtob.items()}
+comparison: Dict[str, Callable[[int, int], bool]] = {
+    "nv": lambda a, b: False,
+    ">": gt,
+    "==": eq,
+    ">=": ge,
+    "<": lt,
+    "!=": ne,
+    "<=": le,
+    "aw": lambda a, b: True,
+}
+operation: Dict[str, Callable[[int, int], int]] = {
+    "add": add,
+    "sub": sub,
+    "mul": mul,
+    "div": divide,
+    "rmv": rshift,
+    "lmv": lshift,
+    "and": and_,
+    "or_": or_,
+}
+
+
+def to_int32(value: int) -> int:
+    """Wrap `value` into a signed 32-bit value, like VM.setr."""
+    return (value + 2147483648 & 4294967295) - 2147483648
+
+
+# `call built_in.<name> n` handled by the interpreter itself, the same set assembler.preprocess expands.
+# Operands are taken in push order, so `a b call built_in.sub 2` is a - b.
+built_in: Dict[str, Callable[..., int]] = {
+    "neg": lambda a: to_int32(-a),
+    "invert": lambda a: int(a == 0),
+    "bool": lambda a: int(a != 0),
+    "add": lambda a, b: to_int32(a + b),
+    "sub": lambda a, b: to_int32(a - b),
+    "mul": lambda a, b: to_int32(a * b),
+    "div": lambda a, b: to_int32(divide(a, b)),
+    "mod": modulo,
+    "or": lambda a, b: a | b,
+    "and": lambda a, b: a & b,
+    "lm": lambda a, b: to_int32(a << b),
+    "rm": lambda a, b: a >> b,
+    "eq": lambda a, b: int(a == b),
+    "neq": lambda a, b: int(a != b),
+    "geq": lambda a, b: int(a >= b),
+    "leq": lambda a, b: int(a <= b),
+    "gt": lambda a, b: int(a > b),
+    "lt": lambda a, b: int(a < b),
+}
+
+Handler = Callable[[int], int]
+
+
+class Interpreter:
+    """
+    Runs .vm code (see ./vmcode and compiler/Compiler.py) directly, one handler per line, without assembling it.
+
+    The stack language gets its own runtime instead of the machine's expansion:
+    - an operand stack, a Python list that push, pop, goto and call work on
+    - frames in memory from FRAME_BASE upwards, $L pointing at argument 0 with the locals after the arguments,
+      and the return index, caller $L and caller frame top kept on a separate call stack
+    - a label table mapping labels to line indices, so getl and jump use line indices as addresses
+    The register instructions (copy, comp, addr, ...) work on the registers and memory of `vm` as on the machine.
+    Returning from the outermost frame or `halt` ends the run.
+    """
+
+    def __init__(self, source: List[str], file: str = "<vm>") -> None:
+        self.file = file
+        self.vm = VM()
+        self.stack: List[int] = []
+        # return index, caller $L, caller frame top and operand stack depth of every active call
+        self.calls: List[Tuple[int, int, int, int]] = []
+        self.labels: Dict[str, int] = {}
+        # words needed by the frame of every subroutine (labels containing ".")
+        self.frames: Dict[str, int] = {}
+        self.built_in: Dict[str, Callable[..., int]] = dict(built_in)
+        self.top = FRAME_BASE
+        self.vm.registers[3] = FRAME_BASE
+        # the operand stack lives outside VM memory, so the collector has to be told about it
+        self.vm.roots.append(lambda: self.stack)
+        self.pointer = 0
+        self.halted = False
+        lines = self.parse(source)
+        self.code: List[Handler] = [self.compile(line, words) for line, words in lines]
+
+    def parse(self, source: List[str]) -> List[Tuple[int, List[str]]]:
+        """Split the source into instructions, filling the label table and the frame sizes."""
+        lines: List[Tuple[int, List[str]]] = []
+        now = ""
+        for line, i in enumerate(source):
+            words = i.split()
+            if not words or words[0].startswith("//") or words[0].startswith("debug"):
+                continue
+            if words[0] in ("label", "setl"):
+                if len(words) != 2:
+                    error("Unknown format", self.file, line)
+                self.labels[words[1]] = len(lines)
+                if "." in words[1]:
+                    now = words[1]
+                    self.frames[now] = 0
+                continue
+            if now and words[0] in ("push", "pop") and len(words) == 3 and words[1] in ("@L", "$L"):
+                self.frames[now] = max(self.frames[now], int(words[2]) + 1)
+            lines.append((line, words))
+        return lines
+
+    def getter(self, name: str) -> Callable[[], int]:
+        """A function reading register `name` ($M goes through memory, $T through the sub-registers)."""
+        r, rT, read = self.vm.registers, self.vm.rT, self.vm.memory.read
+        key = register[name]
+        if key == 4:
+            return lambda: read(r[0])
+        elif key == 6:
+            return lambda: rT[r[6]]
+        return lambda: r[key]
+
+    def setter(self, name: str) -> Callable[[int], None]:
+        """A function writing a wrapped value to register `name`, see getter."""
+        r, rT, write = self.vm.registers, self.vm.rT, self.vm.memory.write
+
+        def set_memory(value: int) -> None:
+            write(r[0], to_int32(value))
+
+        def set_temporary(value: int) -> None:
+            rT[r[6]] = to_int32(value)
+
+        def set_register(value: int) -> None:
+            r[key] = to_int32(value)
+
+        key = register[name]
+        if key == 4:
+            return set_memory
+        elif key == 6:
+            return set_temporary
+        return set_register
+
+    def compile(self, line: int, words: List[str]) -> Handler:
+        """Build the handler of one instruction: it takes the line index and returns the next one."""
+        try:
+            return self.compile_words(words)
+        except KeyError as e:
+            error(f"Unknown label or register {e}", self.file, line)
+            raise
+        except (IndexError, ValueError):
+            error("Unknown format", self.file, line)
+            raise
+
+    def compile_words(self, words: List[str]) -> Handler:
+        stack, calls = self.stack, self.calls
+        push, pop = stack.append, stack.pop
+        r = self.vm.registers
+        read, write = self.vm.memory.read, self.vm.memory.write
+        op = words[0]
+        operand = words[1] if len(words) > 1 else ""
+        offset = int(words[2]) if len(words) == 3 and op in ("push", "pop") else 0
+
+        # the common forms on plain registers index `r` directly instead of going through getter
+        key = register.get(operand[1:], 4) if operand[:1] in ("$", "@") else 4
+
+        if op == "push" and operand[0] == "@" and key not in (4, 6):
+
+            def handler(pc: int) -> int:
+                push(read(r[key] + offset))
+                return pc + 1
+
+        elif op == "push" and operand[0] == "@":
+            get = self.getter(operand[1:])
+
+            def handler(pc: int) -> int:
+                push(read(get() + offset))
+                return pc + 1
+
+        elif op == "push" and operand[0] == "$" and key not in (4, 6):
+
+            def handler(pc: int) -> int:
+                push(to_int32(r[key] + offset))
+                return pc + 1
+
+        elif op == "push" and operand[0] == "$":
+            get = self.getter(operand[1:])
+
+            def handler(pc: int) -> int:
+                push(to_int32(get() + offset))
+                return pc + 1
+
+        elif op == "push":
+            value = to_int32(int(operand))
+
+            def handler(pc: int) -> int:
+                push(value)
+                return pc + 1
+
+        elif op == "pop" and operand[0] == "@" and key not in (4, 6):
+
+            def handler(pc: int) -> int:
+                write(r[key] + offset, pop())
+                return pc + 1
+
+        elif op == "pop" and operand[0] == "@":
+            get = self.getter(operand[1:])
+
+            def handler(pc: int) -> int:
+                write(get() + offset, pop())
+                return pc + 1
+
+        elif op == "pop" and operand[0] == "$" and len(words) == 2:
+            put = self.setter(operand[1:])
+
+            def handler(pc: int) -> int:
+                put(pop())
+                return pc + 1
+
+        elif op == "goto" and len(words) == 3:
+            target = self.labels[operand]
+            if words[2] == "all":
+
+                def handler(pc: int) -> int:
+                    return target
+
+            elif words[2] == "true":
+
+                def handler(pc: int) -> int:
+                    return target if pop() != 0 else pc + 1
+
+            elif words[2] == "false":
+
+                def handler(pc: int) -> int:
+                    return target if pop() == 0 else pc + 1
+
+            else:
+                raise ValueError(words[2])
+
+        elif op == "call" and len(words) == 3:
+            return self.compile_call(operand, int(words[2]))
+
+        elif op == "return" and len(words) == 1:
+
+            def handler(pc: int) -> int:
+                value = pop()
+                if not calls:
+                    return -1
+                pc, r[3], self.top, depth = calls.pop()
+                del stack[depth:]
+                push(value)
+                return pc
+
+        elif op == "halt" and len(words) == 1:
+
+            def handler(pc: int) -> int:
+                return -1
+
+        else:
+            return self.compile_register(words)
+        return handler
+
+    def compile_call(self, name: str, n: int) -> Handler:
+        stack, calls = self.stack, self.calls
+        push, pop = stack.append, stack.pop
+        r = self.vm.registers
+        write = self.vm.memory.write
+        if name in host_function and host_function[name][1] == n:
+            function = host_function[name][2]
+            vm = self.vm
+
+            def host(pc: int) -> int:
+                args = stack[len(stack) - n :]
+                del stack[len(stack) - n :]
+                push(to_int32(function(vm, *args)))
+                return pc + 1
+
+            return host
+        if name.startswith("built_in."):
+            return self.compile_built_in(name, n)
+        if name == "print" and n == 1:
+
+            def print_(pc: int) -> int:
+                write(CONSOLE_BASE + CONSOLE_INT, pop())
+                write(CONSOLE_BASE + CONSOLE_CHAR, 10)
+                push(0)
+                return pc + 1
+
+            return print_
+        if name == "input" and n == 0:
+            read = self.vm.memory.read
+
+            def input_(pc: int) -> int:
+                push(read(CONSOLE_BASE + CONSOLE_INT))
+                return pc + 1
+
+            return input_
+        entry = self.labels.get(name)
+        if entry is None:
+            message = f"Unknown subroutine '{name}'"
+
+            def unknown(pc: int) -> int:
+                raise Exception(message)
+
+            return unknown
+        size = max(n, self.frames.get(name, 0))
+
+        def call(pc: int) -> int:
+            base = self.top
+            depth = len(stack) - n
+            calls.append((pc + 1, r[3], base, depth))
+            for i in range(n):
+                write(base + i, stack[depth + i])
+            for i in range(n, size):
+                write(base + i, 0)
+            del stack[depth:]
+            r[3] = base
+            self.top = base + size
+            return entry
+
+        return call
+
+    def compile_built_in(self, name: str, n: int) -> Handler:
+        """Handlers for `call built_in.<name> n`, run by the Python functions in `built_in`."""
+        stack = self.stack
+        push, pop = stack.append, stack.pop
+        function = self.built_in.get(name[len("built_in.") :])
+        if function is None:
+            message = f"Unknown built-in function '{name}'"
+
+            def handler(pc: int) -> int:
+                raise Exception(message)
+
+        elif n == 1:
+
+            def handler(pc: int) -> int:
+                push(function(pop()))
+                return pc + 1
+
+        elif n == 2:
+
+            def handler(pc: int) -> int:
+                b = pop()
+                push(function(pop(), b))
+                return pc + 1
+
+        else:
+
+            def handler(pc: int) -> int:
+                args = stack[len(stack) - n :]
+                del stack[len(stack) - n :]
+                push(function(*args))
+                return pc + 1
+
+        return handler
+
+    def compile_register(self, words: List[str]) -> Handler:
+        """Handlers for the register instructions and their syntactic sugar, see ./vmcode."""
+        r = self.vm.registers
+        op = words[0]
+        if op == "inpv" and len(words) == 2:
+            value = to_int32(int(words[1]))
+
+            def handler(pc: int) -> int:
+                r[7] = value
+                return pc + 1
+
+        elif op == "setv" and len(words) == 3:
+            value = to_int32(int(words[2]))
+            put = self.setter(words[1][1:])
+
+            def handler(pc: int) -> int:
+                r[7] = value
+                put(value)
+                return pc + 1
+
+        elif op == "getl" and len(words) == 3:
+            value = self.labels[words[2]]
+            put = self.setter(words[1][1:])
+
+            def handler(pc: int) -> int:
+                r[7] = value
+                put(value)
+                return pc + 1
+
+        elif op == "copy" and len(words) == 3:
+            get, put = self.getter(words[1][1:]), self.setter(words[2][1:])
+
+            def handler(pc: int) -> int:
+                put(get())
+                return pc + 1
+
+        elif op in ("load", "stor") and len(words) == 3 and words[1][0] == "@":
+            address = self.getter(words[1][1:])
+            get, put = (self.getter("M"), self.setter(words[2][1:])) if op == "load" else (self.getter(words[2][1:]), self.setter("M"))
+
+            def handler(pc: int) -> int:
+                r[0] = address()
+                put(get())
+                return pc + 1
+
+        elif op == "comp" and len(words) == 4:
+            a, b, compare = self.getter(words[1][1:]), self.getter(words[3][1:]), comparison[words[2]]
+
+            def handler(pc: int) -> int:
+                r[1] = 1 if compare(a(), b()) else 0
+                return pc + 1
+
+        elif op[:3] in operation and op[3:] == "r" and len(words) == 4:
+            a, b, put, function = self.getter(words[1][1:]), self.getter(words[2][1:]), self.setter(words[3][1:]), operation[op[:3]]
+
+            def handler(pc: int) -> int:
+                put(function(a(), b()))
+                return pc + 1
+
+        elif op[:3] in operation and op[3:] == "v" and len(words) == 4:
+            value = to_int32(int(words[2]))
+            a, put, function = self.getter(words[1][1:]), self.setter(words[3][1:]), operation[op[:3]]
+
+            def handler(pc: int) -> int:
+                r[7] = value
+                put(function(a(), value))
+                return pc + 1
+
+        elif op == "sett" and len(words) == 2 and 0 <= int(words[1]) < 8:
+            index = int(words[1])
+
+            def handler(pc: int) -> int:
+                r[6] = index
+                return pc + 1
+
+        elif op == "jump" and len(words) == 3:
+            target, condition = self.getter(words[1][1:]), self.getter(words[2][1:])
+
+            def handler(pc: int) -> int:
+                return target() if condition() != 0 else pc + 1
+
+        else:
+            raise ValueError(op)
+        return handler
+
+    def run(self, max_steps: Optional[int] = None) -> int:
+        """
+        Run until the program ends or `max_steps` lines have been executed, returning the number of executed lines.
+        `halted` tells which one happened, and calling run again resumes.
+        """
+        code = self.code
+        size = len(code)
+        limit = maxsize if max_steps is None else max_steps
+        pc = self.pointer
+        steps = 0
+        try:
+            while 0 <= pc < size and steps < limit:
+                pc = code[pc](pc)
+                steps += 1
+        finally:
+            self.pointer = pc
+            self.halted = not 0 <= pc < size
+        return steps
+
+
+class Args:
+    def __init__(self, path: str = "", max_steps: Optional[int] = None) -> None:
+        self.path = path
+        self.max_steps = max_steps
+
+
+def parser_args(args: List[str]) -> Args:
+    result = Args()
+    options = iter(args)
+    for i in options:
+        if i == "--max-steps":
+            result.max_steps = int(next(options, "0"))
+        elif result.path == "" and isfile(i) and i.endswith(".vm"):
+            result.path = abspath(i)
+    if result.path == "":
+        raise Exception("Need to pass in a .vm file")
+    return result
+
+
+def main(args: Args) -> None:
+    with open(args.path, "r", encoding="utf-8") as f:
+        source = f.readlines()
+    try:
+        interpreter = Interpreter(source, args.path)
+    except CompileError as e:
+        print(e.show(source[e.line])[0])
+        return
+    interpreter.vm.memory.map(CONSOLE_BASE, Console())
+    try:
+        steps = interpreter.run(args.max_steps)
+    finally:
+        interpreter.vm.memory.flush()
+    print(interpreter.vm.memory)
+    print(interpreter.vm.registers)
+    print(interpreter.stack)
+    print(f"{steps} steps" + ("" if interpreter.halted else " (stopped by --max-steps)"))
+
+
+if __name__ == "__main__":
+    if len(argv) > 1:
+        args = parser_args(argv[1:])
+    else:
+        args = parser_args(input("path & args: ").split())
+    main(args)
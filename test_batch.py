@@ -0,0 +1,50 @@
+import json
+
+import assembler
+import batch
+import emulator
+from test_emulator import SUM_LOOP, assemble
+
+
+def test_batch_runs(tmp_path):
+    program = tmp_path / "sum.asm"
+    program.write_bytes(assemble(SUM_LOOP))
+    loop = tmp_path / "loop.vm"
+    loop.write_text("label a\ngetl $A a\nsetv $C 1\njump $A $C\n")
+    results = batch.run_batch(batch.parser_args([str(program), str(loop), str(program), "--max-steps", "100", "--workers", "2"]))
+    assert [i["steps"] for i in results] == [87, 100, 87]
+    assert [i["reason"] for i in results] == ["exit", "steps", "exit"]
+    assert results[0]["memory"] == {"100": 55}
+    assert "1 out of steps" in batch.report(results)
+
+
+def test_batch_images(tmp_path):
+    program = tmp_path / "inc.vm"
+    program.write_text("setv $A 100\naddv $M 1 $M\nhalt\n")
+    image = tmp_path / "a.json"
+    image.write_text(json.dumps({"100": 41}))
+    vm = emulator.VM()
+    vm.memory[100] = -1
+    vm.snapshot(str(tmp_path / "b.snap"))
+    args = batch.parser_args([str(program), "--image", str(image), "--image", str(tmp_path / "b.snap"), "--core", "dispatch"])
+    results = batch.run_batch(args)
+    assert [i["memory"] for i in results] == [{"100": 42}, {}]
+
+
+def test_batch_assembly_error(tmp_path):
+    # a stale image next to the .vm must not be run in its place
+    program = tmp_path / "p.vm"
+    program.write_text("bogus $D\nhalt\n")
+    (tmp_path / "p.asm").write_bytes(assemble(SUM_LOOP))
+    results = batch.run_batch(batch.parser_args([str(program)]))
+    assert results[0]["error"].startswith("CompileError")
+    assert "1 runs, 1 failed" in batch.report(results)
+
+
+def test_batch_console_output(tmp_path):
+    program = tmp_path / "print.vm"
+    program.write_text("push 42\ncall print 1\npop $D\ncall input 0\ncall print 1\npop $D\nhalt\n")
+    results = batch.run_batch(batch.parser_args([str(program)]))
+    # no input, so input gives 0; the console page stays out of the memory dump
+    assert results[0]["output"] == "42\n0\n"
+    assert all(int(i) < assembler.CONSOLE_BASE for i in results[0]["memory"])
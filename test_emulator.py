@@ -0,0 +1,624 @@
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Dict, Iterator, List, Optional, Tuple, Type
+
+import pytest
+
+import assembler
+import emulator
+from built_in.built_in import HEAP_BASE, HEAP_GC_SPACE, HEAP_HEADER, alloc, collect
+from test_translator import compile_nj
+
+
+def assemble(source: List[str], symbols: Optional[Dict[str, int]] = None) -> bytes:
+    """Assemble o0-level code (.vm without built_in calls) into an .asm image."""
+    return assembler.assembler2(assembler.assembler1(assembler.assembler0(assembler.parse(source), "test"), "test"), "test", symbols)
+
+
+def test_program_decode_fields():
+    program = emulator.Program(assemble(["copy $D $P", "comp $L >= $V", "subr $P $V $T", "sett 7", "inpv -3"]))
+    assert len(program) == 5
+    assert list(program.opcode) == [1, 3, 4, 6, 0]
+    assert (program.r0[0], program.r1[0]) == (2, 5)
+    assert (program.r0[1], program.r1[1], program.r2[1]) == (3, 3, 7)
+    assert (program.r0[2], program.r1[2], program.r2[2], program.r3[2]) == (1, 5, 7, 6)
+    assert program.r0[3] == 7
+    assert emulator.sign_extend(program.value[4], 12) == -3
+
+
+def test_label_fixups():
+    # a forward reference, a value needing exte words before the label, and a backward reference
+    symbols: Dict[str, int] = {}
+    asm = assembler.assembler2(assembler.parse(["//getl end", "inpv 100000", "//setl end", "sett 3", "//getl end"]), "test", symbols)
+    program = emulator.Program(asm)
+    assert symbols == {"end": 6}
+    assert list(program.opcode) == [0, 0, 5, 6, 0]
+    assert emulator.sign_extend(program.value[0], 12) == 6 == emulator.sign_extend(program.value[4], 12)
+    with pytest.raises(assembler.CompileError, match="Unknown label 'nowhere'"):
+        assembler.assembler2(assembler.parse(["//getl nowhere"]), "test")
+
+
+def test_extended_value():
+    vm = emulator.VM()
+    program = emulator.Program(assemble(["inpv -100000"]))
+    assert list(program.opcode) == [0, 5]
+    vm.inpv(program.value[0], program.extend[0] == 1)
+    vm.exte(program.value[1], program.extend[1] == 1)
+    assert vm.registers[7] == -100000
+
+
+SUM_LOOP = [
+    "setv $D 0",
+    "setv $L 10",
+    "label loop",
+    "addr $D $L $D",
+    "subv $L 1 $L",
+    "getl $T loop",
+    "inpv 0",
+    "comp $L > $V",
+    "jump $T $C",
+    "setv $A 100",
+    "copy $D $M",
+]
+
+
+def test_assembler_reentrant():
+    image = assembler.assemble("\n".join(SUM_LOOP), "sum.vm")
+    assert image == assemble(SUM_LOOP)
+    # the labels of one assembly are not seen by the next one
+    with pytest.raises(assembler.CompileError, match="Unknown label 'loop'"):
+        assembler.assemble(["getl $T loop"])
+    sources = [SUM_LOOP + [f"setv $D {i * 1000}"] * i for i in range(16)]
+    with ThreadPoolExecutor(4) as pool:
+        images = list(pool.map(assembler.assemble, sources))
+    assert images == [assemble(i) for i in sources]
+
+
+def test_assembler_streaming():
+    def source(n: int) -> Iterator[str]:
+        for _ in range(n):
+            yield "push @L 3"
+            yield "pop $D"
+        yield "halt"
+
+    o0 = StringIO()
+    image = assembler.Assembler().assemble(source(1), o0)
+    assert image == assemble(o0.getvalue().splitlines())
+    assert o0.getvalue().splitlines()[-3:] == ["getl $A halt_2", "setl halt_2", "jump $A $C"]
+    # nothing but the image grows with the source
+    peaks = []
+    for n in (500, 2000):
+        tracemalloc.start()
+        image = assembler.assemble(source(n))
+        peaks.append((tracemalloc.get_traced_memory()[1], len(image)))
+        tracemalloc.stop()
+    assert peaks[1][0] - peaks[0][0] < 10 * (peaks[1][1] - peaks[0][1])
+    # errors point at the line of the .vm source
+    with pytest.raises(assembler.CompileError) as e:
+        assembler.assemble(["push $D", "", "call built_in.add 2", "pop", "halt"])
+    assert e.value.line == 3
+
+
+STRAIGHT_LINE = [
+    "inpv 2147483647",
+    "copy $V $D",
+    "addv $D 1 $D",
+    "setv $P 1000",
+    "push $D",
+    "push -7",
+    "subv $P 1 $P",
+    "load @P $L",
+    "sett 3",
+    "mulv $L -3 $T",
+    "sett 0",
+    "divv $D 0 $C",
+    "lmvv $L 2 $D",
+    "comp $D <= $L",
+]
+
+
+CORES = [emulator.LegacyCore, emulator.DispatchCore, emulator.BlockCore]
+
+HALT = [
+    "setv $D 3",
+    "setv $C 1",
+    "getl $A halt",
+    "label halt",
+    "jump $A $C",
+    "setv $D 4",
+]
+
+
+def run_legacy(source: List[str]) -> emulator.VM:
+    vm = emulator.VM()
+    emulator.LegacyCore(vm, emulator.Program(assemble(source))).run()
+    return vm
+
+
+@pytest.mark.parametrize("core", [emulator.DispatchCore, emulator.BlockCore])
+def test_core_loop(core: Type[emulator.DispatchCore]):
+    vm = emulator.VM()
+    steps = core(vm, emulator.Program(assemble(SUM_LOOP))).run()
+    assert vm.memory[100] == 55
+    assert steps == 4 + 10 * 8 + 3
+
+
+@pytest.mark.parametrize("core", [emulator.DispatchCore, emulator.BlockCore])
+def test_core_matches_legacy(core: Type[emulator.DispatchCore]):
+    expected = run_legacy(STRAIGHT_LINE)
+    vm = emulator.VM()
+    core(vm, emulator.Program(assemble(STRAIGHT_LINE))).run()
+    assert vm.registers == expected.registers
+    assert vm.rT == expected.rT
+    assert (vm.temp_value, vm.temp_bits) == (expected.temp_value, expected.temp_bits)
+    assert vm.memory[1000] == expected.memory[1000] == -2147483648
+    assert vm.rT[3] == 21
+
+
+def test_block_core_jump_into_block():
+    # the loop label sits in the middle of the block that starts at pointer 0
+    vm = emulator.VM()
+    core = emulator.BlockCore(vm, emulator.Program(assemble(SUM_LOOP)))
+    core.run()
+    assert vm.memory[100] == 55
+    assert sorted(core.blocks) == [0, 8, 24]
+
+
+def test_paged_memory():
+    memory = emulator.PagedMemory()
+    assert memory.read(2147483647) == 0
+    assert memory.pages == {}
+    memory.write(-2147483648, 5)
+    memory.write(2147483647, -1)
+    memory.write(3, 7)
+    assert memory.read(-2147483648) == 5
+    assert memory.read(2147483647) == -1
+    assert len(memory.pages) == 3
+    assert memory.items() == [(-2147483648, 5), (3, 7), (2147483647, -1)]
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_halt_on_jump_to_itself(core: Type[emulator.DispatchCore]):
+    vm = emulator.VM()
+    steps = core(vm, emulator.Program(assemble(HALT))).run()
+    assert vm.registers[2] == 3
+    assert vm.pointer == 12
+    assert steps == 7
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_ring_trace(core: Type[emulator.DispatchCore]):
+    trace = emulator.Trace("ring", 3)
+    vm = emulator.VM()
+    steps = core(vm, emulator.Program(assemble(SUM_LOOP))).run(trace)
+    assert len(trace.records) == 3
+    assert trace.records[-1][0] == steps
+    assert trace.records[-1][3] == tuple(vm.registers)
+
+
+def test_halt_instruction():
+    vm = emulator.VM()
+    steps = emulator.DispatchCore(vm, emulator.Program(assemble(["setv $D 3", "halt", "setv $D 4"]))).run()
+    assert vm.registers[2] == 3
+    assert steps == 7
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_profile(core: Type[emulator.DispatchCore]):
+    symbols: Dict[str, int] = {}
+    program = emulator.Program(assemble(["label main.main"] + SUM_LOOP[:2] + ["label math.sum"] + SUM_LOOP[2:], symbols))
+    profile = emulator.Profile(program)
+    steps = core(emulator.VM(), program).run(None, profile)
+    assert profile.total() == steps
+    assert profile.by_label(symbols) == {"math.sum": 85, "main.main": 6}
+    assert profile.by_opcode()["jump"] == 10
+    assert profile.by_address()[symbols["loop"]] == 10
+
+
+@pytest.mark.parametrize("core", CORES[1:])
+def test_snapshot_restore(tmp_path, core: Type[emulator.DispatchCore]):
+    path = str(tmp_path / "state.snap")
+    vm = emulator.VM()
+    vm.memory[70000] = -5
+    vm.rT[3] = 9
+    core(vm, emulator.Program(assemble(SUM_LOOP))).run()
+    vm.snapshot(path)
+    restored = emulator.VM()
+    restored.restore(path)
+    assert dict(restored.memory.items()) == dict(vm.memory.items())
+    assert (restored.registers, restored.rT, restored.pointer) == (vm.registers, vm.rT, vm.pointer)
+    # restored pages are copy-on-write, running again must not change the file
+    restored.pointer = 0
+    core(restored, emulator.Program(assemble(["setv $A 100", "addv $M 1 $M"]))).run()
+    assert restored.memory[100] == 56
+    again = emulator.VM()
+    again.restore(path)
+    assert again.memory[100] == 55
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_step_budget(core: Type[emulator.DispatchCore]):
+    vm = emulator.VM()
+    runner = core(vm, emulator.Program(assemble(SUM_LOOP)))
+    budgets = []
+    while not runner.halted:
+        budgets.append(runner.run(max_steps=5))
+    assert budgets == [5] * 17 + [2]
+    assert vm.memory[100] == 55
+
+
+def test_machine_resume():
+    machine = emulator.Machine.load(assemble(SUM_LOOP + HALT))
+    result = machine.run(max_steps=50, memory=[100])
+    assert (result.reason, result.steps, result.memory) == ("steps", 50, {100: 0})
+    result = machine.run(memory=range(100, 102))
+    assert (result.reason, result.total, result.memory) == ("halt", 87 + 7, {100: 55, 101: 0})
+    assert machine.run().steps == 0
+    assert emulator.Machine.load(assemble(SUM_LOOP), "legacy").run().reason == "exit"
+
+
+def test_machine_deadline():
+    machine = emulator.Machine.load(assemble(["label a", "getl $A a", "setv $C 1", "jump $A $C"]), "dispatch")
+    machine.slice = 100
+    assert machine.run(deadline=0).reason == "deadline"
+    result = machine.run(deadline=emulator.monotonic() + 0.05)
+    assert result.reason == "deadline" and result.steps % 100 == 0 and result.steps > 0
+
+
+def test_superinstructions_jump_into_idiom():
+    source = ["setv $P 50", "setv $D 7", "setv $L 2"]
+    source += ["copy $P $A", "label mid", "copy $D $M", "inpv 1", "addr $P $V $P"]  # push $D
+    source += ["subv $L 1 $L", "setv $A 80", "getl $T mid", "inpv 0", "comp $L > $V", "jump $T $C"]
+    program = emulator.Program(assemble(source))
+    vm = emulator.VM()
+    core = emulator.DispatchCore(vm, program)
+    assert core.idioms == {"setv": 5, "push": 1, "opv": 1}
+    assert list(core.lengths[6:10]) == [4, 1, 1, 1]
+    steps = core.run()
+    legacy = emulator.VM()
+    assert steps == emulator.LegacyCore(legacy, program).run()
+    assert dict(vm.memory.items()) == dict(legacy.memory.items()) == {50: 7, 80: 7}
+    assert vm.registers == legacy.registers
+
+
+ECHO = ["call input 0", "call input 0", "call print 1", "pop $D", "call print 1", "pop $D", "halt"]
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_console(core: Type[emulator.DispatchCore]):
+    output = StringIO()
+    console = emulator.Console(output, StringIO("12\n  -3 x"))
+    vm = emulator.VM()
+    vm.memory.map(assembler.CONSOLE_BASE, console)
+    core(vm, emulator.Program(assembler.assemble(ECHO))).run()
+    # buffered until the end of the run
+    assert output.getvalue() == ""
+    vm.memory.flush()
+    assert output.getvalue() == "-3\n12\n"
+    assert vm.memory.pages[assembler.CONSOLE_BASE >> emulator.PAGE_BITS] is console
+    assert all(address < assembler.CONSOLE_BASE for address, _ in vm.memory.items())
+    assert console.read_char() == ord(" ") and console.read_char() == ord("x")
+    assert console.read_char() == -1 and console.read_int() == 0
+
+
+def peephole(source: List[str], rules: Optional[List[assembler.PeepholeRule]] = None) -> Tuple[List[str], Dict[str, int]]:
+    counts: Dict[str, int] = {}
+    return list(assembler.unparse(assembler.peephole(assembler.parse(source), rules, counts))), counts
+
+
+SHAPES = """
+class main {
+    function void main(pass) {
+        var int a = 3;
+        do print(main.square(a) + main.square(4));
+        do main.show(a, 7);
+        var pair p = pair.new(2, 5);
+        do print(p.sub(pass));
+        return;
+    }
+    function int square(int x) {
+        var int y = x * x;
+        return y;
+    }
+    function void show(int u, int v) {
+        do print(u * 10 + v);
+        return;
+    }
+}
+class pair {
+    constructor pair new(int x0, int y0) {
+        attr int x = x0;
+        attr int y = y0;
+        return self;
+    }
+    method int sub(pass) {
+        return self.x - self.y;
+    }
+}
+"""
+
+
+@pytest.mark.parametrize("level", [0, 1])
+@pytest.mark.parametrize("core", list(emulator.cores))
+def test_compiled_program(tmp_path, core: str, level: int):
+    # calls with arguments and locals, nested calls, a constructor and a method, printing from inside subroutines
+    image = assembler.assemble("\n".join(compile_nj(tmp_path, SHAPES)).split("\n"), level=level)
+    output = StringIO()
+    vm = emulator.VM()
+    vm.memory.map(assembler.CONSOLE_BASE, emulator.Console(output))
+    assert emulator.Machine.load(image, core, vm).run(max_steps=100000).reason == "halt"
+    assert output.getvalue() == "25\n37\n-3\n"
+    # every call left its frame
+    assert vm.registers[3] == vm.registers[5] == emulator.STACK_BASE
+
+
+def test_peephole_rules():
+    # push $D, pop $D
+    code, counts = peephole(list(assembler.unparse(assembler.assembler0(assembler.parse(["push $D", "pop $D"]), "test"))))
+    assert code == ["stor @P $D"]
+    assert counts == {"cancel offset": 1, "reload": 1}
+    source = ["sett 7", "sett 0", "addv $L 0 $D", "load @T $D", "stor @T $D", "copy $T $T", "setl a", "sett 1"]
+    code, counts = peephole(source)
+    assert code == ["sett 0", "copy $L $D", "load @T $D", "setl a", "sett 1"]
+    assert counts == {"sett twice": 1, "zero offset": 1, "store back": 1, "self copy": 1}
+    # a custom rule table
+    drop = ("drop sett", 1, lambda w: [] if w[0][0] == "sett" else None)
+    assert peephole(["sett 7", "copy $L $T", "sett 0"], [drop]) == (["copy $L $T"], {"drop sett": 2})
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_peephole_same_result(core: Type[emulator.DispatchCore]):
+    for source in (STRAIGHT_LINE, ECHO):
+        results = []
+        for level in (0, 1):
+            vm = emulator.VM()
+            vm.memory.map(assembler.CONSOLE_BASE, emulator.Console(StringIO(), StringIO("12 -3")))
+            steps = core(vm, emulator.Program(assembler.assemble(source, level=level))).run()
+            # $A and $V are scratch registers
+            results.append(([vm.registers[i] for i in (1, 2, 3, 4, 5, 6)], list(vm.rT), vm.memory.items(), steps))
+        assert results[0][:3] == results[1][:3]
+        assert results[1][3] < results[0][3]
+
+
+def test_console_buffer():
+    output = StringIO()
+    console = emulator.Console(output, StringIO("7\n"), limit=4)
+    memory = emulator.PagedMemory()
+    memory.map(assembler.CONSOLE_BASE, console)
+    memory[assembler.CONSOLE_BASE + assembler.CONSOLE_CHAR] = ord("a")
+    memory[assembler.CONSOLE_BASE + assembler.CONSOLE_INT] = 12
+    assert output.getvalue() == ""
+    memory[assembler.CONSOLE_BASE + assembler.CONSOLE_INT] = -5
+    assert output.getvalue() == "a12-5"
+    memory[assembler.CONSOLE_BASE + assembler.CONSOLE_CHAR] = ord("?")
+    # reading input flushes the pending prompt first
+    assert memory[assembler.CONSOLE_BASE + assembler.CONSOLE_INT] == 7
+    assert output.getvalue() == "a12-5?"
+    memory[assembler.CONSOLE_BASE + assembler.CONSOLE_CHAR] = ord("!")
+    memory[assembler.CONSOLE_BASE + assembler.CONSOLE_FLUSH] = 0
+    assert output.getvalue() == "a12-5?!"
+
+
+HOST_CALLS = ["setv $P 500", "push 17", "push 5", "call math.mod 2", "push 84", "push 36", "call math.gcd 2", "push -3", "push 5", "call math.pow 2", "halt"]
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_host_trap(core: Type[emulator.DispatchCore]):
+    source = list(assembler.unparse(assembler.preprocess(assembler.parse(HOST_CALLS))))
+    assert [i for i in source if i.startswith("trap")] == ["trap 0", "trap 1", "trap 2"]
+    vm = emulator.VM()
+    steps = core(vm, emulator.Program(assemble(source))).run()
+    assert [vm.memory[i] for i in range(500, 503)] == [2, 12, -243]
+    assert vm.registers[5] == 503
+    assert steps == 2 + 6 * 5 + 3 + 5
+
+
+def test_trap_encoding():
+    asm = assembler.assembler2(assembler.parse(["trap 4095", "trap 1"]), "test")
+    assert asm == bytes([0b11111111, 0b11111110, 0b11100000, 0b00000010])
+    assert assembler.asmtovm("1111111111111110" + "1110000000000010", "test") == ["trap 4095", "trap 1"]
+    vm = emulator.VM()
+    with pytest.raises(Exception, match="Unknown host function 4095"):
+        emulator.LegacyCore(vm, emulator.Program(assemble(["trap 4095"]))).run()
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_far_labels(core: Type[emulator.DispatchCore]):
+    # the jump to `far` and the one back both need exte words, which move every label after them
+    source = ["getl $D far", "setv $C 1", "jump $D $C", "label back", "setv $L 7", "halt"] + ["copy $D $P"] * 1500
+    source += ["label far", "setv $D 42", "getl $A back", "setv $C 1", "jump $A $C"]
+    symbols: Dict[str, int] = {}
+    asm = assemble(source, symbols)
+    vm = emulator.VM()
+    core(vm, emulator.Program(asm)).run()
+    assert (vm.registers[2], vm.registers[3]) == (42, 7)
+    assert symbols["back"] == 12
+    assert symbols["far"] == len(asm) - 2 * 7
+
+
+ALLOC_FREE = ["setv $P 500", "push 3", "call built_in.alloc 1", "push 5", "call built_in.alloc 1", "push 3", "call system.alloc 1"]
+ALLOC_FREE += ["pop $D", "stor @D $P", "push $D", "push $D", "call system.free 1", "pop $D", "push 4", "call built_in.alloc 1", "halt"]
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_alloc_free(core: Type[emulator.DispatchCore]):
+    vm = emulator.VM()
+    core(vm, emulator.Program(assembler.assemble(ALLOC_FREE))).run()
+    first = HEAP_BASE + HEAP_HEADER + 1
+    # blocks of 4, 8 and 4 words, the last one freed and handed out again zeroed
+    assert [vm.memory[i] for i in range(500, 504)] == [first, first + 5, first + 14, first + 14]
+    assert vm.registers[5] == 504
+    assert vm.memory[first + 14] == 0 and vm.memory[first + 13] == 2
+    assert vm.memory[HEAP_BASE] == first + 18
+    assert vm.memory[HEAP_BASE + 1 + 2] == 0
+
+
+def test_free_errors():
+    vm = emulator.VM()
+    address = emulator.host_trap[3][1](vm, 1)
+    emulator.host_trap[4][1](vm, address)
+    with pytest.raises(Exception, match="Double free"):
+        emulator.host_trap[4][1](vm, address)
+    with pytest.raises(Exception, match="Invalid free"):
+        emulator.host_trap[4][1](vm, 12)
+    assert emulator.host_trap[3][1](vm, -1) == -1
+
+
+def test_bulk_copy_fill():
+    memory = emulator.PagedMemory()
+    start = emulator.PAGE_SIZE - 3
+    memory.fill(start, 5, 6)
+    assert memory.items() == [(start + i, 5) for i in range(6)]
+    for i in range(6):
+        memory[start + i] = i + 1
+    # overlapping ranges across a page boundary behave like memmove
+    memory.copy(start + 2, start, 6)
+    assert [memory[start + i] for i in range(8)] == [1, 2, 1, 2, 3, 4, 5, 6]
+    memory.copy(start, start + 2, 6)
+    assert [memory[start + i] for i in range(8)] == [1, 2, 3, 4, 5, 6, 5, 6]
+    # untouched pages read as zeros without being allocated
+    memory.copy(100, 1 << 20, 3)
+    assert (1 << 20) >> emulator.PAGE_BITS not in memory.pages
+    memory.copy(100, 200, 0)
+    memory.fill(100, 9, -1)
+    assert memory[100] == 0
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_copy_fill_trap(core: Type[emulator.DispatchCore]):
+    source = ["setv $P 500", "push 600", "push 7", "push 10", "call arr.fill 3", "push 700", "push 605", "push 10", "call arr.copy 3", "halt"]
+    vm = emulator.VM()
+    steps = core(vm, emulator.Program(assembler.assemble(source))).run()
+    assert [vm.memory[i] for i in range(700, 711)] == [7] * 5 + [0] * 6
+    assert vm.registers[5] == 502
+    assert steps == 2 + 6 * 5 + 2 + 5
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_modulo_expansion(core: Type[emulator.DispatchCore]):
+    pairs = [(17, 5), (-7, 3), (7, -3), (-2147483648, 7)]
+    source = ["setv $P 500"]
+    for a, b in pairs:
+        source += [f"push {a}", f"push {b}", "call built_in.mod 2"]
+    vm = emulator.VM()
+    core(vm, emulator.Program(assembler.assemble(source + ["halt"]))).run()
+    assert [vm.memory[500 + i] for i in range(len(pairs))] == [emulator.modulo(a, b) for a, b in pairs] == [2, 2, -2, 5]
+
+
+def test_collect():
+    vm = emulator.VM()
+    a, b, c = alloc(vm, 2), alloc(vm, 2), alloc(vm, 5)
+    vm.memory[a + 1] = c
+    vm.memory[100] = a
+    assert collect(vm) == 1
+    # b went back to its free list and is handed out again
+    assert alloc(vm, 2) == b and vm.memory[b - 1] == 1
+    vm.memory[100] = 0
+    vm.registers[2] = b
+    assert collect(vm) == 2
+    assert vm.memory[c - 1] == ~3 and vm.memory[b - 1] == 1
+    vm.collect = False
+    vm.registers[2] = 0
+    assert collect(vm) == 0
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_gc_trap(core: Type[emulator.DispatchCore]):
+    # the second block is only referenced by a stack slot that gets overwritten
+    source = ["setv $P 500", "push 3", "call built_in.alloc 1", "push 3", "call built_in.alloc 1", "pop $D"]
+    source += ["push 0", "pop $D", "call system.gc 0", "halt"]
+    vm = emulator.VM()
+    core(vm, emulator.Program(assembler.assemble(source))).run()
+    first = HEAP_BASE + HEAP_HEADER + 1
+    assert vm.memory[501] == 1
+    assert (vm.memory[first - 1], vm.memory[first + 4]) == (2, ~2)
+
+
+@pytest.mark.parametrize("core", CORES)
+def test_gc_register_root(core: Type[emulator.DispatchCore]):
+    # the only pointer to the block is in $L when the collection runs
+    source = ["push 3", "call built_in.alloc 1", "pop $D", "copy $D $L", "push 0", "pop $C", "call system.gc 0", "halt"]
+    vm = emulator.VM()
+    core(vm, emulator.Program(assembler.assemble(source))).run()
+    first = HEAP_BASE + HEAP_HEADER + 1
+    assert vm.registers[3] == first
+    assert vm.memory[first - 1] == 2
+
+
+def test_alloc_collects():
+    vm = emulator.VM()
+    kept = alloc(vm, 1000)
+    vm.memory[100] = kept
+    for _ in range(1000):
+        alloc(vm, 1000)
+    # garbage is reclaimed instead of growing the heap by a million words
+    assert vm.memory[HEAP_BASE] < HEAP_BASE + 3 * HEAP_GC_SPACE
+    assert vm.memory[kept - 1] == 10
+    # a block bigger than the space between two collections collects once and grows the heap
+    big = alloc(vm, 2 * HEAP_GC_SPACE)
+    assert big > 0 and vm.memory[big - 1] == 19
+    vm.memory[101] = big
+    assert alloc(vm, 2 * HEAP_GC_SPACE) == big + (1 << 19) + 1
+
+
+# two workers append their argument to the log at 900 (next free slot in 899) three times, yielding after each entry
+GREEN_THREADS = ["setv $P 500", "setv $D 900", "setv $C 899", "stor @C $D"]
+GREEN_THREADS += ["getl $D worker", "push $D", "push 1", "call system.spawn 2", "getl $D worker", "push $D", "push 2", "call system.spawn 2"]
+GREEN_THREADS += ["call system.yield 0", "halt"]
+GREEN_THREADS += ["label worker", "sett 1", "setv $T 3", "label worker_loop", "setv $D 899", "load @D $C", "load @L $D", "stor @C $D"]
+GREEN_THREADS += ["addv $C 1 $C", "setv $D 899", "stor @D $C", "call system.yield 0", "subv $T 1 $T"]
+GREEN_THREADS += ["inpv 0", "comp $T != $V", "getl $D worker_loop", "jump $D $C", "halt"]
+
+
+@pytest.mark.parametrize("core", list(emulator.cores))
+def test_scheduler_yield(core: str):
+    scheduler = emulator.Scheduler(emulator.Program(assembler.assemble(GREEN_THREADS)), core)
+    scheduler.run()
+    vm = scheduler.vm
+    assert [vm.memory[i] for i in range(900, 906)] == [1, 2, 1, 2, 1, 2]
+    assert (vm.memory[500], vm.memory[501]) == (1, 2)
+    assert [i.number for i in scheduler.done] == [0, 1, 2]
+    assert not scheduler.tasks and len(scheduler.free) == (scheduler.end - scheduler.base) // scheduler.stack_size
+
+
+@pytest.mark.parametrize("core", list(emulator.cores))
+def test_scheduler_time_slice(core: str):
+    # a quantum of one instruction switches inside every inpv/exte chain, the rT banks keep the loop counters apart
+    source = ["setv $P 500", "getl $D worker", "push $D", "push 1", "call system.spawn 2", "getl $D worker", "push $D", "push 2"]
+    source += ["call system.spawn 2", "halt", "label worker", "sett 1", "setv $T 3", "label worker_loop", "load @L $D"]
+    source += ["addv $D 100000 $D", "load @D $C", "addv $C 1 $C", "stor @D $C", "subv $T 1 $T"]
+    source += ["inpv 0", "comp $T != $V", "getl $D worker_loop", "jump $D $C", "halt"]
+    scheduler = emulator.Scheduler(emulator.Program(assembler.assemble(source)), core, quantum=1)
+    steps = scheduler.run()
+    assert (scheduler.vm.memory[100001], scheduler.vm.memory[100002]) == (3, 3)
+    assert steps == sum(i.steps for i in scheduler.done)
+    # a task that never yields is still preempted
+    source = ["setv $P 500", "getl $D worker", "push $D", "push 7", "call system.spawn 2", "label spin", "setv $C 1", "getl $D spin", "jump $D $C"]
+    source += ["label worker", "load @L $D", "setv $C 950", "stor @C $D", "halt"]
+    scheduler = emulator.Scheduler(emulator.Program(assembler.assemble(source)), core, quantum=100)
+    assert scheduler.run(5000) == 5000
+    assert scheduler.vm.memory[950] == 7
+    assert [i.number for i in scheduler.tasks] == [0]
+
+
+@pytest.mark.parametrize("core", list(emulator.cores))
+def test_scheduler_task_returns(core: str):
+    # compiled functions end with `return`, which ends the task instead of running the program again
+    source = ["setv $P 500", "getl $D worker", "push $D", "push 7", "call system.spawn 2", "pop $T", "halt"]
+    source += ["label worker", "load @L $D", "setv $C 950", "stor @C $D", "push 0", "return"]
+    scheduler = emulator.Scheduler(emulator.Program(assembler.assemble(source)), core)
+    scheduler.run(20000)
+    assert scheduler.vm.memory[950] == 7
+    assert not scheduler.tasks and [i.number for i in scheduler.done] == [0, 1]
+
+
+def test_spawn_needs_scheduler():
+    vm = emulator.VM()
+    program = emulator.Program(assembler.assemble(["setv $P 500", "push 0", "push 0", "call system.spawn 2", "call system.yield 0", "halt"]))
+    with pytest.raises(Exception, match="system.spawn needs a scheduler"):
+        emulator.BlockCore(vm, program).run()
+    vm = emulator.VM()
+    program = emulator.Program(assembler.assemble(["setv $P 500", "call system.yield 0", "halt"]))
+    assert emulator.Machine(program, "dispatch", vm).run().reason == "halt"
+    assert vm.memory[500] == 0
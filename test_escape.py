@@ -0,0 +1,98 @@
+from io import StringIO
+from typing import List, Tuple
+
+from assembler import CONSOLE_BASE
+from built_in.built_in import HEAP_BASE, HEAP_HEADER
+from compiler.AST import Class, DeclareVar
+from compiler.escape import EscapeAnalysis
+from compiler.lib import Args, read_source, type_class
+from compiler.main import analyze_file, compile_all_file
+from emulator import Console
+from interpreter import Interpreter
+
+POINT = """
+class main {
+    function void main(pass) {
+        var int total = 0;
+        for (i, 0, 10, 1) {
+            var point p = point.new(i, 2);
+            var point q = point.new(3, i);
+            let total = total + p.sum(pass) + point.dot(p, q);
+        }
+        var point r = point.new(1, 1);
+        global point g = point.new(5, 5);
+        do print(total + r.sum(pass) + g.sum(pass));
+        return;
+    }
+    function point keep(int x) {
+        var point k = point.new(x, x);
+        return k;
+    }
+    function void store(pass) {
+        var point s = point.new(1, 2);
+        var list l = list.new(pass);
+        do point.hold(l, s);
+        return;
+    }
+}
+class point {
+    constructor point new(int x0, int y0) {
+        attr int x = x0;
+        attr int y = y0;
+        return self;
+    }
+    method int sum(pass) {
+        return self.x + self.y;
+    }
+    function int dot(point a, point b) {
+        return a.x * b.x + a.y * b.y;
+    }
+    function void hold(list l, point p) {
+        do l.append(p);
+        return;
+    }
+}
+"""
+
+
+def parse(tmp_path) -> Tuple[List[Class], List[DeclareVar]]:
+    """The same steps as compiler/main.py, for point.nj with system.nj and list.nj."""
+    path = tmp_path / "point.nj"
+    path.write_text(POINT)
+    classes: List[Class] = []
+    global_: List[DeclareVar] = []
+    for i in (str(path), "built_in/system.nj", "built_in/list.nj"):
+        root = analyze_file(read_source(i), Args(), i, [])
+        classes.extend(root.class_list)
+        global_.extend(root.global_)
+    for i in classes:
+        global_.append(DeclareVar(i.name, "class", type_class))
+        global_.extend(i.attr_list)
+        for j in i.subroutine_list:
+            global_.append(DeclareVar(j.name, j.kind, j.return_type))  # type: ignore
+    return classes, global_
+
+
+def test_frame_objects(tmp_path):
+    analysis = EscapeAnalysis(parse(tmp_path)[0])
+    assert analysis.frame["main.main"] == {"p": "point", "q": "point", "r": "point"}
+    assert analysis.frame["main.keep"] == {}
+    assert analysis.frame["main.store"] == {"l": "list"}
+    assert analysis.escapes["point.dot"] == [False, False]
+    assert analysis.escapes["point.hold"] == [False, True]
+
+
+def test_frame_objects_skip_alloc(tmp_path):
+    classes, global_ = parse(tmp_path)
+    errout: List[str] = []
+    code = compile_all_file(classes, global_, Args(), {}, errout)
+    assert errout == []
+    code = ["call system.init 0", "pop $T", "call main.main 0", "pop $T", "halt"] + code
+    interpreter = Interpreter("\n".join(code).split("\n"))
+    output = StringIO()
+    interpreter.vm.memory.map(CONSOLE_BASE, Console(output))
+    interpreter.run()
+    interpreter.vm.memory.flush()
+    assert output.getvalue() == "302\n"
+    # only the global g reached the heap: one header word and its two attributes
+    assert interpreter.vm.memory[HEAP_BASE] == HEAP_BASE + HEAP_HEADER + 3
@@ -0,0 +1,124 @@
+from io import StringIO
+
+import pytest
+
+from assembler import CONSOLE_BASE
+from built_in.built_in import HEAP_HEADER, collect
+from compiler.lib import CompileError
+from emulator import Console
+from interpreter import FRAME_BASE, HEAP_BASE, Interpreter
+
+# fact(6) into global 0, then 100 - 58 into global 1, written the way compiler/Compiler.py emits it
+FACT = """
+call main.main 0
+pop $T
+halt
+label main.main
+push 6
+call main.fact 1
+inpv 0
+pop @V 0
+push 100
+push 58
+call built_in.sub 2
+inpv 0
+pop @V 1
+push 0
+return
+label main.fact
+push @L 0
+push 2
+call built_in.lt 2
+goto if_false_0 false
+push 1
+return
+label if_false_0
+push @L 0
+push @L 0
+push 1
+call built_in.sub 2
+call main.fact 1
+call built_in.mul 2
+return
+""".splitlines()
+
+
+def test_call_return():
+    interpreter = Interpreter(FACT)
+    steps = interpreter.run()
+    assert interpreter.halted and interpreter.pointer == -1
+    assert (interpreter.vm.memory[0], interpreter.vm.memory[1]) == (720, 42)
+    assert interpreter.stack == [] and interpreter.calls == []
+    assert interpreter.frames == {"main.main": 0, "main.fact": 1}
+    # one frame word per nested fact call
+    assert [interpreter.vm.memory[FRAME_BASE + i] for i in range(6)] == [6, 5, 4, 3, 2, 1]
+    assert steps == 75
+
+
+def test_step_budget():
+    interpreter = Interpreter(FACT)
+    assert interpreter.run(50) == 50 and not interpreter.halted
+    assert interpreter.run() == 25 and interpreter.halted
+    assert interpreter.vm.memory[0] == 720
+
+
+def test_locals_and_alloc():
+    source = """
+    push 3
+    call built_in.alloc 1
+    pop $D
+    push 7
+    pop @D 2
+    push $D 2
+    pop $T
+    push @T
+    push 5
+    call built_in.add 2
+    pop @D 0
+    setv $A 9
+    push $A
+    """.splitlines()
+    interpreter = Interpreter(source)
+    interpreter.run()
+    block = HEAP_BASE + HEAP_HEADER + 1
+    assert interpreter.vm.memory[block + 2] == 7
+    assert interpreter.vm.memory[block] == 12
+    assert interpreter.stack == [9]
+    # three words round up to a block of four after its header
+    assert interpreter.vm.memory[HEAP_BASE] == block + 4
+
+
+@pytest.mark.parametrize("line", ["goto nowhere all", "push $X", "pop 3", "frobnicate"])
+def test_compile_error(line: str):
+    with pytest.raises(CompileError) as e:
+        Interpreter(["push 1", line])
+    assert e.value.line == 1
+
+
+def test_console():
+    output = StringIO()
+    interpreter = Interpreter(["call input 0", "call input 0", "call built_in.mul 2", "call print 1", "pop $D", "halt"])
+    interpreter.vm.memory.map(CONSOLE_BASE, Console(output, StringIO("6 7\n")))
+    interpreter.run()
+    interpreter.vm.memory.flush()
+    assert output.getvalue() == "42\n"
+    assert interpreter.stack == []
+
+
+def test_host_function():
+    interpreter = Interpreter(["push 3", "push 5", "call math.pow 2", "push 10", "call math.mod 2", "inpv 0", "pop @V 0", "halt"])
+    assert interpreter.run() == 8
+    assert interpreter.vm.memory[0] == 3
+
+
+def test_modulo():
+    interpreter = Interpreter(["push -7", "push 3", "call built_in.mod 2", "push 5", "push 0", "call built_in.mod 2", "halt"])
+    interpreter.run()
+    assert interpreter.stack == [2, 5]
+
+
+def test_collect_sees_operand_stack():
+    interpreter = Interpreter(["push 1", "call built_in.alloc 1", "push 1", "call built_in.alloc 1", "pop $D", "push 0", "pop $D", "halt"])
+    interpreter.run()
+    assert collect(interpreter.vm) == 1
+    assert interpreter.vm.memory[interpreter.stack[0] - 1] == 0
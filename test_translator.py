@@ -0,0 +1,161 @@
+import os
+from io import StringIO
+from typing import List
+
+import pytest
+
+import translator
+from assembler import CONSOLE_BASE
+from built_in.built_in import HEAP_BASE, HEAP_HEADER
+from compiler.AST import DeclareVar
+from compiler.lib import Args, CompileError, read_source, type_class
+from compiler.main import analyze_file, compile_all_file
+from emulator import VM, Console
+from interpreter import Interpreter
+from test_interpreter import FACT
+
+# a loop, a nested if and values left on the stack across a label
+LOOP = """
+push 0
+pop @V 0
+push 0
+pop @L 0
+label loop
+push @L 0
+push 7
+call built_in.mul 2
+push @V 0
+call built_in.add 2
+pop @V 0
+push @L 0
+push 1
+call built_in.add 2
+pop @L 0
+push @L 0
+push 10
+call built_in.lt 2
+goto loop true
+push 5
+push 6
+label tail
+call built_in.sub 2
+pop @V 1
+push 3
+call built_in.alloc 1
+pop $D
+push $D 1
+pop $T
+push 9
+pop @T
+halt
+""".splitlines()
+
+
+def compile_nj(tmp_path, text: str) -> List[str]:
+    """The .vm code compiler/main.py makes of `text` with system.nj."""
+    path = tmp_path / "main.nj"
+    path.write_text(text)
+    classes, global_ = [], []
+    for i in (str(path), "built_in/system.nj"):
+        root = analyze_file(read_source(i), Args(), i, [])
+        classes.extend(root.class_list)
+        global_.extend(root.global_)
+    for i in classes:
+        global_.append(DeclareVar(i.name, "class", type_class))
+        global_.extend(i.attr_list)
+        for j in i.subroutine_list:
+            global_.append(DeclareVar(j.name, j.kind, j.return_type))  # type: ignore
+    errout: List[str] = []
+    code = compile_all_file(classes, global_, Args(), {}, errout)
+    assert errout == []
+    return ["call system.init 0", "pop $T", "call main.main 0", "pop $T", "halt"] + code
+
+
+def run_both(source):
+    interpreter = Interpreter(source)
+    interpreter.run()
+    namespace = {}
+    exec(compile(translator.translate(source), "<translated>", "exec"), namespace)
+    vm = VM()
+    namespace["run"](vm)
+    return interpreter.vm, vm
+
+
+@pytest.mark.parametrize("source", [FACT, LOOP])
+def test_matches_interpreter(source):
+    expected, vm = run_both(source)
+    # frames of subroutines translated to Python locals never reach memory
+    assert [i for i in vm.memory.items() if i[0] < 1 << 20] == [i for i in expected.memory.items() if i[0] < 1 << 20]
+    assert vm.registers[:3] == expected.registers[:3]
+
+
+# add has no return statement, it must not run on into twice
+FALL_THROUGH = """
+class main {
+    function void main(pass) {
+        global int total = 0;
+        do main.add(3);
+        do main.add(4);
+        return;
+    }
+    function void add(int x) {
+        let total = total * 10 + x;
+    }
+    function void twice(pass) {
+        let total = total * 2;
+        return;
+    }
+}
+"""
+
+
+def test_compiled_void_function(tmp_path):
+    expected, vm = run_both(compile_nj(tmp_path, FALL_THROUGH))
+    assert vm.memory[0] == expected.memory[0] == 34
+    assert [i for i in vm.memory.items() if i[0] < 1 << 20] == [i for i in expected.memory.items() if i[0] < 1 << 20]
+
+
+def test_loop_result():
+    _, vm = run_both(LOOP)
+    assert (vm.memory[0], vm.memory[1], vm.memory[HEAP_BASE + HEAP_HEADER + 2]) == (315, -1, 9)
+
+
+def test_cached_module(tmp_path):
+    path = str(tmp_path / "fact.vm")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(FACT))
+    vm = VM()
+    translator.load(path).run(vm)
+    assert vm.memory[0] == 720
+    target = translator.module_path(path)
+    stamp = os.stat(target).st_mtime_ns
+    translator.load(path)
+    assert os.stat(target).st_mtime_ns == stamp
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(FACT).replace("push 6", "push 5"))
+    vm = VM()
+    translator.load(path).run(vm)
+    assert vm.memory[0] == 120
+
+
+@pytest.mark.parametrize("source", [["label a", "getl $A a", "jump $A $C"], ["goto f.end all", "label f.g", "label f.end"]])
+def test_unsupported(source):
+    with pytest.raises(CompileError):
+        translator.translate(source)
+
+
+def test_function_value():
+    with pytest.raises(CompileError, match="function values \\('main.worker'\\)"):
+        translator.translate(["getl $D main.worker", "push $D", "push 5", "call system.spawn 2", "halt", "label main.worker", "push 0", "return"])
+
+
+def test_console():
+    output = StringIO()
+    namespace = {}
+    source = ["call input 0", "push 2", "call built_in.sub 2", "call print 1", "pop $D", "halt"]
+    exec(compile(translator.translate(source), "<translated>", "exec"), namespace)
+    vm = VM()
+    vm.memory.map(CONSOLE_BASE, Console(output, StringIO("44")))
+    namespace["run"](vm)
+    vm.memory.flush()
+    assert output.getvalue() == "42\n"
@@ -0,0 +1,515 @@
+import importlib.util
+from hashlib import sha1
+from os.path import abspath, isfile
+from sys import argv
+from types import ModuleType
+from typing import Dict, List, Optional, Tuple
+
+from assembler import CONSOLE_BASE, CONSOLE_CHAR, CONSOLE_INT, error
+from built_in.built_in import host_function
+from compiler.lib import CompileError
+from emulator import VM, Console, read_source, wrap, write_source
+from interpreter import register
+
+# `call built_in.<name> 2` as Python source over the operands in push order, see interpreter.built_in
+binary_source = {
+    "add": "({a} + {b})",
+    "sub": "({a} - {b})",
+    "mul": "({a} * {b})",
+    "div": "divide({a}, {b})",
+    "mod": "modulo({a}, {b})",
+    "lm": "({a} << {b})",
+}
+plain_source = {"or": "({a} | {b})", "and": "({a} & {b})", "rm": "({a} >> {b})"}
+compare_source = {"eq": "==", "neq": "!=", "geq": ">=", "leq": "<=", "gt": ">", "lt": "<"}
+operation_source = {"add": "+", "sub": "-", "mul": "*", "rmv": ">>", "lmv": "<<", "and": "&", "or_": "|"}
+comp_source = {">": ">", "==": "==", ">=": ">=", "<": "<", "!=": "!=", "<=": "<="}
+
+HEADER = "# generated by translator.py from {file}, do not edit\n# source sha1: {digest}\n"
+
+
+class Value:
+    """
+    An entry of the operand stack while translating: a Python expression, whether evaluating it later
+    still gives the same result (constants and temporaries), and its condition form for goto if it is a comparison.
+    """
+
+    def __init__(self, source: str, pure: bool, condition: str = "") -> None:
+        self.source = source
+        self.pure = pure
+        self.condition = condition
+
+
+class Subroutine:
+    def __init__(self, name: str, index: int) -> None:
+        self.name = name
+        self.function = f"s{index}_" + "".join(i if i.isalnum() else "_" for i in name)
+        self.lines: List[Tuple[int, List[str]]] = []
+        self.arity = 0
+        self.size = 0
+        # keep the frame in memory (and $L in the register file) instead of Python locals
+        self.memory = False
+
+
+class Translator:
+    """
+    Translates a whole .vm program into the source of a Python module with the same runtime as interpreter.Interpreter.
+
+    Every subroutine (label containing ".") becomes one Python function taking its arguments as parameters,
+    the code before the first subroutine becomes `entry`. Inside a function:
+    - the frame slots @L k are Python locals l0, l1, ..., unless the subroutine takes the address of its frame
+      or touches $L with register instructions, in which case the frame is laid out in memory from FRAME_BASE as in the interpreter
+    - the operand stack is resolved at translation time into Python expressions, and only values still on it at
+      a label or goto are kept in the list `stack`
+    - the code between labels and gotos forms blocks, run by a `while True` loop where each block is guarded
+      by `if pc <= index`, so falling through to the next block needs no dispatch
+    jump and getl (machine addresses, including functions used as values) are not supported.
+    """
+
+    def __init__(self, source: List[str], file: str = "<vm>") -> None:
+        self.file = file
+        self.source = source
+        self.entry = Subroutine("entry", 0)
+        self.entry.function = "entry"
+        self.subroutines: Dict[str, Subroutine] = {}
+        # label -> (subroutine, block)
+        self.labels: Dict[str, Tuple[str, int]] = {}
+        self.code: List[str] = []
+        self.indent = 0
+        self.stack: List[Value] = []
+        self.temp = 0
+        self.known: Dict[int, int] = {}
+        self.now = self.entry
+        self.line = 0
+        self.header = 0
+        self.parse()
+
+    def parse(self) -> None:
+        now = self.entry
+        blocks = 0
+        for line, i in enumerate(self.source):
+            words = i.split()
+            if not words or words[0].startswith("//") or words[0].startswith("debug"):
+                continue
+            if words[0] in ("label", "setl"):
+                if len(words) != 2:
+                    error("Unknown format", self.file, line)
+                if "." in words[1]:
+                    now = self.subroutines[words[1]] = Subroutine(words[1], len(self.subroutines) + 1)
+                    blocks = 0
+                else:
+                    now.lines.append((line, words))
+                    blocks += 1
+                    self.labels[words[1]] = (now.name, blocks)
+                continue
+            now.lines.append((line, words))
+            if words[0] in ("goto", "return", "halt"):
+                blocks += 1
+            if words[0] == "getl" and len(words) == 3 and "." in words[2]:
+                # what the compiler emits for a function used as a value, like system.spawn(main.worker, 5)
+                error(f"function values ('{words[2]}') are not supported by the translator, run the program with the emulator", self.file, line)
+            if words[0] in ("jump", "getl", "exte"):
+                error(f"'{words[0]}' is not supported by the translator", self.file, line)
+            if words[0] in ("push", "pop") and len(words) >= 2 and words[1] in ("@L", "$L"):
+                slot = int(words[2]) if len(words) == 3 else 0
+                now.size = max(now.size, slot + 1)
+                if words[1] == "$L":
+                    now.memory = True
+            elif any(j in ("$L", "@L") for j in words[1:]):
+                now.memory = True
+        for subroutine in [self.entry] + list(self.subroutines.values()):
+            for line, words in subroutine.lines:
+                if words[0] == "call" and len(words) == 3 and words[1] in self.subroutines:
+                    callee = self.subroutines[words[1]]
+                    callee.arity = max(callee.arity, int(words[2]))
+        for subroutine in self.subroutines.values():
+            subroutine.size = max(subroutine.size, subroutine.arity)
+
+    def out(self, line: str) -> None:
+        self.code.append("    " * self.indent + line)
+
+    def new_temp(self) -> str:
+        self.temp += 1
+        return f"t{self.temp}"
+
+    def push(self, value: Value) -> None:
+        self.stack.append(value)
+
+    def pop(self) -> Value:
+        if self.stack:
+            return self.stack.pop()
+        name = self.new_temp()
+        self.out(f"{name} = stack.pop()")
+        return Value(name, True)
+
+    def spill(self) -> None:
+        """Evaluate every pending expression that reads state, before something writes to it."""
+        for i, value in enumerate(self.stack):
+            if not value.pure:
+                name = self.new_temp()
+                self.out(f"{name} = {value.source}")
+                self.stack[i] = Value(name, True, "")
+
+    def flush(self) -> None:
+        """Move the pending values to the runtime stack, at the end of a block."""
+        if self.stack:
+            self.out(f"stack.extend(({', '.join(i.source for i in self.stack)},))")
+            self.stack = []
+
+    def read(self, name: str) -> str:
+        return read_source(register[name])
+
+    def write(self, name: str, value: str) -> None:
+        key = register[name]
+        self.out(write_source(key, value))
+        self.known.pop(key, None)
+
+    def address(self, name: str, offset: int) -> str:
+        key = register[name]
+        if key in self.known:
+            return str(self.known[key] + offset)
+        return f"{self.read(name)} + {offset}" if offset else self.read(name)
+
+    def translate(self) -> str:
+        digest = sha1("".join(self.source).encode()).hexdigest()
+        self.code = [
+            HEADER.format(file=self.file, digest=digest),
+            "from interpreter import FRAME_BASE",
+            "from emulator import ZERO_PAGE, divide, modulo",
+            "from built_in.built_in import host_trap",
+            "",
+            "",
+            "class Stop(Exception):",
+            "    pass",
+            "",
+            "",
+            "def run(vm):",
+        ]
+        self.indent = 1
+        self.out("r, rT = vm.registers, vm.rT")
+        self.out("# frames kept in Python locals are invisible to the heap collector")
+        self.out("vm.collect = False")
+        self.out("pages, page = vm.memory.pages, vm.memory.page")
+        self.out("read, write = vm.memory.read, vm.memory.write")
+        self.out("# frame top")
+        self.out("state = [FRAME_BASE]")
+        self.out("r[3] = FRAME_BASE")
+        for subroutine in self.subroutines.values():
+            self.out("")
+            self.function(subroutine)
+        self.out("")
+        self.function(self.entry)
+        self.out("")
+        self.out("try:")
+        self.out("    entry()")
+        self.out("except Stop:")
+        self.out("    pass")
+        return "\n".join(self.code) + "\n"
+
+    def function(self, subroutine: Subroutine) -> None:
+        self.now = subroutine
+        self.temp = 0
+        parameters = ", ".join(f"l{i}=0" for i in range(subroutine.arity))
+        self.out(f"def {subroutine.function}({parameters}):")
+        self.indent += 1
+        if subroutine.memory:
+            self.out("caller, base = r[3], state[0]")
+            self.out(f"state[0] = base + {subroutine.size}")
+            self.out("r[3] = base")
+            for i in range(subroutine.size):
+                self.out(f"write(base + {i}, {f'l{i}' if i < subroutine.arity else 0})")
+        else:
+            for i in range(subroutine.arity, subroutine.size):
+                self.out(f"l{i} = 0")
+        self.out("stack = []")
+        self.out("pc = 0")
+        self.out("while True:")
+        self.indent += 1
+        block = 0
+        self.stack = []
+        self.begin_block(block)
+        for line, words in subroutine.lines:
+            self.line = line
+            if words[0] in ("label", "setl"):
+                self.end_block()
+                block += 1
+                self.begin_block(block)
+                continue
+            try:
+                self.instruction(words)
+            except CompileError:
+                raise
+            except (KeyError, IndexError, ValueError):
+                error("Unknown format", self.file, line)
+            if words[0] in ("goto", "return", "halt"):
+                self.end_block()
+                block += 1
+                self.begin_block(block)
+        self.end_block()
+        self.out("return 0" if subroutine is not self.entry else "return")
+        self.indent -= 2
+
+    def begin_block(self, block: int) -> None:
+        self.out(f"if pc <= {block}:")
+        self.indent += 1
+        self.header = len(self.code)
+        self.known = {}
+
+    def end_block(self) -> None:
+        self.flush()
+        if len(self.code) == self.header:
+            self.out("pass")
+        self.indent -= 1
+
+    def leave(self) -> None:
+        """Statements restoring the caller's frame before a return."""
+        if self.now.memory:
+            self.out("state[0] = base")
+            self.out("r[3] = caller")
+
+    def instruction(self, words: List[str]) -> None:
+        op = words[0]
+        operand = words[1] if len(words) > 1 else ""
+        offset = int(words[2]) if len(words) == 3 and op in ("push", "pop") else 0
+        local = not self.now.memory and self.now is not self.entry
+        if op == "push" and operand[0] == "@":
+            if operand == "@L" and local:
+                self.push(Value(f"l{offset}", False))
+            else:
+                self.push(Value(f"read({self.address(operand[1:], offset)})", False))
+        elif op == "push" and operand[0] == "$":
+            key = register[operand[1:]]
+            if key in self.known:
+                self.push(Value(str(self.known[key] + offset), True))
+            else:
+                self.push(Value(wrap(f"{self.read(operand[1:])} + {offset}") if offset else self.read(operand[1:]), False))
+        elif op == "push" and len(words) == 2:
+            self.push(Value(str((int(operand) + 2147483648 & 4294967295) - 2147483648), True))
+        elif op == "pop" and operand[0] == "@":
+            value = self.pop()
+            self.spill()
+            if operand == "@L" and local:
+                self.out(f"l{offset} = {value.source}")
+            else:
+                self.out(f"write({self.address(operand[1:], offset)}, {value.source})")
+        elif op == "pop" and operand[0] == "$" and len(words) == 2:
+            value = self.pop()
+            self.spill()
+            self.write(operand[1:], value.source)
+        elif op == "goto" and len(words) == 3:
+            name, block = self.labels[operand]
+            if name != self.now.name:
+                error(f"goto {operand} leaves the subroutine", self.file, self.line)
+            if words[2] == "all":
+                self.flush()
+                self.out(f"pc = {block}")
+                self.out("continue")
+                return
+            value = self.pop()
+            condition = value.condition or f"{value.source} != 0"
+            if words[2] == "false":
+                condition = f"not ({condition})"
+            elif words[2] != "true":
+                raise ValueError(words[2])
+            if self.stack:
+                name = self.new_temp()
+                self.out(f"{name} = {condition}")
+                condition = name
+                self.flush()
+            self.out(f"if {condition}:")
+            self.out(f"    pc = {block}")
+            self.out("    continue")
+        elif op == "call" and len(words) == 3:
+            self.call(operand, int(words[2]))
+        elif op == "return" and len(words) == 1:
+            value = self.pop()
+            if self.now is self.entry:
+                self.out("return")
+                return
+            if self.now.memory and not value.pure:
+                name = self.new_temp()
+                self.out(f"{name} = {value.source}")
+                value = Value(name, True)
+            self.leave()
+            self.out(f"return {value.source}")
+        elif op == "halt" and len(words) == 1:
+            self.out("raise Stop()")
+        else:
+            self.register(words)
+
+    def call(self, name: str, n: int) -> None:
+        if name in host_function and host_function[name][1] == n:
+            number = host_function[name][0]
+            args = [self.pop() for _ in range(n)][::-1]
+            self.spill()
+            temp = self.new_temp()
+            call = f"host_trap[{number}][1](vm, {', '.join(i.source for i in args)})"
+            self.out(f"{temp} = {wrap(call)}")
+            self.push(Value(temp, True))
+            return
+        if name.startswith("built_in."):
+            function = name[len("built_in.") :]
+            if function in ("neg", "invert", "bool") and n == 1:
+                a = self.pop()
+                if function == "neg":
+                    self.push(Value(wrap(f"-{a.source}"), a.pure))
+                else:
+                    condition = f"{a.source} {'==' if function == 'invert' else '!='} 0"
+                    self.push(Value(f"(1 if {condition} else 0)", a.pure, condition))
+            elif function in binary_source and n == 2:
+                b, a = self.pop(), self.pop()
+                self.push(Value(wrap(binary_source[function].format(a=a.source, b=b.source)), a.pure and b.pure))
+            elif function in plain_source and n == 2:
+                b, a = self.pop(), self.pop()
+                self.push(Value(plain_source[function].format(a=a.source, b=b.source), a.pure and b.pure))
+            elif function in compare_source and n == 2:
+                b, a = self.pop(), self.pop()
+                condition = f"{a.source} {compare_source[function]} {b.source}"
+                self.push(Value(f"(1 if {condition} else 0)", a.pure and b.pure, condition))
+            else:
+                self.spill()
+                self.out(f"raise Exception(\"Unknown built-in function '{name}'\")")
+            return
+        if name == "print" and n == 1:
+            a = self.pop()
+            self.spill()
+            self.out(f"write({CONSOLE_BASE + CONSOLE_INT}, {a.source})")
+            self.out(f"write({CONSOLE_BASE + CONSOLE_CHAR}, 10)")
+            self.push(Value("0", True))
+            return
+        if name == "input" and n == 0:
+            self.spill()
+            temp = self.new_temp()
+            self.out(f"{temp} = read({CONSOLE_BASE + CONSOLE_INT})")
+            self.push(Value(temp, True))
+            return
+        args = [self.pop() for _ in range(n)][::-1]
+        self.spill()
+        self.known = {}
+        temp = self.new_temp()
+        if name in self.subroutines:
+            self.out(f"{temp} = {self.subroutines[name].function}({', '.join(i.source for i in args)})")
+        else:
+            self.out(f"raise Exception(\"Unknown subroutine '{name}'\")")
+        self.push(Value(temp, True))
+
+    def register(self, words: List[str]) -> None:
+        """The register instructions and their syntactic sugar, see ./vmcode."""
+        op = words[0]
+        self.spill()
+        if op == "inpv" and len(words) == 2:
+            value = (int(words[1]) + 2147483648 & 4294967295) - 2147483648
+            self.write("V", str(value))
+            self.known[7] = value
+        elif op == "setv" and len(words) == 3:
+            value = (int(words[2]) + 2147483648 & 4294967295) - 2147483648
+            self.write("V", str(value))
+            self.write(words[1][1:], str(value))
+            self.known[7] = value
+        elif op == "copy" and len(words) == 3:
+            self.write(words[2][1:], self.read(words[1][1:]))
+        elif op in ("load", "stor") and len(words) == 3 and words[1][0] == "@":
+            self.write("A", self.read(words[1][1:]))
+            if op == "load":
+                self.write(words[2][1:], self.read("M"))
+            else:
+                self.write("M", self.read(words[2][1:]))
+        elif op == "comp" and len(words) == 4 and words[2] in ("nv", "aw"):
+            self.write("C", "1" if words[2] == "aw" else "0")
+        elif op == "comp" and len(words) == 4:
+            a, b = self.read(words[1][1:]), self.read(words[3][1:])
+            self.write("C", f"1 if {a} {comp_source[words[2]]} {b} else 0")
+        elif op[:3] in ("add", "sub", "mul", "div", "rmv", "lmv", "and", "or_") and op[3:] in ("r", "v") and len(words) == 4:
+            a = self.read(words[1][1:])
+            if op[3:] == "v":
+                value = (int(words[2]) + 2147483648 & 4294967295) - 2147483648
+                self.write("V", str(value))
+                b = str(value)
+            else:
+                b = self.read(words[2][1:])
+            result = f"divide({a}, {b})" if op[:3] == "div" else f"{a} {operation_source[op[:3]]} {b}"
+            self.write(words[3][1:], wrap(result))
+            if op[3:] == "v" and words[3] != "$V":
+                self.known[7] = value
+        elif op == "sett" and len(words) == 2 and 0 <= int(words[1]) < 8:
+            self.out(f"r[6] = {int(words[1])}")
+        else:
+            raise ValueError(op)
+
+
+def translate(source: List[str], file: str = "<vm>") -> str:
+    """The source of a Python module running the .vm program `source`; its `run(vm)` executes it on a VM."""
+    return Translator(source, file).translate()
+
+
+def module_path(path: str) -> str:
+    """Where the translation of a .vm file is cached: <name>_vm.py next to it."""
+    return path[: -len(".vm")] + "_vm.py"
+
+
+def load(path: str) -> ModuleType:
+    """Import the translation of the .vm file at `path`, translating it again if the cached module is missing or stale."""
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.readlines()
+    target = module_path(path)
+    header = HEADER.format(file=path, digest=sha1("".join(source).encode()).hexdigest())
+    cached = ""
+    if isfile(target):
+        with open(target, "r", encoding="utf-8") as f:
+            cached = f.read(len(header))
+    if cached != header:
+        code = translate(source, path)
+        with open(target, "w", encoding="utf-8") as f:
+            f.write(code)
+    spec = importlib.util.spec_from_file_location(target.split("/")[-1][: -len(".py")], target)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Args:
+    def __init__(self, path: str = "", run: bool = False) -> None:
+        self.path = path
+        self.run = run
+
+
+def parser_args(args: List[str]) -> Args:
+    result = Args()
+    for i in args:
+        if i == "--run":
+            result.run = True
+        elif result.path == "" and isfile(i) and i.endswith(".vm"):
+            result.path = abspath(i)
+    if result.path == "":
+        raise Exception("Need to pass in a .vm file")
+    return result
+
+
+def main(args: Args) -> Optional[VM]:
+    try:
+        module = load(args.path)
+    except CompileError as e:
+        with open(args.path, "r", encoding="utf-8") as f:
+            print(e.show(f.readlines()[e.line])[0])
+        return None
+    print(f"translated to {module_path(args.path)}")
+    if not args.run:
+        return None
+    vm = VM()
+    vm.memory.map(CONSOLE_BASE, Console())
+    try:
+        module.run(vm)
+    finally:
+        vm.memory.flush()
+    print(vm.memory)
+    print(vm.registers)
+    return vm
+
+
+if __name__ == "__main__":
+    if len(argv) > 1:
+        args = parser_args(argv[1:])
+    else:
+        args = parser_args(input("path & args: ").split())
+    main(args)